@@ -0,0 +1,189 @@
+import os
+import shutil
+import logging
+import numpy
+from cycle_table import SECONDS_PER_DAY
+
+
+class UsageArchive:
+    """
+    History of the counters of the VMs of the host, kept after their cycle is over for billing
+    and abuse investigations.
+    Samples are stored in one directory per partition_seconds of time, named after the unix time
+    the partition starts, with one file per column of fixed width values: time.f8 (unix time),
+    vm.i4 (index in vms.txt), rx.i8 and tx.i8 (counters in bytes). Samples are appended in time
+    order, so a time window is found with a binary search on the memory mapped time column,
+    and a query only reads the pages of the window.
+    vms.txt lists 'index, nova id, tenant', one line per VM ever sampled.
+    Partitions older than retention_days are deleted.
+    """
+    columns = (('time', numpy.float64, 'f8'), ('vm', numpy.int32, 'i4'), ('rx', numpy.int64, 'i8'),
+               ('tx', numpy.int64, 'i8'))
+    directory = ''
+    partition_seconds = SECONDS_PER_DAY
+    retention_days = 90
+    partition = None #start of the partition written to
+    vm_indexes = {} #nova id -> index
+    vm_tenants = [] #index -> tenant
+    vm_nova_ids = [] #index -> nova id
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, directory, partition_seconds = SECONDS_PER_DAY, retention_days = 90):
+        """
+        :param directory: created if it does not exist
+        :param partition_seconds: time covered by each partition
+        :param retention_days: days a partition is kept, 0 to keep them all
+        """
+        try:
+            self.partition_seconds = int(partition_seconds)
+            self.retention_days = float(retention_days)
+        except ValueError:
+            raise ValueError('The archive partition size and retention should be numbers.')
+        if self.partition_seconds <= 0:
+            raise ValueError('The archive partition size must be positive, not ' + str(partition_seconds))
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.partition = None
+        self.__load_vms()
+
+
+    def __load_vms(self):
+        self.vm_indexes = {}
+        self.vm_tenants = []
+        self.vm_nova_ids = []
+        fname = os.path.join(self.directory, 'vms.txt')
+        if not os.path.exists(fname):
+            return
+        with open(fname) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break #partial write
+                index, nova_id, tenant = [field.strip() for field in line.split(',')]
+                if int(index) != len(self.vm_nova_ids):
+                    raise LookupError('The archive index ' + fname + ' is out of order at VM ' + nova_id)
+                self.vm_indexes[nova_id] = int(index)
+                self.vm_nova_ids.append(nova_id)
+                self.vm_tenants.append(tenant)
+
+
+    def vm_index(self, nova_id, tenant):
+        """
+        :return: index of the VM, added to vms.txt if it is new
+        """
+        if nova_id not in self.vm_indexes:
+            index = len(self.vm_nova_ids)
+            with open(os.path.join(self.directory, 'vms.txt'), 'a') as f:
+                f.write(str(index) + ', ' + nova_id + ', ' + tenant + '\n')
+            self.vm_indexes[nova_id] = index
+            self.vm_nova_ids.append(nova_id)
+            self.vm_tenants.append(tenant)
+        return self.vm_indexes[nova_id]
+
+
+    def __column_fname(self, partition, name, suffix):
+        return os.path.join(self.directory, str(partition), name + '.' + suffix)
+
+
+    def __open_partition(self, partition):
+        """
+        Start writing to a partition. Columns left longer than the others by a
+        write that was cut short are truncated, so the rows line up again
+        """
+        path = os.path.join(self.directory, str(partition))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        rows = self.rows(partition)
+        for name, dtype, suffix in self.columns:
+            fname = self.__column_fname(partition, name, suffix)
+            with open(fname, 'ab') as f:
+                f.truncate(rows * numpy.dtype(dtype).itemsize)
+        self.partition = partition
+
+
+    def append(self, now, samples):
+        """
+        :param now: unix time of the samples, not before the previous ones
+        :param samples: list of (nova id, tenant, rx bytes, tx bytes)
+        """
+        if not samples:
+            return
+        partition = int(now // self.partition_seconds * self.partition_seconds)
+        if partition != self.partition:
+            self.__open_partition(partition)
+            self.expire(now)
+        values = {'time': numpy.full(len(samples), now, numpy.float64),
+                  'vm': numpy.array([self.vm_index(sample[0], sample[1]) for sample in samples], numpy.int32),
+                  'rx': numpy.array([sample[2] for sample in samples], numpy.int64),
+                  'tx': numpy.array([sample[3] for sample in samples], numpy.int64)}
+        for name, dtype, suffix in self.columns:
+            with open(self.__column_fname(partition, name, suffix), 'ab') as f:
+                f.write(values[name].tobytes())
+
+
+    def partitions(self, start = None, end = None):
+        """
+        :return: sorted start times of the partitions holding samples between start and end
+        """
+        partitions = sorted(int(name) for name in os.listdir(self.directory) if name.isdigit())
+        return [partition for partition in partitions
+                if (start is None or partition + self.partition_seconds > start) and (end is None or partition <= end)]
+
+
+    def rows(self, partition):
+        """
+        :return: number of complete samples in the partition
+        """
+        rows = None
+        for name, dtype, suffix in self.columns:
+            fname = self.__column_fname(partition, name, suffix)
+            size = 0
+            if os.path.exists(fname):
+                size = os.path.getsize(fname) // numpy.dtype(dtype).itemsize
+            if rows is None or size < rows:
+                rows = size
+        return rows
+
+
+    def read(self, partition):
+        """
+        :return: dict of column name -> read only memory mapped array
+        """
+        rows = self.rows(partition)
+        arrays = {}
+        for name, dtype, suffix in self.columns:
+            if rows == 0:
+                arrays[name] = numpy.zeros(0, dtype)
+            else:
+                arrays[name] = numpy.memmap(self.__column_fname(partition, name, suffix), dtype, 'r', shape = (rows,))
+        return arrays
+
+
+    def window(self, start, end):
+        """
+        Samples taken between start and end, both included
+        :return: dict of column name -> array
+        """
+        chunks = dict((name, []) for name, dtype, suffix in self.columns)
+        for partition in self.partitions(start, end):
+            arrays = self.read(partition)
+            first = numpy.searchsorted(arrays['time'], start, 'left')
+            last = numpy.searchsorted(arrays['time'], end, 'right')
+            for name in chunks:
+                chunks[name].append(numpy.array(arrays[name][first:last]))
+        return dict((name, numpy.concatenate(chunks[name]) if chunks[name] else numpy.zeros(0, dtype))
+                    for name, dtype, suffix in self.columns)
+
+
+    def expire(self, now):
+        """
+        Delete the partitions that ended more than retention_days ago
+        """
+        if self.retention_days <= 0:
+            return
+        oldest = now - self.retention_days * SECONDS_PER_DAY
+        for partition in self.partitions():
+            if partition + self.partition_seconds <= oldest:
+                self.logger.info('Deleting the usage archived from ' + str(partition))
+                shutil.rmtree(os.path.join(self.directory, str(partition)))
@@ -0,0 +1,187 @@
+"""
+asyncio main loop for the daemon, selected with --engine=async.
+Needs python 3.5 or later, so it is only imported when that engine is asked for.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from daemon import *
+import metrics
+
+
+class AsyncEngine:
+    """
+    Runs the cycles of a Daemon on an asyncio loop, so the slow parts of a cycle overlap
+    instead of running one after the other: the definitions of the new VMs are read with
+    virsh dumpxml, the host's ports are listed and the counters are collected at the same time.
+    virsh runs through the daemon's virsh session when there is one, else through asyncio
+    subprocesses, and the neutron calls in a thread pool, each behind a semaphore so a backend
+    never has more than its limit of calls in flight.
+    QOS port updates are still applied by the daemon's QosReconciler workers.
+    The quota logic is the Daemon's own, only the scheduling of the calls changes.
+    """
+    daemon = None
+    virsh_command = ['sudo', 'virsh']
+    virsh_concurrency = 4
+    neutron_concurrency = 4
+    semaphores = None
+    executor = None
+    loop = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, daemon, virsh_concurrency = 4, neutron_concurrency = 4):
+        """
+        :param daemon: Daemon whose cycles are run
+        :param virsh_concurrency: most virsh processes at the same time
+        :param neutron_concurrency: most neutron calls at the same time
+        """
+        self.daemon = daemon
+        self.virsh_concurrency = virsh_concurrency
+        self.neutron_concurrency = neutron_concurrency
+        self.executor = ThreadPoolExecutor(virsh_concurrency + neutron_concurrency + 1)
+
+
+    async def virsh(self, args):
+        """
+        The session answers one command at a time, but each costs no new sudo, process or libvirt connection
+        :param args: virsh command and its arguments, i.e. ['dumpxml', '5']
+        :return: output of the command
+        """
+        virsh_session = get_session()
+        if virsh_session is not None:
+            return await self.blocking('virsh', virsh_session.run, args)
+        breaker = get_breaker('virsh')
+        timeout = command_timeouts['virsh']
+        async with self.semaphores['virsh']:
+            breaker.allow()
+            metrics.subprocesses.labels('virsh').inc()
+            process = await asyncio.create_subprocess_exec(*(self.virsh_command + args), stdout = asyncio.subprocess.PIPE,
+                                                           stderr = asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                breaker.record_failure()
+                raise RuntimeError('Hit error while running command (virsh ' + ' '.join(args) + ') \n' +
+                                   'Timed out after ' + str(timeout) + ' seconds')
+        if process.returncode != 0:
+            breaker.record_failure()
+            raise RuntimeError('Hit error while running command (virsh ' + ' '.join(args) + ') \n' +
+                               stderr.decode('utf-8', 'replace').strip())
+        breaker.record_success()
+        return stdout.decode('utf-8', 'replace').strip()
+
+
+    async def blocking(self, backend, function, *args):
+        """
+        Run a blocking call in the thread pool
+        :param backend: semaphore to hold during the call, None for none
+        """
+        if backend is None:
+            return await self.loop.run_in_executor(self.executor, function, *args)
+        async with self.semaphores[backend]:
+            return await self.loop.run_in_executor(self.executor, function, *args)
+
+
+    async def collect_counters(self, vms, due_vm_ids, now):
+        daemon = self.daemon
+        if not isinstance(daemon.collector, VirshCollector):
+            return await self.blocking(None, daemon.collect_counters, vms, due_vm_ids, now)
+        try:
+            with stage_timer('counter_collection'):
+                return daemon.collector.parse_domstats(await self.virsh(['domstats', '--interface', '--list-active']))
+        except Exception:
+            for vm_id in due_vm_ids:
+                daemon.samples.schedule(vm_id, 0, now)
+            raise
+
+
+    async def read_definitions(self, vm_ids):
+        """
+        :return: dict of vm id -> output of virsh dumpxml. The VMs that could not be read are left out,
+                 adding them falls back to reading their definition on their own
+        """
+        vm_ids = list(vm_ids)
+        results = await asyncio.gather(*[self.virsh(['dumpxml', vm_id]) for vm_id in vm_ids], return_exceptions = True)
+        domain_xml = {}
+        for vm_id, result in zip(vm_ids, results):
+            if isinstance(result, Exception):
+                self.logger.warning('Could not read the definition of VM ' + vm_id + ': ' + str(result))
+            else:
+                domain_xml[vm_id] = result
+        return domain_xml
+
+
+    async def cycle(self, vms, deadline):
+        daemon = self.daemon
+        self.logger.info('Beginning live update cycle')
+        live_vm_ids = await self.blocking('virsh', daemon.refresh_live_vms, vms)
+        now = time.time()
+        due_vm_ids = daemon.pop_due_vm_ids(vms, now)
+        new_vm_ids = [vm_id for vm_id in live_vm_ids if vm_id not in vms and daemon.quarantine.ready(vm_id)]
+        tasks = [self.collect_counters(vms, due_vm_ids, now)]
+        if new_vm_ids:
+            tasks.append(self.read_definitions(new_vm_ids))
+            tasks.append(self.blocking('neutron', daemon.ports.refresh))
+        results = await asyncio.gather(*tasks, return_exceptions = True)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        counters = results[0]
+        domain_xml = {}
+        if new_vm_ids:
+            domain_xml = results[1]
+            if isinstance(results[2], Exception):
+                #the VMs look their port up on their own
+                self.logger.warning('Could not list the ports of the host: ' + str(results[2]))
+        await self.blocking(None, daemon.evaluate, vms, due_vm_ids, counters, now)
+        await self.blocking('neutron', daemon.add_new_vms, vms, live_vm_ids, counters, deadline, domain_xml)
+        await self.blocking(None, daemon.report_fleet_usage, vms)
+        await self.blocking(None, daemon.checkpoint, vms)
+        return vms
+
+
+    async def wait(self, vms):
+        """
+        Sleep until the next cycle is due, handling lifecycle events as soon as they arrive
+        """
+        daemon = self.daemon
+        while True:
+            remaining = daemon.scheduler.remaining()
+            if remaining <= 0:
+                return vms
+            if daemon.limits.store is not None:
+                remaining = min(remaining, daemon.limit_poll_time)
+            if daemon.watcher is None:
+                await asyncio.sleep(remaining)
+            elif await self.loop.run_in_executor(self.executor, daemon.watcher.wakeup.wait, remaining):
+                vms = await self.blocking('neutron', daemon.handle_lifecycle_events, vms, daemon.scheduler.next_deadline)
+            #also retries the VMs that could not take their new limit, whatever the limits are read from
+            await self.blocking('neutron', daemon.poll_limits, vms)
+
+
+    async def run(self):
+        daemon = self.daemon
+        self.semaphores = {'virsh': asyncio.Semaphore(self.virsh_concurrency),
+                           'neutron': asyncio.Semaphore(self.neutron_concurrency)}
+        vms = await self.blocking(None, daemon.load_file)
+        while True:
+            deadline = daemon.scheduler.begin_cycle()
+            await self.blocking('neutron', daemon.resynch_limits_if_due, vms)
+            try:
+                with Timer(metrics.cycle_duration):
+                    vms = await self.cycle(vms, deadline)
+            except Exception as exception:
+                self.logger.error(exception)
+            daemon.scheduler.complete_cycle()
+            try:
+                vms = await self.wait(vms)
+            except Exception as exception:
+                self.logger.error(exception)
+
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.run())
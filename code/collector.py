@@ -0,0 +1,194 @@
+import os
+import logging
+from virsh import virsh_cmd
+
+
+class CounterCollector:
+    """
+    Reads the rx/tx byte counters of the VM tap devices.
+    Counters are reported from the VM's point of view (the same as virsh domifstat),
+    so rx_bytes is the traffic the VM received.
+    Backends implement collect, which reads a batch of taps in one go,
+    and read, which reads a single VM.
+    """
+    logger = logging.getLogger(__name__)
+
+
+    def collect(self, tap_interfaces = None):
+        """
+        Read the counters of many VMs at once
+        :param tap_interfaces: taps we need counters for, None for every tap on the host
+        :return: dict of tap device -> (rx_bytes, tx_bytes)
+        """
+        raise NotImplementedError()
+
+
+    def read(self, virsh_id, tap_interface):
+        """
+        Read the counters of a single VM
+        :param virsh_id:
+        :param tap_interface:
+        :return: (rx_bytes, tx_bytes)
+        """
+        samples = self.collect([tap_interface])
+        if tap_interface not in samples:
+            raise LookupError('Could not find rx_byte data for vm ' + virsh_id)
+        return samples[tap_interface]
+
+
+
+class VirshCollector(CounterCollector):
+    """
+    Collects the interface counters of every domain on the host with a single
+    'virsh domstats --interface' call, instead of one 'virsh domifstat' per VM.
+    Samples are keyed by tap device name, which is unique on the host and is
+    already known by every Vm.
+    """
+
+
+    def collect(self, tap_interfaces = None):
+        return self.parse_domstats(virsh_cmd(['domstats', '--interface', '--list-active']))
+
+
+    def read(self, virsh_id, tap_interface):
+        bandwidth_data = virsh_cmd(['domifstat', virsh_id, tap_interface])
+        rx_bytes = None
+        tx_bytes = 0
+        for bandwith_data_line in bandwidth_data.splitlines():
+            if ('rx_bytes' in bandwith_data_line):
+                rx_bytes = int(bandwith_data_line.split()[-1])
+            elif ('tx_bytes' in bandwith_data_line):
+                tx_bytes = int(bandwith_data_line.split()[-1])
+        if rx_bytes is None:
+            raise LookupError('Could not find rx_byte data for vm ' + virsh_id)
+        return (rx_bytes, tx_bytes)
+
+
+    def parse_domstats(self, domstats_output):
+        """
+        Parse the key=value output of virsh domstats. Each domain block lists
+        net.<n>.name followed by net.<n>.rx.bytes and net.<n>.tx.bytes
+        :param domstats_output:
+        :return: dict of tap device -> (rx_bytes, tx_bytes)
+        """
+        samples = {}
+        interfaces = {}
+        for line in domstats_output.splitlines():
+            line = line.strip()
+            if line.startswith('Domain:'):
+                self.__add_samples(samples, interfaces)
+                interfaces = {}
+                continue
+            if not line.startswith('net.') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            key_split = key.split('.')
+            if len(key_split) < 3 or not key_split[1].isdigit():
+                continue
+            interface = interfaces.setdefault(key_split[1], {})
+            field = '.'.join(key_split[2:])
+            if field == 'name':
+                interface['name'] = value
+            elif field in ('rx.bytes', 'tx.bytes'):
+                try:
+                    interface[field] = int(value)
+                except ValueError:
+                    raise LookupError('virsh domstats returned ' + value + ' for ' + key + ', which is not a number.')
+        self.__add_samples(samples, interfaces)
+        return samples
+
+
+    def __add_samples(self, samples, interfaces):
+        for interface in interfaces.values():
+            if 'name' in interface and 'rx.bytes' in interface:
+                samples[interface['name']] = (interface['rx.bytes'], interface.get('tx.bytes', 0))
+
+
+
+class SysfsCollector(CounterCollector):
+    """
+    Reads the kernel counters of the tap devices from sysfs, no subprocess needed.
+    The kernel counts from the host side of the tap, so the host's tx is the VM's rx.
+    """
+    root = '/sys/class/net'
+
+
+    def __init__(self, root = None):
+        """
+        :param root: Directory holding one folder per network device. Default /sys/class/net
+        """
+        if root is not None:
+            self.root = root
+
+
+    def collect(self, tap_interfaces = None):
+        if tap_interfaces is None:
+            tap_interfaces = [device for device in os.listdir(self.root) if device.startswith('tap')]
+        samples = {}
+        for tap_interface in tap_interfaces:
+            statistics = os.path.join(self.root, tap_interface, 'statistics')
+            try:
+                samples[tap_interface] = (self.__read_counter(statistics, 'tx_bytes'),
+                                          self.__read_counter(statistics, 'rx_bytes'))
+            except (IOError, OSError):
+                self.logger.debug('No sysfs statistics for ' + tap_interface)
+        return samples
+
+
+    def __read_counter(self, statistics, name):
+        with open(os.path.join(statistics, name)) as f:
+            return int(f.read())
+
+
+
+class ProcNetDevCollector(CounterCollector):
+    """
+    Reads the counters of every network device from a single read of /proc/net/dev.
+    Like sysfs the counters are from the host side of the tap, so rx and tx are swapped.
+    """
+    path = '/proc/net/dev'
+
+
+    def __init__(self, path = None):
+        """
+        :param path: Default /proc/net/dev
+        """
+        if path is not None:
+            self.path = path
+
+
+    def collect(self, tap_interfaces = None):
+        samples = {}
+        if tap_interfaces is not None:
+            tap_interfaces = set(tap_interfaces)
+        with open(self.path) as f:
+            for line in f:
+                if ':' not in line:
+                    continue #headers
+                device, counters = line.split(':', 1)
+                device = device.strip()
+                if tap_interfaces is None and not device.startswith('tap'):
+                    continue
+                if tap_interfaces is not None and device not in tap_interfaces:
+                    continue
+                counters = counters.split()
+                if len(counters) < 9:
+                    raise LookupError('The file ' + self.path + ' has an unexpected format for device ' + device)
+                #Receive columns come first: bytes packets errs drop fifo frame compressed multicast, then transmit
+                samples[device] = (int(counters[8]), int(counters[0]))
+        return samples
+
+
+
+collector_backends = {'virsh': VirshCollector, 'sysfs': SysfsCollector, 'procfs': ProcNetDevCollector}
+
+
+def get_collector(backend):
+    """
+    :param backend: One of virsh, sysfs or procfs
+    :return: CounterCollector
+    """
+    if backend not in collector_backends:
+        raise ValueError('Unknown counter backend ' + str(backend) + '. Use one of ' +
+                         ', '.join(sorted(collector_backends.keys())))
+    return collector_backends[backend]()
@@ -0,0 +1,210 @@
+import datetime
+import logging
+import numpy
+
+
+BYTES_PER_GB = 1000000000
+SECONDS_PER_DAY = 86400
+
+
+class CycleTable:
+    """
+    Cycle state of every VM of the host, one row per VM, held in numpy arrays so the
+    new cycle and abuse checks of a whole cycle run as one pass instead of one VM at a time.
+    Counters are kept in bytes, as read from the collector.
+    Limits are stored once in their own arrays and referenced by index from the rows.
+    """
+    capacity = 0
+    start_date = None     #unix time the cycle started
+    start_bytes = None    #rx counter when the cycle started
+    restricted = None
+    limit_index = None
+    last_date = None      #unix time of the last sample, 0 if there was none
+    last_bytes = None     #rx counter at the last sample
+    free_rows = None
+    limits = None         #(name, time period, band limit, band per sec) -> limit index
+    limit_period = None   #seconds
+    limit_bytes = None
+    line_rate = 1250000000.0 #bytes per second, the fastest a counter can grow
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, capacity = 64, line_rate = 10):
+        """
+        :param line_rate: Gbps of the link of the host, the fastest a VM can receive
+        """
+        self.line_rate = float(line_rate) * BYTES_PER_GB / 8
+        self.capacity = 0
+        self.start_date = numpy.zeros(0, numpy.float64)
+        self.start_bytes = numpy.zeros(0, numpy.int64)
+        self.restricted = numpy.zeros(0, numpy.bool_)
+        self.limit_index = numpy.zeros(0, numpy.int32)
+        self.last_date = numpy.zeros(0, numpy.float64)
+        self.last_bytes = numpy.zeros(0, numpy.int64)
+        self.free_rows = []
+        self.limits = {}
+        self.limit_period = numpy.zeros(0, numpy.float64)
+        self.limit_bytes = numpy.zeros(0, numpy.int64)
+        self.__grow(capacity)
+
+
+    def __len__(self):
+        return self.capacity - len(self.free_rows)
+
+
+    def __grow(self, capacity):
+        added = capacity - self.capacity
+        self.start_date = numpy.concatenate((self.start_date, numpy.zeros(added, numpy.float64)))
+        self.start_bytes = numpy.concatenate((self.start_bytes, numpy.zeros(added, numpy.int64)))
+        self.restricted = numpy.concatenate((self.restricted, numpy.zeros(added, numpy.bool_)))
+        self.limit_index = numpy.concatenate((self.limit_index, numpy.zeros(added, numpy.int32)))
+        self.last_date = numpy.concatenate((self.last_date, numpy.zeros(added, numpy.float64)))
+        self.last_bytes = numpy.concatenate((self.last_bytes, numpy.zeros(added, numpy.int64)))
+        #hand out the low rows first
+        self.free_rows.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+
+    def add(self, date, start_bytes, restricted = False):
+        """
+        :return: CycleView of the new row
+        """
+        if not self.free_rows:
+            self.__grow(max(64, self.capacity * 2))
+        row = self.free_rows.pop()
+        self.start_date[row] = date
+        self.start_bytes[row] = start_bytes
+        self.restricted[row] = restricted
+        self.limit_index[row] = 0
+        self.last_date[row] = 0
+        self.last_bytes[row] = 0
+        return CycleView(self, row)
+
+
+    def remove(self, row):
+        self.free_rows.append(row)
+
+
+    def set_limit(self, row, limit):
+        """
+        :param limit: LimitType
+        """
+        key = (limit.name, limit.time_period, limit.band_limit, limit.band_per_sec)
+        if key not in self.limits:
+            self.limits[key] = len(self.limits)
+            self.limit_period = numpy.append(self.limit_period, float(limit.time_period) * SECONDS_PER_DAY)
+            self.limit_bytes = numpy.append(self.limit_bytes, numpy.int64(limit.band_limit * BYTES_PER_GB))
+        self.limit_index[row] = self.limits[key]
+
+
+    def evaluate(self, rows, dates, rx_bytes):
+        """
+        Records a sample for each row, starts a new cycle for the rows whose time period
+        is over and restricts the rows that used more than their limit this cycle
+        :param rows: rows sampled
+        :param dates: unix time of each sample
+        :param rx_bytes: rx counter of each sample
+        :return: (lifted, abused) boolean arrays matching rows. lifted is True for the rows
+                 whose restriction ended with their cycle, abused for the rows just restricted
+        """
+        rows = numpy.asarray(rows, numpy.intp)
+        dates = numpy.asarray(dates, numpy.float64)
+        rx_bytes = numpy.asarray(rx_bytes, numpy.int64)
+        self.last_date[rows] = dates
+        self.last_bytes[rows] = rx_bytes
+        limits = self.limit_index[rows]
+        #start of new cycle
+        new_cycle = dates - self.start_date[rows] > self.limit_period[limits]
+        lifted = new_cycle & self.restricted[rows]
+        reset_rows = rows[new_cycle]
+        self.start_date[reset_rows] = dates[new_cycle]
+        self.start_bytes[reset_rows] = rx_bytes[new_cycle]
+        self.restricted[reset_rows] = False
+        #abuse detected
+        abused = ~self.restricted[rows] & (rx_bytes - self.start_bytes[rows] > self.limit_bytes[limits])
+        self.restricted[rows[abused]] = True
+        return lifted, abused
+
+
+    def usage_since(self, rows, previous_dates, previous_bytes):
+        """
+        :param previous_dates: last_date of the rows before they were sampled
+        :param previous_bytes: last_bytes of the rows before they were sampled
+        :return: array of the bytes each row received between the two samples, 0 for the rows
+                 not sampled since, sampled for the first time or whose counter went back
+        """
+        rows = numpy.asarray(rows, numpy.intp)
+        used = self.last_bytes[rows] - previous_bytes
+        counted = (previous_dates > 0) & (self.last_date[rows] != previous_dates) & (used > 0)
+        return numpy.where(counted, used, 0)
+
+
+    def next_sample_time(self, rows):
+        """
+        Earliest time each row could cross its quota or start a new cycle. The QOS policy of the
+        port limits what the VM sends, not the rx counter that is metered, so the only bound on how
+        fast the counter grows is the line rate of the host
+        :return: array of unix times, 0 for the rows never sampled
+        """
+        rows = numpy.asarray(rows, numpy.intp)
+        limits = self.limit_index[rows]
+        cycle_end = self.start_date[rows] + self.limit_period[limits]
+        remaining = numpy.maximum(self.limit_bytes[limits] - (self.last_bytes[rows] - self.start_bytes[rows]), 0)
+        crossing = self.last_date[rows] + remaining / self.line_rate
+        due = numpy.where(self.restricted[rows], cycle_end, numpy.minimum(cycle_end, crossing))
+        return numpy.where(self.last_date[rows] == 0, 0, due)
+
+
+
+class CycleView:
+    '''
+    Cycle of one VM, read from its row of the CycleTable
+    '''
+    table = None
+    row = -1
+
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+
+    @property
+    def date(self):
+        return float(self.table.start_date[self.row])
+
+
+    @property
+    def start_bytes(self):
+        return int(self.table.start_bytes[self.row])
+
+
+    @property
+    def bandwidth(self):
+        """
+        :return: counter at the start of the cycle in GB
+        """
+        return float(self.start_bytes) / BYTES_PER_GB
+
+
+    @property
+    def is_restricted(self):
+        return bool(self.table.restricted[self.row])
+
+
+    def __format_time(self):
+        return datetime.datetime.fromtimestamp(self.date).strftime('%Y-%m-%d %H:%M:%S')
+
+
+    def stringify(self):
+        '''
+        Converts the cycle to a format that can be written to a text file, the bandwidth in GB to the byte
+        :return: String
+        '''
+        return repr(self.date) + ', ' + '%.9f' % self.bandwidth + ', ' + str(self.is_restricted)
+
+
+    def __str__(self):
+        output =  ('Cycle start date:      ' + self.__format_time() + ' \n'
+                   'Cycle inital bandwith  ' + str(self.bandwidth) + 'GB')
+        return output
@@ -1,40 +1,126 @@
 import os
+import time
 import signal
 import logging
 from vm import *
+from cycle_table import *
 from limit import *
+from collector import *
+from ports import *
+from journal import *
+from reconcile import *
+from openstack import get_client
+from lifecycle import *
+from scheduler import *
+from sampling import *
+from quarantine import *
+from virsh import *
 from util import *
+from metrics import MetricsServer
+from status import *
+from fleet import FleetClient, read_token
+from archive import UsageArchive
+from limit_store import LimitStore
+from enforcer import get_enforcer
+import metrics
 
 
 class Daemon():
     """
     Starts a daemon that sets QOS rules and monitors bandwidth
     The easiest way to start the daemon is to simply run the startup.py file
-    There is a recovery file that gets written every cycle that holds basic data about
-    all the VMs we are monitoring to record the last bandwidth cycle values.
+    There is a recovery file that holds basic data about all the VMs we are monitoring
+    to record the last bandwidth cycle values. Only the VMs that changed are appended to its
+    journal every cycle, and the journal is compacted back into the recovery file once it grows.
     Definitions of the QOS rules are read from a yaml file whose path is passed it
     when the daemon is started. If this file is updated, you can send an interupt 30 (kill -30 pid) to
     the process, to tell the daemon to read the updated file. The file will automatically be reread once per 24 hours
+    A VM is only sampled once it could have reached its quota or the end of its cycle, receiving at the
+    line rate of the host, and at least once per max_sample_interval seconds.
+    Cycles are kept on a fixed cadence on the monotonic clock. When a cycle runs past the time the next one
+    is due, onboarding new VMs is left to the next cycle and the cycles it ran into are skipped.
+    With a metrics port, the duration of the cycles and of each of their stages, the processes started
+    and the VMs tracked are served in the Prometheus text format on http://127.0.0.1:<port>/metrics.
+    The health of the daemon and the usage of each VM against its quota, as of the last cycle, are
+    answered on the status socket, which metering_check.py queries.
+    With a fleet aggregator, the traffic of the VMs is added up per tenant and pushed to it once per cycle,
+    and the VMs of the tenants it reports over their fleet wide quota get the restricted QOS policy until it
+    stops reporting them.
+    With an archive directory, the counters of every sample are also kept for archive_retention days,
+    for usage_query.py to report the usage of any VM or tenant over any time window.
+    With a limit store instead of the yaml file, the store is polled every limit_poll_time seconds
+    between cycles, and tenants moved to another limit are updated without waiting for the next resynch.
+    With a local enforcer, a VM over its quota gets the restricted QOS policy, and its tap is rate limited
+    to the restricted limit as soon as the abuse is detected, until neutron has confirmed the policy.
+    Without one, the VM keeps the policy of its limit.
 
     """
 
 
     logger = logging.getLogger(__name__)
     recovery_fname = ''
+    recovery_header = 'vm id, date(unix time), date (GB), restricted(t/f), nova id, tap, mac, tenant, port id, policy'
+    journal = None
     cycle_update_time = -1 #seconds
     limit_synch_time = -1 # seconds (converted from daemon init which is hours)
     resynch_flag = False
     limits = {}
+    collector = None
+    ports = None
+    qos = None
+    watcher = None
+    domains = {} #domain name -> vm id
+    full_poll_cycles = 20
+    cycles_since_full_poll = 0
+    next_limit_synch = 0 #time on the monotonic clock
+    scheduler = None
+    samples = None
+    table = None
+    quarantine = None
+    deferred_vm_ids = set() #new VMs left for the next cycle when a cycle runs late
+    metrics_server = None
+    status_board = None
+    status_server = None
+    fleet = None
+    archive = None
+    limit_poll_time = 5 #seconds
+    enforcer = None
 
 
-    def __init__(self, cycle_update_time, limit_synch_time):
+    def __init__(self, cycle_update_time, limit_synch_time, counter_backend = 'virsh', fsync_policy = 'cycle',
+                 compact_threshold = 1000, qos_workers = 4, lifecycle = 'poll', full_poll_cycles = 20,
+                 max_sample_interval = 3600, virsh_session = True, metrics_port = 0,
+                 status_socket = None, recovery_fname = None, meter_fname = '/etc/metering/meter.yaml',
+                 fleet_url = None, fleet_token_file = '/etc/metering/fleet.token', archive_dir = None, archive_retention = 90, limit_store = None,
+                 limit_poll_time = 5, local_enforcer = 'none', handoff_delay = 30, line_rate = 10):
         """
 
-        :param recovery_fname: Name of the file to dump status
+        :param recovery_fname: Name of the file to dump status. Default recovery.txt next to the daemon
         :param meter_fname: limit definition file (Todo, move and read this file from the controller)
         :param log_level:
         :param cycle_update_time: How often to read data from virsh (seconds)
         :param limit_synch_time: How often to reread the limit file (Hours)
+        :param counter_backend: Where to read the VM counters from, virsh, sysfs or procfs
+        :param fsync_policy: When to fsync the recovery journal, always, cycle or never
+        :param compact_threshold: Number of journal entries before the recovery file is rewritten
+        :param qos_workers: Number of neutron port updates that can run at the same time
+        :param lifecycle: How VMs starting and stopping are noticed: events (virsh event, run with sudo),
+                          inotify (libvirt runtime directory) or poll (list the domains every cycle)
+        :param full_poll_cycles: With events or inotify, list every domain once per this many cycles as a safety net
+        :param max_sample_interval: Most seconds between two samples of a VM that is far from its quota
+        :param virsh_session: Send the virsh commands to one long lived virsh shell instead of starting virsh for each
+        :param metrics_port: Port of the local metrics endpoint, 0 for none
+        :param status_socket: Path of the Unix socket answering status queries, None for none
+        :param fleet_url: url of the aggregator of the tenant usage across the compute nodes, None for none
+        :param fleet_token_file: File holding the token shared with the aggregator
+        :param archive_dir: Directory of the history of the VM counters, None for no history
+        :param archive_retention: Days the history is kept, 0 to keep it all
+        :param limit_store: SQLite database of the limits to use instead of meter_fname, None for the file
+        :param limit_poll_time: Seconds between two checks of the limit store for changes
+        :param local_enforcer: Give a VM over its quota the restricted policy and rate limit its tap right away
+                               with tc or ovs, none to leave it on its limit
+        :param handoff_delay: Seconds the local rate limit is kept once neutron confirmed the restricted policy
+        :param line_rate: Gbps of the link of the host, the fastest a VM can use up its quota
         :return:
         """
         try:
@@ -42,10 +128,49 @@ class Daemon():
             self.limit_synch_time = int(limit_synch_time) * 3600
         except ValueError:
             raise Exception("Either cycle_update_time or limit_synch_time is not a valid integer.")
+        try:
+            metrics_port = int(metrics_port)
+        except ValueError:
+            raise Exception('The metrics port ' + str(metrics_port) + ' is not a valid integer.')
+        if virsh_session:
+            set_session(VirshSession())
         self.__check_credentials()
         self.__check_qos_enabled()
-        self.recovery_fname = os.path.dirname(os.path.realpath(__file__))  + "/recovery.txt"
-        self.limits = LimitCollection()
+        if recovery_fname is None:
+            recovery_fname = os.path.dirname(os.path.realpath(__file__))  + "/recovery.txt"
+        self.recovery_fname = recovery_fname
+        self.journal = StateJournal(self.recovery_fname, self.recovery_header, fsync_policy, compact_threshold)
+        store = None
+        if limit_store:
+            store = LimitStore(limit_store)
+        self.limits = LimitCollection(meter_fname, store)
+        self.limit_poll_time = float(limit_poll_time)
+        self.enforcer = get_enforcer(local_enforcer, self.limits, handoff_delay)
+        self.collector = get_collector(counter_backend)
+        self.ports = PortIndex()
+        self.qos = QosReconciler(qos_workers)
+        self.qos.start()
+        self.domains = {}
+        self.deferred_vm_ids = set()
+        self.scheduler = CycleScheduler(self.cycle_update_time)
+        self.next_limit_synch = monotonic() + self.limit_synch_time
+        self.samples = SampleQueue(int(max_sample_interval))
+        self.table = CycleTable(line_rate = line_rate)
+        self.quarantine = Quarantine()
+        self.full_poll_cycles = int(full_poll_cycles)
+        self.cycles_since_full_poll = self.full_poll_cycles #list every domain on the first cycle
+        self.watcher = get_lifecycle_watcher(lifecycle)
+        if self.watcher is not None:
+            self.watcher.start()
+        if metrics_port:
+            self.metrics_server = MetricsServer(metrics.registry, metrics_port).start()
+        if fleet_url:
+            self.fleet = FleetClient(fleet_url, read_token(fleet_token_file))
+        if archive_dir:
+            self.archive = UsageArchive(archive_dir, retention_days = archive_retention)
+        self.status_board = StatusBoard(self.cycle_update_time)
+        if status_socket:
+            self.status_server = StatusServer(status_socket, self.status_board).start()
         signal.signal(30, self.__signal_handler) #catch interupt 30
         self.logger.info("Daemon started succesfully")
 
@@ -53,16 +178,16 @@ class Daemon():
 
     def __check_credentials(self):
         try:
-            subprocess_cmd('nova list', 0)
-        except RuntimeError:
+            get_client().list_servers()
+        except Exception:
             raise Exception('Unable to access the openstack services. Please source a stackrc/openrc and ensure the openstack cloud '
                             'is up and running succesfully.')
 
 
     def __check_qos_enabled(self):
         try:
-            subprocess_cmd('neutron qos-policy-list', 0)
-        except Exception as exception:
+            get_client().list_qos_policies()
+        except Exception:
             raise Exception('Unable to access QOS service. Either it is not enabled, or Openstack is not working properly.')
 
 
@@ -78,33 +203,81 @@ class Daemon():
 
 
     def __get_vm_id(self, virsh_vm_output):
+        """
+        :param virsh_vm_output: line of virsh list, i.e. ' 5     instance-00000005     running'
+        :return: (vm id, domain name)
+        """
         virsh_output_split = virsh_vm_output.split()
         if len(virsh_output_split) > 2  and virsh_output_split[0].isdigit():
-            return virsh_output_split[0]
+            return virsh_output_split[0], virsh_output_split[1]
         else:
             raise LookupError('virsh output did not provide an instance id. Ensure output of virsh has not changed.')
 
 
-    def __get_live_vm_ids(self):
-        vm_ids = []
-        virsh_vms = subprocess_cmd('sudo virsh list | tail -n +3 | head -n -1')
-        for virsh_vm_output in virsh_vms.splitlines():
-            vm_ids.append(self.__get_vm_id(virsh_vm_output))
-        return vm_ids
+    def __get_list_rows(self, virsh_list_output):
+        """
+        :param virsh_list_output: output of virsh list, a header then a line of dashes then one line per domain
+        :return: list of the domain lines
+        """
+        lines = virsh_list_output.splitlines()
+        for index, line in enumerate(lines):
+            if line.strip().startswith('---'):
+                return [line for line in lines[index + 1:] if line.strip()]
+        raise LookupError('virsh list did not print its header. Ensure output of virsh has not changed.')
+
+
+    def __list_live_vm_ids(self):
+        """
+        List every running domain
+        :return: set of vm ids
+        """
+        if self.watcher is not None:
+            self.watcher.poll() #the listing below covers everything received so far
+        self.domains = {}
+        virsh_vms = virsh_cmd(['list'])
+        for virsh_vm_output in self.__get_list_rows(virsh_vms):
+            vm_id, domain_name = self.__get_vm_id(virsh_vm_output)
+            self.domains[domain_name] = vm_id
+        self.cycles_since_full_poll = 0
+        return set(self.domains.values())
+
+
+    def __get_live_vm_ids(self, vms = None):
+        """
+        With a lifecycle watcher the VMs we already track are only adjusted with the domains
+        that started or stopped since the last call. The full list is read on startup and
+        every full_poll_cycles cycles in case an event was missed.
+        :param vms: VMs tracked so far
+        :return: set of vm ids
+        """
+        if self.watcher is None or vms is None or self.cycles_since_full_poll >= self.full_poll_cycles:
+            return self.__list_live_vm_ids()
+        self.cycles_since_full_poll += 1
+        live_vm_ids = set(vms.keys()) | self.deferred_vm_ids
+        for event, domain_name in self.watcher.poll():
+            if event == STARTED:
+                try:
+                    vm_id = virsh_cmd(['domid', domain_name], 0).strip()
+                except RuntimeError as exception:
+                    self.logger.warning('Domain ' + domain_name + ' started but is already gone: ' + str(exception))
+                    continue
+                self.domains[domain_name] = vm_id
+                live_vm_ids.add(vm_id)
+            elif event == STOPPED and domain_name in self.domains:
+                vm_id = self.domains.pop(domain_name)
+                live_vm_ids.discard(vm_id)
+                self.deferred_vm_ids.discard(vm_id)
+        return live_vm_ids
 
 
     def __dump_to_recovery_file(self, vms):
         """
         Write output to a file that we can use to recover if there is a crash or issue
+        Only the VMs whose entry changed since the last cycle are written
         :param vms:
         :return:
         """
-        recovery_fname_temp = self.recovery_fname + '.tmp'
-        with open(recovery_fname_temp, 'w+') as f:
-            f.write('vm id, date(unix time), date (GB), restricted(t/f)\n')
-            for vm in vms:
-                f.write(vms[vm].stringify())
-        os.rename(recovery_fname_temp, self.recovery_fname) #copy to a temp file to ensure file is written to completion
+        self.journal.write(dict((vm_id, vms[vm_id].stringify()) for vm_id in vms))
 
 
     def load_file(self):
@@ -115,68 +288,350 @@ class Daemon():
         :return:
         """
         vms = {}
-        if not os.path.exists(self.recovery_fname):
+        vm_entries = self.journal.load()
+        if not vm_entries:
             return vms
         self.logger.info('Loading VM data from file ' + self.recovery_fname)
         vm_live_ids = self.__get_live_vm_ids()
-        with open(self.recovery_fname) as f:
-            for vm_entry in f.readlines()[1:]:
-                vm_entry_split = vm_entry.split(',')
-                if len(vm_entry_split) != 4:
-                    raise LookupError('The dump file does not have the right number of entries')
-                vm_id = vm_entry_split[0]
-                if not vm_id.isdigit():
-                    raise LookupError('The entry ' + vm_id + ' should be a vm_id, but it is not a number.')
-                #Check that VM still exists in live
-                if vm_id not in vm_live_ids:
-                    continue
-                try:
-                    date = (float(vm_entry_split[1]))
-                except ValueError:
-                    raise LookupError('The entry ' + vm_entry_split[1] + ' should be a date in float format.')
-                try:
-                    bandwidth = (float(vm_entry_split[2]))
-                except ValueError:
-                    raise LookupError('The entry ' + vm_entry_split[2] + ' should be a bandwidth, but it is not a number.')
-                restricted = str2bool(vm_entry_split[3])
-                cycle = Cycle(date, bandwidth, restricted)
-                vm = Vm(vm_id, self.limits, cycle)
-                vms[vm_id] = vm
+        for vm_entry in vm_entries.values():
+            vm_entry_split = [field.strip() for field in vm_entry.split(',')]
+            #Files written before the VM metadata was recorded only have the first 4 entries
+            if len(vm_entry_split) != 4 and len(vm_entry_split) != 10:
+                raise LookupError('The dump file does not have the right number of entries')
+            vm_id = vm_entry_split[0]
+            if not vm_id.isdigit():
+                raise LookupError('The entry ' + vm_id + ' should be a vm_id, but it is not a number.')
+            #Check that VM still exists in live
+            if vm_id not in vm_live_ids:
+                continue
+            try:
+                date = (float(vm_entry_split[1]))
+            except ValueError:
+                raise LookupError('The entry ' + vm_entry_split[1] + ' should be a date in float format.')
+            try:
+                bandwidth = (float(vm_entry_split[2]))
+            except ValueError:
+                raise LookupError('The entry ' + vm_entry_split[2] + ' should be a bandwidth, but it is not a number.')
+            restricted = str2bool(vm_entry_split[3])
+            cycle = Cycle(date, bandwidth, restricted)
+            metadata = None
+            if len(vm_entry_split) == 10:
+                metadata = {'nova_id': vm_entry_split[4], 'tap_interface': vm_entry_split[5],
+                            'mac_address': vm_entry_split[6], 'tenant': vm_entry_split[7],
+                            'port_id': vm_entry_split[8], 'applied_policy': vm_entry_split[9]}
+            try:
+                vm = Vm(vm_id, self.limits, cycle, collector = self.collector, ports = self.ports, metadata = metadata,
+                        qos = self.qos, table = self.table, enforcer = self.enforcer)
+            except Exception as exception:
+                self.logger.error('Could not restore VM ' + vm_id + ' (' + str(exception) + '), it will be added as a new VM')
+                continue
+            vms[vm_id] = vm
+            self.limits.vms_by_tenant.add(vm_id, vm.tenant)
+            self.samples.schedule(vm_id, 0, time.time())
+        #The listing above counts as the full poll of the first cycle, so the live VMs that were not
+        #restored are added then rather than after full_poll_cycles cycles
+        self.deferred_vm_ids = vm_live_ids - set(vms.keys())
         return vms
 
 
-    def get_live_results(self, vms):
-        self.logger.info('Beginning live update cycle')
-        live_vm_ids = self.__get_live_vm_ids()
-        #Purge deleted VMs
-        for vm_id in vms.keys():
+    def __purge_vms(self, vms, live_vm_ids):
+        for vm_id in list(vms.keys()):
             if vm_id not in live_vm_ids:
+                self.logger.info('VM removed: ' + vm_id)
+                self.ports.forget(vms[vm_id].mac_address)
+                self.qos.cancel(vms[vm_id].port_id)
+                if self.enforcer is not None:
+                    self.enforcer.forget(vms[vm_id].tap_interface)
+                self.samples.remove(vm_id)
+                self.table.remove(vms[vm_id].cycle.row)
+                self.limits.vms_by_tenant.remove(vm_id)
                 del vms[vm_id]
-        #main loop to update measurements for all VMs
-        for vm_id in live_vm_ids:
-            #Pick up newly created VMs
-            if vm_id not in vms:
-                self.logger.info('New VM detected: ' + vm_id)
-                vm =  Vm(vm_id, self.limits)
-                vms[vm_id] = vm
+
+
+    def __add_vm(self, vms, vm_id, counters = None, domain_xml = None):
+        self.logger.info('New VM detected: ' + vm_id)
+        vm =  Vm(vm_id, self.limits, counters = counters, collector = self.collector, ports = self.ports,
+                 qos = self.qos, table = self.table, domain_xml = domain_xml, enforcer = self.enforcer)
+        vms[vm_id] = vm
+        self.limits.vms_by_tenant.add(vm_id, vm.tenant)
+        self.samples.schedule(vm_id, vm.next_sample_time(), time.time())
+
+
+    def add_new_vms(self, vms, live_vm_ids, counters = None, deadline = None, domain_xml = None):
+        """
+        Onboarding a VM reads its definition and looks up its port, so once the deadline has
+        passed the remaining new VMs are left for the next cycle. So are the ones that need
+        virsh or neutron while its circuit breaker is open, and the quarantined ones until their retry time
+        :param deadline: time on the monotonic clock, None to add every new VM
+        :param domain_xml: dict of vm id -> definition already read with virsh dumpxml
+        """
+        self.deferred_vm_ids = set()
+        with stage_timer('discovery'):
+            for vm_id in live_vm_ids:
+                if vm_id in vms:
+                    continue
+                if (deadline is not None and monotonic() >= deadline) or not self.quarantine.ready(vm_id):
+                    self.deferred_vm_ids.add(vm_id)
+                    continue
+                try:
+                    self.__add_vm(vms, vm_id, counters, (domain_xml or {}).get(vm_id))
+                except CircuitOpenError as exception:
+                    self.logger.warning('Could not add VM ' + vm_id + ' yet: ' + str(exception))
+                    self.deferred_vm_ids.add(vm_id)
+                except Exception as exception:
+                    self.quarantine.add(vm_id, exception)
+                    self.deferred_vm_ids.add(vm_id)
+                else:
+                    self.quarantine.release(vm_id)
+        if self.deferred_vm_ids:
+            self.logger.warning(str(len(self.deferred_vm_ids)) + ' new VMs left for the next cycle')
+
+
+    def __isolate(self, vm_id, exception, now):
+        """
+        Sample a VM that failed again once its quarantine is over. If the backend
+        it needed is down it is not the VM's fault, so it is only tried again next cycle
+        """
+        if isinstance(exception, CircuitOpenError):
+            self.samples.schedule(vm_id, 0, now)
+        else:
+            self.samples.schedule(vm_id, self.quarantine.add(vm_id, exception), now)
+
+
+    def status(self, vms):
+        """
+        :return: dict summarising the state of the daemon
+        """
+        return {'vms': len(vms),
+                'restricted': len([vm_id for vm_id in vms if vms[vm_id].cycle.is_restricted]),
+                'quarantined': self.quarantine.status(),
+                'deferred': sorted(self.deferred_vm_ids),
+                'qos_queue_depth': self.qos.depth(),
+                'scheduler': self.scheduler.stats(),
+                'breakers': dict((name, breakers[name].state) for name in breakers),
+                'restricted_tenants': sorted(self.fleet.restricted_tenants) if self.fleet is not None else [],
+                'enforced_locally': len(self.enforcer) if self.enforcer is not None else 0}
+
+
+    def __update_gauges(self, vms):
+        metrics.vms_tracked.set(len(vms))
+        metrics.vms_restricted.set(len([vm_id for vm_id in vms if vms[vm_id].cycle.is_restricted]))
+        metrics.vms_quarantined.set(len(self.quarantine))
+        metrics.qos_queue_depth.set(self.qos.depth())
+        metrics.vms_enforced_locally.set(len(self.enforcer) if self.enforcer is not None else 0)
+
+
+    def refresh_live_vms(self, vms):
+        """
+        Find the running domains and stop tracking the VMs that are gone
+        :return: set of live vm ids
+        """
+        with stage_timer('vm_listing'):
+            live_vm_ids = self.__get_live_vm_ids(vms)
+            #New VMs found this cycle share a single listing of the host's ports
+            self.ports.invalidate()
+            #Purge deleted VMs
+            self.__purge_vms(vms, live_vm_ids)
+            self.quarantine.retain(live_vm_ids)
+        return live_vm_ids
+
+
+    def pop_due_vm_ids(self, vms, now):
+        """
+        :return: ids of the VMs that could have crossed their quota since their last sample
+        """
+        return [vm_id for vm_id in self.samples.pop_due(now) if vm_id in vms]
+
+
+    def collect_counters(self, vms, due_vm_ids, now):
+        """
+        One batch read for the counters of the VMs sampled this cycle
+        :return: dict of tap -> (rx_bytes, tx_bytes)
+        """
+        try:
+            with stage_timer('counter_collection'):
+                return self.collector.collect([vms[vm_id].tap_interface for vm_id in due_vm_ids])
+        except Exception:
+            #sample them again on the next cycle
+            for vm_id in due_vm_ids:
+                self.samples.schedule(vm_id, 0, now)
+            raise
+
+
+    def evaluate(self, vms, due_vm_ids, counters, now):
+        """
+        Update measurements and test for abuse in one pass, a VM that fails is quarantined
+        """
+        due_vms = [vms[vm_id] for vm_id in due_vm_ids]
+        rows = [vm.cycle.row for vm in due_vms]
+        previous_dates = self.table.last_date[rows]
+        previous_bytes = self.table.last_bytes[rows]
+        with stage_timer('quota_evaluation'):
+            failures = dict((vm.virsh_id, exception) for vm, exception in
+                            update_cycles(due_vms, self.limits.restricted_limit_name, counters))
+            next_sample_times = self.table.next_sample_time(rows)
+        if self.fleet is not None:
+            used = self.table.usage_since(rows, previous_dates, previous_bytes)
+            for index in used.nonzero()[0]:
+                self.fleet.add(due_vms[index].tenant, int(used[index]))
+        self.__archive_samples(due_vms, failures, counters, now)
+        for index, vm_id in enumerate(due_vm_ids):
+            if vm_id in failures:
+                self.__isolate(vm_id, failures[vm_id], now)
             else:
-                vms[vm_id].update_cycle(self.limits.restricted_limit_name)
+                self.quarantine.release(vm_id)
+                self.samples.schedule(vm_id, float(next_sample_times[index]), now)
+                #a restored VM may have been rediscovered under another tenant
+                self.limits.vms_by_tenant.add(vm_id, due_vms[index].tenant)
+        self.logger.info('Sampled ' + str(len(due_vm_ids) - len(failures)) + ' of ' + str(len(vms)) + ' VMs, ' +
+                         str(len(failures)) + ' failed, ' + str(len(self.quarantine)) + ' quarantined')
+
+
+    def __archive_samples(self, due_vms, failures, counters, now):
+        if self.archive is None or not counters:
+            return
+        samples = [(vm.nova_id, vm.tenant, counters[vm.tap_interface][0], counters[vm.tap_interface][1])
+                   for vm in due_vms if vm.virsh_id not in failures and vm.tap_interface in counters]
+        try:
+            with stage_timer('archive_write'):
+                self.archive.append(now, samples)
+        except Exception as exception:
+            self.logger.error('Could not archive the samples of this cycle: ' + str(exception))
+
+
+    def checkpoint(self, vms):
+        if self.enforcer is not None:
+            with stage_timer('local_enforcement'):
+                self.enforcer.reconcile(set(vms[vm_id].tap_interface for vm_id in vms))
+        with stage_timer('checkpoint_write'):
+            self.__dump_to_recovery_file(vms)
+        self.__update_gauges(vms)
+        self.status_board.update(vms, self.table, self.status(vms))
+        self.logger.info('QOS updates queued: ' + str(self.qos.depth()) +
+                         ', oldest queued for ' + str(int(self.qos.oldest_age())) + ' seconds')
+
+
+    def report_fleet_usage(self, vms):
+        """
+        Push the tenant usage of this cycle to the aggregator, and restrict the VMs of the tenants it
+        reports over quota. While it cannot be reached the usage is kept and pushed on a later cycle,
+        and the tenants it last reported stay restricted
+        """
+        if self.fleet is None:
+            return
+        try:
+            with stage_timer('fleet_push'):
+                self.fleet.push()
+        except Exception as exception:
+            self.logger.error('Could not push the tenant usage to the aggregator: ' + str(exception))
+        restricted_tenants = self.fleet.restricted_tenants
+        for vm_id in vms:
+            restricted = vms[vm_id].tenant in restricted_tenants
+            if vms[vm_id].fleet_restricted == restricted:
+                continue
+            try:
+                vms[vm_id].set_fleet_restricted(restricted, self.limits.restricted_limit_name)
+            except Exception as exception:
+                #the policy is pushed again with the next sample of the VM
+                self.logger.error('Could not update the policy of VM ' + vm_id + ' for the fleet wide quota of ' +
+                                  'its tenant: ' + str(exception))
+
+
+    def get_live_results(self, vms, deadline = None):
+        """
+        :param deadline: time on the monotonic clock the cycle should be done by, None for no deadline
+        :return: vms
+        """
+        self.logger.info('Beginning live update cycle')
+        live_vm_ids = self.refresh_live_vms(vms)
+        now = time.time()
+        due_vm_ids = self.pop_due_vm_ids(vms, now)
+        counters = self.collect_counters(vms, due_vm_ids, now)
+        self.evaluate(vms, due_vm_ids, counters, now)
+        #Pick up newly created VMs
+        self.add_new_vms(vms, live_vm_ids, counters, deadline)
+        self.report_fleet_usage(vms)
+        self.checkpoint(vms)
+        return vms
+
+
+    def handle_lifecycle_events(self, vms, deadline = None):
+        """
+        Start tracking the VMs that just started and drop the ones that stopped,
+        without waiting for the next measurement cycle
+        :param vms:
+        :param deadline: time on the monotonic clock the next cycle is due
+        :return: vms
+        """
+        live_vm_ids = self.__get_live_vm_ids(vms)
+        self.ports.invalidate()
+        self.__purge_vms(vms, live_vm_ids)
+        self.quarantine.retain(live_vm_ids)
+        self.add_new_vms(vms, live_vm_ids, deadline = deadline)
         self.__dump_to_recovery_file(vms)
         return vms
 
 
+    def __wait(self, vms):
+        """
+        Sleep until the next cycle is due, handling lifecycle events as soon as they arrive
+        :return: vms
+        """
+        while True:
+            remaining = self.scheduler.remaining()
+            if remaining <= 0:
+                return vms
+            if self.limits.store is not None:
+                remaining = min(remaining, self.limit_poll_time)
+            if self.watcher is None:
+                sleep(remaining)
+            elif self.watcher.wakeup.wait(remaining):
+                vms = self.handle_lifecycle_events(vms, self.scheduler.next_deadline)
+            self.poll_limits(vms)
+
+
+    def resynch_limits_if_due(self, vms):
+        """
+        The limit file is reread on its own deadlines on the same clock as the cycles, so it does not drift with them
+        A resynch that fails, i.e. while neutron is down, is tried again next cycle without holding up the measurements
+        """
+        try:
+            if self.resynch_flag or monotonic() >= self.next_limit_synch:
+                self.limits.synch_limits(vms)
+                self.resynch_flag = False
+                #the limits may have changed, so sample every VM against them on this cycle
+                for vm_id in vms:
+                    self.samples.schedule(vm_id, 0, time.time())
+                #a limit synch time of 0 or less resynchs on every cycle
+                self.next_limit_synch = advance_deadline(self.next_limit_synch, self.limit_synch_time, monotonic())
+        except Exception as exception:
+            self.logger.error('Could not resynch the limits: ' + str(exception))
+
+
+    def poll_limits(self, vms):
+        """
+        Apply the changes made to the limit store since it was last read, between two cycles
+        """
+        try:
+            if self.limits.changed():
+                self.limits.synch_limits(vms)
+        except Exception as exception:
+            self.logger.error('Could not apply the changes of the limit store: ' + str(exception))
+
+
     def start(self):
-        time_left = self.limit_synch_time
         vms = self.load_file()
         while True:
+            deadline = self.scheduler.begin_cycle()
+            self.resynch_limits_if_due(vms)
             try:
-                if self.resynch_flag or time_left < 0:
-                    self.limits.synch_limits(vms)
-                    self.resynch_flag = False
-                    time_left = self.limit_synch_time + self.cycle_update_time
-                vms = self.get_live_results(vms)
-                sleep(self.cycle_update_time)
-                time_left = time_left - self.cycle_update_time
+                with Timer(metrics.cycle_duration):
+                    vms = self.get_live_results(vms, deadline)
             except Exception as exception:
                 self.logger.error(exception)
                 #Todo Tell Sensu
+            self.scheduler.complete_cycle()
+            try:
+                vms = self.__wait(vms)
+            except Exception as exception:
+                self.logger.error(exception)
@@ -0,0 +1,237 @@
+import time
+import threading
+import logging
+from util import subprocess_cmd
+import metrics
+
+
+class EnforcerBackend:
+    """
+    Commands that put a rate limit on the traffic a VM sends, on its tap device
+    """
+    command = []
+    timeout = 10 #seconds, the point is to be faster than neutron
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, command = None):
+        """
+        :param command: argument list the arguments are appended to, default the one of the backend
+        """
+        if command is not None:
+            self.command = command
+
+
+    def apply(self, tap_interface, band_per_sec):
+        """
+        :param band_per_sec: kbps
+        """
+        raise NotImplementedError
+
+
+    def remove(self, tap_interface):
+        raise NotImplementedError
+
+
+
+class TcBackend(EnforcerBackend):
+    """
+    A policer on the ingress qdisc of the tap, which is the traffic the VM sends. The filter uses
+    its own priority, ahead of the filters the neutron agent adds, so removing it leaves them alone.
+    The ingress qdisc may already exist, i.e. set up by the neutron linuxbridge agent, so failing
+    to add it is not an error.
+    """
+    command = ['sudo', 'tc']
+    priority = 1
+
+
+    def burst(self, band_per_sec):
+        """
+        :return: kilobytes the VM can send at once, 80% of a second of traffic as the neutron agents do
+        """
+        return max(64, int(band_per_sec * 0.8 / 8))
+
+
+    def apply(self, tap_interface, band_per_sec):
+        try:
+            subprocess_cmd(self.command + ['qdisc', 'add', 'dev', tap_interface, 'handle', 'ffff:', 'ingress'], 0,
+                           self.timeout)
+        except RuntimeError:
+            pass
+        subprocess_cmd(self.command + ['filter', 'replace', 'dev', tap_interface, 'parent', 'ffff:', 'protocol', 'all',
+                                       'prio', str(self.priority), 'handle', '1', 'matchall', 'action', 'police',
+                                       'rate', str(int(band_per_sec)) + 'kbit',
+                                       'burst', str(self.burst(band_per_sec)) + 'k', 'conform-exceed', 'drop'], 0,
+                       self.timeout)
+
+
+    def remove(self, tap_interface):
+        subprocess_cmd(self.command + ['filter', 'del', 'dev', tap_interface, 'parent', 'ffff:', 'protocol', 'all',
+                                       'prio', str(self.priority)], 0, self.timeout)
+
+
+
+class OvsBackend(EnforcerBackend):
+    """
+    The ingress policing of the OVS interface of the tap. The neutron OVS agent enforces QOS with
+    the same fields, so once the policy is confirmed the agent owns them and removing does nothing:
+    clearing them could undo what the agent just wrote.
+    """
+    command = ['sudo', 'ovs-vsctl']
+
+
+    def apply(self, tap_interface, band_per_sec):
+        subprocess_cmd(self.command + ['set', 'interface', tap_interface,
+                                       'ingress_policing_rate=' + str(int(band_per_sec)),
+                                       'ingress_policing_burst=' + str(int(band_per_sec * 0.8))], 0, self.timeout)
+
+
+    def remove(self, tap_interface):
+        pass
+
+
+
+class LocalEnforcer:
+    """
+    Restricts a VM on its tap as soon as abuse is detected, without waiting for neutron and its agent.
+    The restricted QOS policy is still pushed to the port, and once neutron confirmed it the local rate
+    limit is kept for handoff_delay more seconds, for the agent to apply the policy, then removed.
+    A restriction lifted by a new cycle is removed right away.
+    Commands only run from the measurement loop, the QOS workers only record the confirmations.
+    """
+    backend = None
+    limits = None
+    handoff_delay = 30 #seconds
+    enforced = {} #tap -> [band per sec, unix time to hand off to neutron or None before the confirmation]
+    lock = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, backend, limits, handoff_delay = 30):
+        """
+        :param backend: EnforcerBackend
+        :param limits: LimitCollection, for the rate of the restricted limit
+        :param handoff_delay: Seconds the local rate limit is kept once neutron confirmed the restricted policy
+        """
+        self.backend = backend
+        self.limits = limits
+        try:
+            self.handoff_delay = float(handoff_delay)
+        except ValueError:
+            raise ValueError('The hand off delay ' + str(handoff_delay) + ' should be a number of seconds.')
+        self.enforced = {}
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.enforced)
+
+
+    def restrict(self, tap_interface):
+        """
+        Rate limit the tap to the restricted limit until neutron confirms the restricted policy.
+        A failure is logged, neutron still restricts the VM once it gets to it
+        """
+        restricted_limit = self.limits.limits.get(self.limits.restricted_limit_name)
+        if restricted_limit is None:
+            self.logger.error('There is no restricted limit to enforce on ' + tap_interface)
+            return
+        with self.lock:
+            if tap_interface in self.enforced and self.enforced[tap_interface][0] == restricted_limit.band_per_sec:
+                return
+        try:
+            self.backend.apply(tap_interface, restricted_limit.band_per_sec)
+        except Exception as exception:
+            self.logger.error('Could not restrict ' + tap_interface + ' locally: ' + str(exception))
+            return
+        self.logger.info('Restricted ' + tap_interface + ' locally to ' + str(restricted_limit.band_per_sec) + ' kbps')
+        metrics.local_enforcements.labels('restrict').inc()
+        with self.lock:
+            self.enforced[tap_interface] = [restricted_limit.band_per_sec, None]
+
+
+    def adopt(self, tap_interface):
+        """
+        A tap restored from file may still have the rate limit of the previous run of the daemon,
+        remove it on the next reconcile
+        """
+        with self.lock:
+            if tap_interface not in self.enforced:
+                self.enforced[tap_interface] = [None, 0]
+
+
+    def confirm(self, tap_interface, policy):
+        """
+        Called once neutron accepted the policy of the port
+        """
+        with self.lock:
+            if tap_interface in self.enforced and policy == self.limits.restricted_limit_name:
+                if self.enforced[tap_interface][1] is None:
+                    self.enforced[tap_interface][1] = time.time() + self.handoff_delay
+
+
+    def release(self, tap_interface):
+        """
+        The restriction was lifted, remove the local rate limit now
+        """
+        with self.lock:
+            if tap_interface not in self.enforced:
+                return
+        self.__remove(tap_interface, 'release')
+
+
+    def forget(self, tap_interface):
+        """
+        The VM is gone and its tap with it
+        """
+        with self.lock:
+            self.enforced.pop(tap_interface, None)
+
+
+    def reconcile(self, tap_interfaces, now = None):
+        """
+        Hand the taps whose restricted policy was confirmed long enough ago over to neutron
+        :param tap_interfaces: taps of the VMs tracked, the others are forgotten
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for tap_interface in list(self.enforced.keys()):
+                if tap_interface not in tap_interfaces:
+                    del self.enforced[tap_interface]
+            due = [tap_interface for tap_interface in self.enforced
+                   if self.enforced[tap_interface][1] is not None and self.enforced[tap_interface][1] <= now]
+        for tap_interface in due:
+            self.__remove(tap_interface, 'handoff')
+
+
+    def __remove(self, tap_interface, reason):
+        try:
+            self.backend.remove(tap_interface)
+        except Exception as exception:
+            #the filter may not be there, i.e. adopted from a previous run
+            self.logger.warning('Could not remove the local rate limit of ' + tap_interface + ': ' + str(exception))
+        else:
+            self.logger.info('Removed the local rate limit of ' + tap_interface + ' (' + reason + ')')
+            metrics.local_enforcements.labels(reason).inc()
+        with self.lock:
+            self.enforced.pop(tap_interface, None)
+
+
+
+enforcer_backends = {'tc': TcBackend, 'ovs': OvsBackend}
+
+
+def get_enforcer(mode, limits, handoff_delay = 30, command = None):
+    """
+    :param mode: tc, ovs or none
+    :param command: argument list of the backend command, default sudo tc or sudo ovs-vsctl
+    :return: LocalEnforcer, or None when the VMs are only restricted through neutron
+    """
+    if mode is None or mode == 'none':
+        return None
+    if mode not in enforcer_backends:
+        raise ValueError('Unknown local enforcer ' + str(mode) + '. Use one of ' +
+                         ', '.join(sorted(enforcer_backends.keys())) + ' or none')
+    return LocalEnforcer(enforcer_backends[mode](command), limits, handoff_delay)
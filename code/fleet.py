@@ -0,0 +1,387 @@
+"""
+Tenant wide quotas across the compute nodes. Each daemon adds up the traffic of its VMs per tenant
+and pushes the totals since its last push to the aggregator, once per cycle, in a single request.
+The aggregator keeps the total of every tenant over the current period and answers each push with
+the tenants over their quota, so a tenant cannot get around its quota by spreading its traffic over
+many small VMs on many nodes. The daemons put the VMs of those tenants on the restricted policy
+until the aggregator stops reporting them.
+
+Every request carries a token shared by the aggregator and the daemons, kept in a file only root
+can read. Run the aggregator on the controller with
+    python fleet.py -f /etc/metering/fleet.yaml -b 192.168.0.10 -p 8778 -t /etc/metering/fleet.token
+and start the daemons with --fleet-url http://192.168.0.10:8778 --fleet-token-file /etc/metering/fleet.token
+"""
+import hmac
+import json
+import time
+import socket
+import optparse
+import threading
+import logging
+import yaml
+try:
+    import httplib
+    from urlparse import urlparse
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from util import get_breaker
+from cycle_table import BYTES_PER_GB, SECONDS_PER_DAY
+import metrics
+
+token_header = 'X-Metering-Token'
+
+
+class FleetAggregator:
+    """
+    Usage of every tenant over the current period, in bytes, kept up to date with the batches
+    pushed by the nodes. Every batch carries a sequence number that grows per node, so a batch
+    sent again after its answer was lost is only counted once.
+    """
+    quotas = {} #tenant -> bytes
+    default_quota = None #bytes, None for no quota
+    period = 30 * SECONDS_PER_DAY #seconds
+    window_start = 0 #unix time the period started
+    totals = {} #tenant -> bytes
+    sequences = {} #node -> last sequence applied
+    last_push = {} #node -> unix time
+    lock = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, quotas, default_quota = None, period = 30, now = None):
+        """
+        :param quotas: dict of tenant -> quota in GB
+        :param default_quota: quota in GB of the tenants not listed, None for no quota
+        :param period: days after which the totals start again from 0
+        """
+        if now is None:
+            now = time.time()
+        self.quotas = dict((tenant, int(quotas[tenant] * BYTES_PER_GB)) for tenant in quotas)
+        self.default_quota = None
+        if default_quota is not None:
+            self.default_quota = int(default_quota * BYTES_PER_GB)
+        self.period = float(period) * SECONDS_PER_DAY
+        self.window_start = now
+        self.totals = {}
+        self.sequences = {}
+        self.last_push = {}
+        self.lock = threading.Lock()
+
+
+    def __roll_window(self, now):
+        if now - self.window_start < self.period:
+            return
+        self.logger.info('New quota period, forgetting the usage of ' + str(len(self.totals)) + ' tenants')
+        self.totals = {}
+        self.window_start += (now - self.window_start) // self.period * self.period
+
+
+    def __restricted(self):
+        restricted = []
+        for tenant in self.totals:
+            quota = self.quotas.get(tenant, self.default_quota)
+            if quota is not None and self.totals[tenant] > quota:
+                restricted.append(tenant)
+        return sorted(restricted)
+
+
+    def apply(self, node, sequence, deltas, now = None):
+        """
+        :param node: name of the compute node
+        :param sequence: number of the batch, greater than the one of the previous batch of the node
+        :param deltas: dict of tenant -> bytes used since the previous batch
+        :return: list of the tenants over their quota
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.__roll_window(now)
+            self.last_push[node] = now
+            if sequence <= self.sequences.get(node, 0):
+                self.logger.debug('Batch ' + str(sequence) + ' of ' + node + ' was already applied')
+            else:
+                self.sequences[node] = sequence
+                for tenant in deltas:
+                    self.totals[tenant] = self.totals.get(tenant, 0) + int(deltas[tenant])
+            return self.__restricted()
+
+
+    def usage(self):
+        """
+        :return: dict of tenant -> dict of used_gb, quota_gb and restricted
+        """
+        with self.lock:
+            usage = {}
+            for tenant in self.totals:
+                quota = self.quotas.get(tenant, self.default_quota)
+                usage[tenant] = {'used_gb': float(self.totals[tenant]) / BYTES_PER_GB,
+                                 'quota_gb': None if quota is None else float(quota) / BYTES_PER_GB,
+                                 'restricted': quota is not None and self.totals[tenant] > quota}
+            return usage
+
+
+
+class AggregatorServer(ThreadingMixIn, HTTPServer):
+    """
+    POST /v1/usage {"node": ..., "sequence": ..., "deltas": {tenant: bytes}} -> {"restricted": [tenant, ...]}
+    GET /v1/tenants -> {tenant: {"used_gb": ..., "quota_gb": ..., "restricted": ...}}
+    Requests without the shared token in their X-Metering-Token header are refused with 401.
+    """
+    daemon_threads = True
+    aggregator = None
+    token = ''
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, aggregator, port, token, host = '127.0.0.1'):
+        """
+        :param token: shared with the daemons
+        :param host: address to listen on, the one the compute nodes reach the controller on
+        """
+        if not token:
+            raise ValueError('The aggregator needs a token shared with the daemons')
+        HTTPServer.__init__(self, (host, port), AggregatorHandler)
+        self.aggregator = aggregator
+        self.token = token
+
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, name = 'AggregatorServer')
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Aggregating tenant usage on ' + self.server_address[0] + ':' + str(self.server_address[1]))
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+
+class AggregatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def authorized(self):
+        token = self.headers.get(token_header) or ''
+        if hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            return True
+        self.server.logger.warning('Refused a request from ' + self.client_address[0] + ' without the shared token')
+        #the body is not read, so the connection cannot be reused
+        self.close_connection = True
+        self.reply(401, {'error': 'missing or wrong token'})
+        return False
+
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/v1/tenants':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, self.server.aggregator.usage())
+
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/v1/usage':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            batch = json.loads(self.rfile.read(length).decode('utf-8'))
+            restricted = self.server.aggregator.apply(str(batch['node']), int(batch['sequence']), batch['deltas'])
+        except (ValueError, KeyError, TypeError) as exception:
+            return self.reply(400, {'error': 'bad usage batch: ' + str(exception)})
+        self.reply(200, {'restricted': restricted})
+
+
+
+class FleetClient:
+    """
+    Daemon side of the aggregator. Usage is added up per tenant between pushes, and a batch
+    the aggregator did not acknowledge is sent again, with the same sequence number, before
+    the next one, so no usage is lost or counted twice while the aggregator is unreachable.
+    """
+    url = ''
+    token = ''
+    node = ''
+    timeout = 10 #seconds
+    sequence = 0
+    accumulated = {} #tenant -> bytes not in a batch yet
+    pending = None #(sequence, deltas) sent but not acknowledged
+    restricted_tenants = set()
+    last_push = 0 #unix time of the last acknowledged push
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, url, token, node = None, timeout = 10):
+        """
+        :param url: url of the aggregator, i.e. http://controller:8778
+        :param token: shared with the aggregator
+        :param node: name of this compute node. Default the hostname
+        :param timeout: seconds
+        """
+        if node is None:
+            node = socket.gethostname()
+        self.url = url.rstrip('/')
+        self.token = token
+        self.node = node
+        self.timeout = timeout
+        #a restarted daemon must not reuse the numbers of its previous run
+        self.sequence = int(time.time() * 1000)
+        self.accumulated = {}
+        self.pending = None
+        self.restricted_tenants = set()
+        self.last_push = 0
+
+
+    def add(self, tenant, rx_bytes):
+        if rx_bytes > 0:
+            self.accumulated[tenant] = self.accumulated.get(tenant, 0) + int(rx_bytes)
+
+
+    def push(self):
+        """
+        Send the usage added since the last push
+        :return: set of the tenants over their fleet wide quota
+        """
+        if self.pending is not None:
+            self.__send(*self.pending)
+            self.pending = None
+        if self.accumulated:
+            self.sequence += 1
+            self.pending = (self.sequence, self.accumulated)
+            self.accumulated = {}
+            self.__send(*self.pending)
+            self.pending = None
+        return self.restricted_tenants
+
+
+    def __send(self, sequence, deltas):
+        parsed_url = urlparse(self.url)
+        breaker = get_breaker('fleet')
+        breaker.allow()
+        metrics.api_requests.labels('fleet').inc()
+        payload = json.dumps({'node': self.node, 'sequence': sequence, 'deltas': deltas})
+        connection = httplib.HTTPConnection(parsed_url.netloc, timeout = self.timeout)
+        try:
+            connection.request('POST', parsed_url.path + '/v1/usage', payload,
+                               {'Content-Type': 'application/json', token_header: self.token})
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            breaker.record_failure()
+            raise
+        finally:
+            connection.close()
+        if response.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status >= 400:
+            raise RuntimeError('Hit error while pushing usage to ' + self.url + ' \n' + str(response.status) + ' ' +
+                               data.decode('utf-8', 'replace'))
+        restricted_tenants = set(json.loads(data.decode('utf-8'))['restricted'])
+        for tenant in restricted_tenants - self.restricted_tenants:
+            self.logger.warning('Tenant ' + tenant + ' is over its fleet wide quota')
+        for tenant in self.restricted_tenants - restricted_tenants:
+            self.logger.info('Tenant ' + tenant + ' is back under its fleet wide quota')
+        self.restricted_tenants = restricted_tenants
+        self.last_push = time.time()
+
+
+
+def read_token(fname):
+    """
+    :param fname: file holding the token shared by the aggregator and the daemons
+    :return: token
+    """
+    with open(fname) as stream:
+        token = stream.read().strip()
+    if not token:
+        raise ValueError('File: ' + fname + ' does not hold a token')
+    return token
+
+
+def load_quota_file(fname):
+    """
+    :param fname: yaml file of period (days), default (GB, optional) and tenants (tenant -> GB)
+    :return: FleetAggregator
+    """
+    with open(fname) as stream:
+        definitions = yaml.safe_load(stream) or {}
+    if 'period' not in definitions:
+        raise ValueError('File: ' + fname + ' does not define the period')
+    return FleetAggregator(definitions.get('tenants') or {}, definitions.get('default'), definitions['period'])
+
+
+def main():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-f', '--quota-file',
+        help    = 'Yaml file with the fleet wide quota of the tenants. Default /etc/metering/fleet.yaml',
+        dest    = 'quota_file',
+        metavar = 'QUOTA_FILE')
+
+    parser.add_option('-b', '--bind-address',
+        help    = 'Address to listen on, the one the compute nodes reach the controller on. Default 127.0.0.1',
+        dest    = 'bind_address',
+        metavar = 'BIND_ADDRESS')
+
+    parser.add_option('-t', '--token-file',
+        help    = 'File holding the token shared with the daemons. Default /etc/metering/fleet.token',
+        dest    = 'token_file',
+        metavar = 'TOKEN_FILE')
+
+    parser.add_option('-p', '--port',
+        help    = 'Port to listen on. Default 8778',
+        dest    = 'port',
+        metavar = 'PORT')
+
+    parser.add_option('-l', '--log-file',
+        help    = 'Optional. Name of the log file. Default fleet.log',
+        dest    = 'log_file',
+        metavar = 'LOG_FILE')
+
+    (options, args) = parser.parse_args()
+    quota_file = options.quota_file
+    bind_address = options.bind_address
+    token_file = options.token_file
+    port = options.port
+    log_file = options.log_file
+    if quota_file is None:
+        quota_file = '/etc/metering/fleet.yaml'
+    if bind_address is None:
+        bind_address = '127.0.0.1'
+    if token_file is None:
+        token_file = '/etc/metering/fleet.token'
+    if port is None:
+        port = 8778
+    if log_file is None:
+        log_file = 'fleet.log'
+    logging.basicConfig(filename=log_file, level='INFO', format='%(asctime)s %(levelname)s %(message)s')
+    server = AggregatorServer(load_quota_file(quota_file), int(port), read_token(token_file), bind_address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import os
+import logging
+
+
+class StateJournal:
+    """
+    Keeps the recovery entries of the VMs on disk as a compact snapshot plus an
+    append-only log of the entries that changed since the snapshot.
+    An entry only changes when a cycle resets, a VM is restricted, or a VM is added or
+    removed, so a steady state cycle writes nothing. Once the log holds more than
+    compact_threshold entries it is folded into a new snapshot.
+    Log lines are '+ <entry>' for an added or changed VM and '- <vm id>' for a removed one.
+    """
+    fname = ''
+    journal_fname = ''
+    header = ''
+    fsync_policy = 'cycle'
+    compact_threshold = 1000
+    entries = {}
+    journal_entries = 0
+    fsync_policies = ('always', 'cycle', 'never')
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, fname, header, fsync_policy = 'cycle', compact_threshold = 1000):
+        """
+        :param fname: snapshot file, the log is written next to it as fname.journal
+        :param header: first line of the snapshot
+        :param fsync_policy: always (after every log entry), cycle (once per write) or never
+        :param compact_threshold: Number of log entries after which a new snapshot is written
+        """
+        if fsync_policy not in self.fsync_policies:
+            raise ValueError('Unknown fsync policy ' + str(fsync_policy) + '. Use one of ' + ', '.join(self.fsync_policies))
+        try:
+            self.compact_threshold = int(compact_threshold)
+        except ValueError:
+            raise ValueError('The compact threshold ' + str(compact_threshold) + ' is not a valid integer.')
+        self.fname = fname
+        self.journal_fname = fname + '.journal'
+        self.header = header
+        self.fsync_policy = fsync_policy
+        self.entries = {}
+        self.journal_entries = 0
+
+
+    def load(self):
+        """
+        Replay the snapshot and then the log
+        :return: dict of vm id -> entry
+        """
+        self.entries = read_entries(self.fname)
+        if os.path.exists(self.journal_fname):
+            self.compact()
+        return dict(self.entries)
+
+
+    def write(self, entries):
+        """
+        Append the entries that differ from what is already on disk
+        :param entries: dict of vm id -> entry for every VM we track
+        :return:
+        """
+        changes = []
+        for vm_id in entries:
+            entry = entries[vm_id].rstrip('\n')
+            if self.entries.get(vm_id) != entry:
+                changes.append('+ ' + entry + '\n')
+                self.entries[vm_id] = entry
+        for vm_id in list(self.entries.keys()):
+            if vm_id not in entries:
+                changes.append('- ' + vm_id + '\n')
+                del self.entries[vm_id]
+        if not changes:
+            return
+        self.journal_entries += len(changes)
+        if self.journal_entries > max(self.compact_threshold, len(self.entries)):
+            self.compact()
+            return
+        with open(self.journal_fname, 'a') as f:
+            for change in changes:
+                f.write(change)
+                if self.fsync_policy == 'always':
+                    self.__sync(f)
+            if self.fsync_policy == 'cycle':
+                self.__sync(f)
+
+
+    def compact(self):
+        """
+        Write every entry to a new snapshot and start an empty log
+        """
+        self.logger.debug('Compacting ' + self.journal_fname + ' into ' + self.fname)
+        fname_temp = self.fname + '.tmp'
+        with open(fname_temp, 'w+') as f:
+            f.write(self.header + '\n')
+            for vm_id in self.entries:
+                f.write(self.entries[vm_id] + '\n')
+            if self.fsync_policy != 'never':
+                self.__sync(f)
+        os.rename(fname_temp, self.fname) #copy to a temp file to ensure file is written to completion
+        if os.path.exists(self.journal_fname):
+            os.remove(self.journal_fname)
+        self.journal_entries = 0
+
+
+    def __sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+
+def read_entries(fname):
+    """
+    Replay a snapshot and its log without loading either file into memory at once
+    :param fname: snapshot file
+    :return: dict of vm id -> entry
+    """
+    entries = {}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            f.readline() #header
+            for line in f:
+                line = line.rstrip('\n')
+                if line:
+                    entries[line.split(',')[0].strip()] = line
+    journal_fname = fname + '.journal'
+    if os.path.exists(journal_fname):
+        with open(journal_fname) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break #partial write from a crash
+                line = line.rstrip('\n')
+                if line.startswith('+ '):
+                    entries[line[2:].split(',')[0].strip()] = line[2:]
+                elif line.startswith('- '):
+                    entries.pop(line[2:].strip(), None)
+    return entries
@@ -0,0 +1,244 @@
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+import subprocess
+import threading
+import logging
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+STARTED = 'started'
+STOPPED = 'stopped'
+
+
+class LifecycleWatcher:
+    """
+    Reports domains starting and stopping as they happen, so the daemon does not have
+    to list every domain each cycle to notice them.
+    Events are (STARTED or STOPPED, domain name) and are queued until the daemon polls them.
+    wakeup is set whenever an event is queued.
+    """
+    events = None
+    wakeup = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.wakeup = threading.Event()
+
+
+    def start(self):
+        thread = threading.Thread(target = self.watch, name = self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+
+
+    def watch(self):
+        """
+        Runs in the background and calls emit for every event
+        """
+        raise NotImplementedError()
+
+
+    def emit(self, event, domain_name):
+        self.logger.debug('Domain ' + domain_name + ' ' + event)
+        self.events.put((event, domain_name))
+        self.wakeup.set()
+
+
+    def poll(self):
+        """
+        :return: list of (event, domain name) received since the last poll, oldest first
+        """
+        self.wakeup.clear()
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+
+class VirshEventWatcher(LifecycleWatcher):
+    """
+    Follows 'virsh event --loop --event lifecycle', which prints a line such as
+    event 'lifecycle' for domain instance-0000000a: Started Booted
+    for every state change. virsh is started again if it exits. If it keeps failing
+    (i.e. libvirt is too old for virsh event), the libvirt runtime directory is watched instead.
+    """
+    command = ['sudo', 'virsh', 'event', '--all', '--loop', '--event', 'lifecycle']
+    restart_delay = 5 #seconds
+    max_failures = 3
+    fallback_path = None
+    stopped_states = ('Stopped', 'Shutdown', 'Crashed')
+
+
+    def __init__(self, command = None, fallback_path = None):
+        """
+        :param command: argument list of the event stream, default sudo virsh event
+        :param fallback_path: libvirt runtime directory to watch if virsh event does not work, None to keep retrying
+        """
+        LifecycleWatcher.__init__(self)
+        if command is not None:
+            self.command = command
+        self.fallback_path = fallback_path
+
+
+    def watch(self):
+        failures = 0
+        while self.fallback_path is None or failures < self.max_failures:
+            events_received = False
+            try:
+                process = subprocess.Popen(self.command, stdout = subprocess.PIPE, universal_newlines = True)
+                for line in iter(process.stdout.readline, ''):
+                    events_received = self.parse_event(line) or events_received
+                process.wait()
+                self.logger.error('virsh event exited with code ' + str(process.returncode) + ', restarting it')
+            except OSError as exception:
+                self.logger.error('Could not run virsh event: ' + str(exception))
+            if events_received:
+                failures = 0
+            else:
+                failures += 1
+            time.sleep(self.restart_delay)
+        self.logger.warning('virsh event keeps failing, watching ' + self.fallback_path + ' instead')
+        fallback = RuntimeDirWatcher(self.fallback_path)
+        fallback.events = self.events
+        fallback.wakeup = self.wakeup
+        fallback.watch()
+
+
+    def parse_event(self, line):
+        """
+        :return: True if the line was a lifecycle event
+        """
+        if "event 'lifecycle' for domain " not in line or ':' not in line:
+            return False
+        domain_name, state = line.split("event 'lifecycle' for domain ", 1)[1].split(':', 1)
+        state = state.split()
+        if not state:
+            return False
+        if state[0] == 'Started':
+            self.emit(STARTED, domain_name.strip())
+        elif state[0] in self.stopped_states:
+            self.emit(STOPPED, domain_name.strip())
+        return True
+
+
+
+class RuntimeDirWatcher(LifecycleWatcher):
+    """
+    Watches the libvirt runtime directory, where the driver keeps a <domain name>.xml
+    status file for every running domain. The file appears when the domain starts and
+    is removed when it stops. Uses inotify, or lists the directory every poll_interval
+    seconds when inotify is not available.
+    """
+    path = '/var/run/libvirt/qemu'
+    poll_interval = 1 #seconds
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    use_inotify = True
+
+
+    def __init__(self, path = None, use_inotify = True, poll_interval = 1):
+        """
+        :param path: libvirt runtime directory. Default /var/run/libvirt/qemu
+        :param use_inotify: False to always list the directory
+        :param poll_interval: seconds between directory listings when inotify is not used
+        """
+        LifecycleWatcher.__init__(self)
+        if path is not None:
+            self.path = path
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.domains = self.__list_domains()
+
+
+    def __list_domains(self):
+        return set(entry[:-len('.xml')] for entry in os.listdir(self.path) if entry.endswith('.xml'))
+
+
+    def watch(self):
+        if self.use_inotify:
+            try:
+                self.__watch_inotify()
+            except (OSError, AttributeError) as exception:
+                self.logger.warning('inotify is not available (' + str(exception) + '), listing ' + self.path +
+                                    ' every ' + str(self.poll_interval) + ' seconds instead')
+        self.__watch_listing()
+
+
+    def __watch_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_TO | self.IN_MOVED_FROM
+        if libc.inotify_add_watch(fd, self.path.encode('utf-8'), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on ' + self.path)
+        #events that happened while inotify was being set up
+        self.__diff_listing()
+        while True:
+            self.parse_inotify(os.read(fd, 65536))
+
+
+    def parse_inotify(self, buffer):
+        """
+        :param buffer: struct inotify_event records: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+        """
+        offset = 0
+        while offset + 16 <= len(buffer):
+            wd, mask, cookie, length = struct.unpack_from('iIII', buffer, offset)
+            name = buffer[offset + 16:offset + 16 + length].rstrip(b'\0').decode('utf-8')
+            offset += 16 + length
+            if not name.endswith('.xml'):
+                continue
+            domain_name = name[:-len('.xml')]
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO) and domain_name not in self.domains:
+                self.domains.add(domain_name)
+                self.emit(STARTED, domain_name)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM) and domain_name in self.domains:
+                self.domains.discard(domain_name)
+                self.emit(STOPPED, domain_name)
+
+
+    def __watch_listing(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.__diff_listing()
+            except OSError as exception:
+                self.logger.error('Could not list ' + self.path + ': ' + str(exception))
+
+
+    def __diff_listing(self):
+        domains = self.__list_domains()
+        for domain_name in domains - self.domains:
+            self.emit(STARTED, domain_name)
+        for domain_name in self.domains - domains:
+            self.emit(STOPPED, domain_name)
+        self.domains = domains
+
+
+
+def get_lifecycle_watcher(mode):
+    """
+    :param mode: events (virsh event), inotify (libvirt runtime directory) or poll (no watcher)
+    :return: LifecycleWatcher, or None when the daemon should list the domains every cycle
+    """
+    if mode == 'events':
+        return VirshEventWatcher(fallback_path = RuntimeDirWatcher.path)
+    if mode == 'inotify':
+        return RuntimeDirWatcher()
+    if mode == 'poll':
+        return None
+    raise ValueError('Unknown lifecycle mode ' + str(mode) + '. Use one of events, inotify or poll')
@@ -1,25 +1,39 @@
 import yaml
-from util import *
+import hashlib
+from openstack import get_client
 import logging
-import os
 
 class LimitCollection:
     """
     Synch the limit definition file and update when necessary
+    Only the limits that changed are pushed to neutron, and only the VMs whose tenant
+    ends up with a different limit are updated
+    With a LimitStore instead of the file, only the changes since the version last applied are read,
+    and when they only move tenants, only the VMs of those tenants are looked at
     """
     limits = {}
     tenants = {}
     restricted_limit_name = ''
     default_limit_name = ''
+    meter_file_hash = ''
     #config_scp_location = ''
     meter_file_path = ''
+    store = None #LimitStore, None to read meter_file_path
+    store_version = 0 #version of the store applied
+    pending_vm_ids = set() #VMs whose new limit could not be set, retried on the next synch
+    vms_by_tenant = None #TenantIndex of the VMs tracked, kept up to date by the daemon
     logger = logging.getLogger(__name__)
 
 
-    def __init__(self):
+    def __init__(self, meter_file_path = '/etc/metering/meter.yaml', store = None):
         #self.config_scp_location = config_scp_location
-        self.meter_file_path = '/etc/metering/meter.yaml'
+        self.meter_file_path = meter_file_path
+        self.store = store
+        self.pending_vm_ids = set()
+        self.vms_by_tenant = TenantIndex()
         self.__update_limits()
+        if store is not None and not self.limits:
+            raise ValueError('The limit store ' + store.fname + ' is empty, import a meter file into it first')
 
 
     #def __fetch_meter_file(self):
@@ -30,56 +44,149 @@ class LimitCollection:
     #                    'Ensure that the compute node can ssh into the controller, and that the file exists')
 
 
+    def changed(self):
+        """
+        :return: True if the store has changes that were not applied, or a VM is still waiting for its new limit.
+                 The file itself is only reread by synch_limits
+        """
+        if self.pending_vm_ids:
+            return True
+        return self.store is not None and self.store.version() != self.store_version
+
+
+    def __source(self):
+        if self.store is not None:
+            return 'store ' + self.store.fname
+        return 'file ' + self.meter_file_path
+
+
     def synch_limits(self, vms):
-        self.logger.info('Resynching limits file and updating affected VMs')
-        self.__update_limits()
-        for vm_id in vms:
-            vms[vm_id].set_limit(self)
+        """
+        The VMs of the tenants whose limit changed are found with vms_by_tenant. A new restricted
+        limit moves every restricted VM to it.
+        A VM that fails to take its new limit does not stop the others. The definitions are already
+        recorded as applied, so it is kept in pending_vm_ids and tried again on the next synch
+        """
+        self.logger.info('Resynching limits ' + self.__source() + ' and updating affected VMs')
+        previous_restricted_limit_name = self.restricted_limit_name
+        previous = self.__update_limits()
+        vm_ids = set(vm_id for vm_id in self.pending_vm_ids if vm_id in vms)
+        if previous is None and not vm_ids:
+            self.logger.info('Limits ' + self.__source() + ' have not changed')
+            self.pending_vm_ids = set()
+            return
+        if previous is not None:
+            previous_limits, previous_tenants, previous_default_limit_name, changed_tenants = previous
+            if changed_tenants is None:
+                changed_tenants = self.vms_by_tenant.tenants()
+            for tenant in changed_tenants:
+                tenant_vm_ids = [vm_id for vm_id in self.vms_by_tenant.vm_ids(tenant) if vm_id in vms]
+                if not tenant_vm_ids:
+                    continue
+                previous_limit = resolve_limit(previous_limits, previous_tenants, previous_default_limit_name, tenant)
+                if previous_limit != resolve_limit(self.limits, self.tenants, self.default_limit_name, tenant):
+                    self.logger.info('Updating the limit of the ' + str(len(tenant_vm_ids)) + ' VMs of tenant ' + tenant)
+                    vm_ids.update(tenant_vm_ids)
+            if self.restricted_limit_name != previous_restricted_limit_name:
+                restricted_vm_ids = [vm_id for vm_id in vms
+                                     if vms[vm_id].policy(self.restricted_limit_name) == self.restricted_limit_name]
+                self.logger.info('The restricted limit is now ' + str(self.restricted_limit_name) + ', updating the ' +
+                                 str(len(restricted_vm_ids)) + ' restricted VMs')
+                vm_ids.update(restricted_vm_ids)
+        self.pending_vm_ids = set()
+        for vm_id in vm_ids:
+            try:
+                vms[vm_id].set_limit(self)
+            except Exception as exception:
+                self.logger.error('Could not update the limit of VM ' + vm_id + ', it is retried on the next synch: ' +
+                                  str(exception))
+                self.pending_vm_ids.add(vm_id)
+        if self.pending_vm_ids:
+            self.logger.warning(str(len(self.pending_vm_ids)) + ' VMs are still waiting for their new limit')
+
+
+    def __read_file(self):
+        """
+        :return: None if the file did not change, else (hash of the file, definitions, None)
+        """
+        #self.__fetch_meter_file()
+        with open(self.meter_file_path, 'rb') as stream:
+            meter_file = stream.read()
+        meter_file_hash = hashlib.sha1(meter_file).hexdigest()
+        if meter_file_hash == self.meter_file_hash:
+            return None
+        return meter_file_hash, parse_meter_file(meter_file, self.meter_file_path), None
+
+
+    def __read_store(self):
+        """
+        :return: None if the store did not change, else (version of the store, definitions, tenants changed
+                 or None if any tenant may have a new limit)
+        """
+        changes = self.store.changes_since(self.store_version)
+        if changes is None:
+            return None
+        limits = dict(self.limits)
+        for name in changes['meters']:
+            if changes['meters'][name] is None:
+                limits.pop(name, None)
+            else:
+                limits[name] = changes['meters'][name]
+        tenants = dict(self.tenants)
+        for tenant in changes['tenants']:
+            if changes['tenants'][tenant] is None:
+                tenants.pop(tenant, None)
+            else:
+                tenants[tenant] = changes['tenants'][tenant]
+        default_limit_name = changes['settings'].get('default', self.default_limit_name)
+        restricted_limit_name = changes['settings'].get('restricted', self.restricted_limit_name)
+        changed_tenants = None
+        if not changes['meters'] and default_limit_name == self.default_limit_name:
+            changed_tenants = set(changes['tenants'])
+        return changes['version'], (limits, tenants, default_limit_name, restricted_limit_name), changed_tenants
 
 
     def __update_limits(self):
         '''
         Load definitions of the metering rules
-        Create the rules in Neutron
+        Create or update the rules in Neutron that changed
         After calling this funciton, must update the VM limits
+        :return: None if the definitions did not change, else the previous (limits, tenants, default_limit_name)
+                 and the tenants changed, None if any tenant may have a new limit
         '''
-        #self.__fetch_meter_file()
-        self.limits = {}
-        self.tenants = {}
-
-        qos_policy_list = subprocess_cmd('neutron qos-policy-list')
-        with open(self.meter_file_path, 'r') as stream:
-            vm_defs = yaml.load(stream)
-            if 'restricted' not in vm_defs or 'default' not in vm_defs:
-                raise ValueError('File: ' + self.meter_file_path + ' does not define restricted or default value')
-            if 'meters' not in vm_defs or 'tenants' not in vm_defs:
-                raise ValueError('File: ' + self.meter_file_path + ' does not define meters or tenants lists')
-            else:
-                self.restricted_limit_name = vm_defs.get('restricted')
-                self.default_limit_name = vm_defs.get('default')
-            meters = vm_defs.get('meters')
-            for limit in meters:
-                time_period = meters.get(limit).get('time_period')
-                band_limit = meters.get(limit).get('bandwidth_limit')
-                band_per_sec = meters.get(limit).get('bandwith_per_sec')
-                if not type(time_period) is int and not type(band_limit) is int and not type(band_per_sec) is int:
-                    raise ValueError('Something seems to be misconfigured in the yaml definition file for limit: ' + limit + '.')
-                limit_type = LimitType(limit, time_period, band_limit, band_per_sec)
-                self.limits[limit] = limit_type
+        if self.store is not None:
+            loaded = self.__read_store()
+        else:
+            loaded = self.__read_file()
+        if loaded is None:
+            return None
+        loaded_version, definitions, changed_tenants = loaded
+        limits, tenants, default_limit_name, restricted_limit_name = definitions
+
+        #Only talk to neutron about the limits that are new or changed
+        changed_limits = [limits[limit] for limit in limits if self.limits.get(limit) != limits[limit]]
+        if changed_limits:
+            qos_policy_list = get_client().list_qos_policies()
+            for limit_type in changed_limits:
                 limit_type.synch_metering_rule(qos_policy_list)
-            tenants = vm_defs.get('tenants')
-            for tenant in tenants:
-                tenant_limit = tenants.get(tenant)
-                if tenant_limit not in self.limits and tenant_limit != 'restricted' and tenant_limit != 'default':
-                    raise ValueError('The tenant ' + tenant + ' has an undefined limit, ' + tenant_limit + '.')
-                self.tenants[tenant] = tenants.get(tenant)
+
+        previous = (self.limits, self.tenants, self.default_limit_name, changed_tenants)
+        self.limits = limits
+        self.tenants = tenants
+        self.restricted_limit_name = restricted_limit_name
+        self.default_limit_name = default_limit_name
+        if self.store is not None:
+            self.store_version = loaded_version
+        else:
+            self.meter_file_hash = loaded_version
+        return previous
 
 
     def get_limit_for_tenant(self, tenant_id):
-        if tenant_id in self.tenants:
-            return self.limits[self.tenants[tenant_id]]
-        else:
-            return self.limits[self.default_limit_name]
+        limit = resolve_limit(self.limits, self.tenants, self.default_limit_name, tenant_id)
+        if limit is None:
+            raise LookupError('There is no limit defined for tenant ' + tenant_id)
+        return limit
 
 
 
@@ -104,27 +211,23 @@ class LimitType:
     def synch_metering_rule(self, qos_policy_list = None):
         """
         For each definition, create a metering rule.
-        :param qos_policy_list:
+        :param qos_policy_list: QOS policies already in neutron, listed once for all the limits
         :return:
         """
+        client = get_client()
         if qos_policy_list == None:
-            qos_policy_list = subprocess_cmd('neutron qos-policy-list')
-        if qos_policy_list.find(self.name) == -1:
+            qos_policy_list = client.list_qos_policies()
+        policies = [policy for policy in qos_policy_list if policy['name'] == self.name]
+        if not policies:
             self.logger.info('Creating QOS rule: ' + self.name)
-            bash_create_policy = ('neutron qos-policy-create '+ self.name + '; '
-                                  'neutron qos-bandwidth-limit-rule-create '+ self.name +
-                                  ' --max-kbps ' +  str(self.band_per_sec) +
-                                  ' --max-burst-kbps ' + str(self.band_per_sec))
-            subprocess_cmd(bash_create_policy)
+            policy = client.create_qos_policy(self.name)
+            client.create_bandwidth_limit_rule(policy['id'], self.band_per_sec, self.band_per_sec)
         else:
-            qos_bandwidth_list = subprocess_cmd("neutron qos-bandwidth-limit-rule-list " + self.name +
-                                                " | awk '{print $2}' | tail -n +4 | head -n -1").split()
+            qos_bandwidth_list = client.list_bandwidth_limit_rules(policies[0]['id'])
             if len(qos_bandwidth_list) != 1:
                 raise Exception('There should only be one bandwith rule in the QOS policy ' + self.name)
-            bash_update_rule = (  'neutron qos-bandwidth-limit-rule-update '+ qos_bandwidth_list[0] + ' ' + self.name +
-                                  ' --max-kbps ' +  str(self.band_per_sec) +
-                                  ' --max-burst-kbps ' + str(self.band_per_sec))
-            subprocess_cmd(bash_update_rule)
+            client.update_bandwidth_limit_rule(policies[0]['id'], qos_bandwidth_list[0]['id'],
+                                               self.band_per_sec, self.band_per_sec)
 
 
     def __str__(self):
@@ -140,4 +243,103 @@ class LimitType:
             return self.name == other.name and self.time_period == other.time_period \
                 and self.band_limit == other.band_limit and self.band_per_sec == other.band_per_sec
         else:
-            return False
\ No newline at end of file
+            return False
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+
+def parse_meter_file(meter_file, fname):
+    """
+    :param meter_file: content of a limit definition file
+    :param fname: name of the file, for the errors
+    :return: (limits, tenants, default limit name, restricted limit name)
+    """
+    vm_defs = yaml.safe_load(meter_file)
+    if 'restricted' not in vm_defs or 'default' not in vm_defs:
+        raise ValueError('File: ' + fname + ' does not define restricted or default value')
+    if 'meters' not in vm_defs or 'tenants' not in vm_defs:
+        raise ValueError('File: ' + fname + ' does not define meters or tenants lists')
+    limits = {}
+    meters = vm_defs.get('meters')
+    for limit in meters:
+        time_period = meters.get(limit).get('time_period')
+        band_limit = meters.get(limit).get('bandwidth_limit')
+        band_per_sec = meters.get(limit).get('bandwith_per_sec')
+        if not type(time_period) is int and not type(band_limit) is int and not type(band_per_sec) is int:
+            raise ValueError('Something seems to be misconfigured in the yaml definition file for limit: ' + limit + '.')
+        limits[limit] = LimitType(limit, time_period, band_limit, band_per_sec)
+    tenants = {}
+    tenant_defs = vm_defs.get('tenants') or {}
+    for tenant in tenant_defs:
+        tenant_limit = tenant_defs.get(tenant)
+        if tenant_limit not in limits and tenant_limit != 'restricted' and tenant_limit != 'default':
+            raise ValueError('The tenant ' + tenant + ' has an undefined limit, ' + tenant_limit + '.')
+        tenants[tenant] = tenant_limit
+    return limits, tenants, vm_defs.get('default'), vm_defs.get('restricted')
+
+
+def resolve_limit(limits, tenants, default_limit_name, tenant_id):
+    """
+    :return: LimitType of the tenant, or the default one if the tenant is not listed. None if there is none
+    """
+    if tenant_id in tenants:
+        return limits.get(tenants[tenant_id])
+    else:
+        return limits.get(default_limit_name)
+
+
+class TenantIndex:
+    """
+    Ids of the VMs of each tenant, updated as the VMs are added and removed, so the VMs
+    of a tenant whose limit changed are found without going through every VM
+    """
+    by_tenant = {} #tenant -> set of vm ids
+    by_vm = {} #vm id -> tenant
+
+
+    def __init__(self):
+        self.by_tenant = {}
+        self.by_vm = {}
+
+
+    def __len__(self):
+        return len(self.by_vm)
+
+
+    def add(self, vm_id, tenant):
+        """
+        Also moves a VM whose tenant changed, i.e. rediscovered after its virsh id was reused
+        """
+        if self.by_vm.get(vm_id) == tenant:
+            return
+        self.remove(vm_id)
+        self.by_vm[vm_id] = tenant
+        self.by_tenant.setdefault(tenant, set()).add(vm_id)
+
+
+    def remove(self, vm_id):
+        tenant = self.by_vm.pop(vm_id, None)
+        if tenant is None:
+            return
+        self.by_tenant[tenant].discard(vm_id)
+        if not self.by_tenant[tenant]:
+            del self.by_tenant[tenant]
+
+
+    def update(self, vms):
+        """
+        :param vms: dict of vm id -> Vm
+        """
+        for vm_id in vms:
+            self.add(vm_id, vms[vm_id].tenant)
+
+
+    def tenants(self):
+        return list(self.by_tenant.keys())
+
+
+    def vm_ids(self, tenant):
+        return list(self.by_tenant.get(tenant, ()))
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+Limits and tenant mappings kept in a SQLite database instead of meter.yaml. Every change bumps the
+version of the store, and the daemons poll for the changes since the version they applied, so a
+tenant moved to another limit is picked up within seconds without rereading everything.
+
+    python limit_store.py -k /var/lib/metering/limits.db import /etc/metering/meter.yaml
+    python limit_store.py -k /var/lib/metering/limits.db set-tenant admin metering_whitelist
+    python limit_store.py -k /var/lib/metering/limits.db show
+
+and start the daemons with --limit-store /var/lib/metering/limits.db
+"""
+import sys
+import json
+import sqlite3
+import optparse
+import logging
+from limit import LimitType, parse_meter_file
+
+schema = ('CREATE TABLE IF NOT EXISTS store_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)',
+          'INSERT OR IGNORE INTO store_version VALUES (0, 0)',
+          'CREATE TABLE IF NOT EXISTS meters (name TEXT PRIMARY KEY, time_period REAL NOT NULL, '
+          'bandwidth_limit REAL NOT NULL, bandwith_per_sec INTEGER NOT NULL, version INTEGER NOT NULL, '
+          'deleted INTEGER NOT NULL DEFAULT 0)',
+          'CREATE INDEX IF NOT EXISTS meters_version ON meters (version)',
+          'CREATE TABLE IF NOT EXISTS tenants (tenant TEXT PRIMARY KEY, meter TEXT NOT NULL, version INTEGER NOT NULL, '
+          'deleted INTEGER NOT NULL DEFAULT 0)',
+          'CREATE INDEX IF NOT EXISTS tenants_version ON tenants (version)',
+          'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL)')
+
+
+class LimitStore:
+    """
+    Meters, tenant mappings and the default and restricted limit names, each row stamped with the
+    version of the change that last wrote it. Deleted rows are kept with the deleted flag so the
+    deletion is part of the changes since an older version.
+    Each write is one transaction that bumps the version once, or leaves it as it is if nothing changed.
+    """
+    fname = ''
+    connection = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, fname, timeout = 30):
+        """
+        :param fname: SQLite database, created if it does not exist
+        :param timeout: seconds to wait for another writer to finish
+        """
+        self.fname = fname
+        #transactions are begun and committed explicitly
+        self.connection = sqlite3.connect(fname, timeout = timeout, isolation_level = None, check_same_thread = False)
+        self.connection.text_factory = str
+        for statement in schema:
+            self.connection.execute(statement)
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def version(self):
+        return self.connection.execute('SELECT version FROM store_version').fetchone()[0]
+
+
+    def __write(self, changes):
+        """
+        :param changes: function(cursor, version) writing the rows of one change, returning the number of rows written
+        :return: version of the store after the change
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            version = cursor.execute('SELECT version FROM store_version').fetchone()[0]
+            if changes(cursor, version + 1):
+                cursor.execute('UPDATE store_version SET version = ?', (version + 1,))
+                version += 1
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return version
+
+
+    def __read(self, cursor, since):
+        meters = {}
+        for name, time_period, band_limit, band_per_sec, deleted in cursor.execute(
+                'SELECT name, time_period, bandwidth_limit, bandwith_per_sec, deleted FROM meters WHERE version > ?',
+                (since,)):
+            meters[name] = None if deleted else LimitType(name, time_period, band_limit, band_per_sec)
+        tenants = {}
+        for tenant, meter, deleted in cursor.execute('SELECT tenant, meter, deleted FROM tenants WHERE version > ?',
+                                                     (since,)):
+            tenants[tenant] = None if deleted else meter
+        settings = dict(cursor.execute('SELECT name, value FROM settings WHERE version > ?', (since,)).fetchall())
+        return meters, tenants, settings
+
+
+    def changes_since(self, since):
+        """
+        :param since: version already applied, 0 for everything
+        :return: None if the store is still at that version, else dict of version, meters (name -> LimitType,
+                 None if deleted), tenants (tenant -> limit name, None if deleted) and settings
+                 (default and restricted -> limit name) changed since
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN')
+        try:
+            version = cursor.execute('SELECT version FROM store_version').fetchone()[0]
+            if version == since:
+                return None
+            meters, tenants, settings = self.__read(cursor, since)
+        finally:
+            cursor.execute('COMMIT')
+        return {'version': version, 'meters': meters, 'tenants': tenants, 'settings': settings}
+
+
+    def definitions(self):
+        """
+        :return: (limits, tenants, default limit name, restricted limit name), without the deleted rows
+        """
+        changes = self.changes_since(-1)
+        limits = dict((name, changes['meters'][name]) for name in changes['meters'] if changes['meters'][name])
+        tenants = dict((tenant, changes['tenants'][tenant]) for tenant in changes['tenants'] if changes['tenants'][tenant])
+        return limits, tenants, changes['settings'].get('default'), changes['settings'].get('restricted')
+
+
+    def __meter_in_use(self, cursor, name):
+        return (cursor.execute('SELECT 1 FROM tenants WHERE meter = ? AND deleted = 0', (name,)).fetchone() or
+                cursor.execute('SELECT 1 FROM settings WHERE value = ?', (name,)).fetchone())
+
+
+    def __check_meter(self, cursor, name):
+        if name in ('default', 'restricted'):
+            return
+        if not cursor.execute('SELECT 1 FROM meters WHERE name = ? AND deleted = 0', (name,)).fetchone():
+            raise ValueError('The limit ' + name + ' is not defined.')
+
+
+    def __set_meter(self, cursor, version, limit):
+        values = (float(limit.time_period), float(limit.band_limit), int(limit.band_per_sec))
+        row = cursor.execute('SELECT time_period, bandwidth_limit, bandwith_per_sec, deleted FROM meters WHERE name = ?',
+                             (limit.name,)).fetchone()
+        if row is not None and tuple(row) == values + (0,):
+            return 0
+        cursor.execute('INSERT OR REPLACE INTO meters VALUES (?, ?, ?, ?, ?, 0)', (limit.name,) + values + (version,))
+        return 1
+
+
+    def __set_tenant(self, cursor, version, tenant, meter):
+        self.__check_meter(cursor, meter)
+        row = cursor.execute('SELECT meter, deleted FROM tenants WHERE tenant = ?', (tenant,)).fetchone()
+        if row is not None and tuple(row) == (meter, 0):
+            return 0
+        cursor.execute('INSERT OR REPLACE INTO tenants VALUES (?, ?, ?, 0)', (tenant, meter, version))
+        return 1
+
+
+    def __set_setting(self, cursor, version, name, meter):
+        self.__check_meter(cursor, meter)
+        row = cursor.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        if row is not None and row[0] == meter:
+            return 0
+        cursor.execute('INSERT OR REPLACE INTO settings VALUES (?, ?, ?)', (name, meter, version))
+        return 1
+
+
+    def __delete(self, cursor, version, table, key, value):
+        return cursor.execute('UPDATE ' + table + ' SET deleted = 1, version = ? WHERE ' + key + ' = ? AND deleted = 0',
+                              (version, value)).rowcount
+
+
+    def set_meter(self, name, time_period, band_limit, band_per_sec):
+        """
+        :param time_period: days
+        :param band_limit: GB
+        :param band_per_sec: kbps
+        :return: version of the store
+        """
+        limit = LimitType(name, time_period, band_limit, band_per_sec)
+        return self.__write(lambda cursor, version: self.__set_meter(cursor, version, limit))
+
+
+    def delete_meter(self, name):
+        def changes(cursor, version):
+            if self.__meter_in_use(cursor, name):
+                raise ValueError('The limit ' + name + ' is still used by a tenant or as the default or restricted limit.')
+            return self.__delete(cursor, version, 'meters', 'name', name)
+        return self.__write(changes)
+
+
+    def set_tenant(self, tenant, meter):
+        return self.__write(lambda cursor, version: self.__set_tenant(cursor, version, tenant, meter))
+
+
+    def delete_tenant(self, tenant):
+        """
+        The tenant falls back to the default limit
+        """
+        return self.__write(lambda cursor, version: self.__delete(cursor, version, 'tenants', 'tenant', tenant))
+
+
+    def set_default(self, meter):
+        return self.__write(lambda cursor, version: self.__set_setting(cursor, version, 'default', meter))
+
+
+    def set_restricted(self, meter):
+        return self.__write(lambda cursor, version: self.__set_setting(cursor, version, 'restricted', meter))
+
+
+    def import_meter_file(self, fname):
+        """
+        Make the store match a limit definition file, in one change. Only the rows that differ are written
+        :return: version of the store
+        """
+        with open(fname, 'rb') as stream:
+            limits, tenants, default_limit_name, restricted_limit_name = parse_meter_file(stream.read(), fname)
+        def changes(cursor, version):
+            written = 0
+            for name in limits:
+                written += self.__set_meter(cursor, version, limits[name])
+            for tenant in tenants:
+                written += self.__set_tenant(cursor, version, tenant, tenants[tenant])
+            written += self.__set_setting(cursor, version, 'default', default_limit_name)
+            written += self.__set_setting(cursor, version, 'restricted', restricted_limit_name)
+            for (tenant,) in cursor.execute('SELECT tenant FROM tenants WHERE deleted = 0').fetchall():
+                if tenant not in tenants:
+                    written += self.__delete(cursor, version, 'tenants', 'tenant', tenant)
+            for (name,) in cursor.execute('SELECT name FROM meters WHERE deleted = 0').fetchall():
+                if name not in limits:
+                    written += self.__delete(cursor, version, 'meters', 'name', name)
+            return written
+        return self.__write(changes)
+
+
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog -k LIMIT_STORE import FILE | show | version | '
+                                           'set-meter NAME DAYS GB KBPS | delete-meter NAME | '
+                                           'set-tenant TENANT NAME | delete-tenant TENANT | '
+                                           'set-default NAME | set-restricted NAME')
+
+    parser.add_option('-k', '--limit-store',
+        help    = 'SQLite database of the limits. Default /var/lib/metering/limits.db',
+        dest    = 'limit_store',
+        metavar = 'LIMIT_STORE')
+
+    (options, args) = parser.parse_args()
+    limit_store = options.limit_store
+    if limit_store is None:
+        limit_store = '/var/lib/metering/limits.db'
+    commands = {'import': (1, 'import_meter_file'), 'set-meter': (4, 'set_meter'), 'delete-meter': (1, 'delete_meter'),
+                'set-tenant': (2, 'set_tenant'), 'delete-tenant': (1, 'delete_tenant'),
+                'set-default': (1, 'set_default'), 'set-restricted': (1, 'set_restricted')}
+    if not args or (args[0] not in commands and args[0] not in ('show', 'version')):
+        parser.error('Unknown command')
+    store = LimitStore(limit_store)
+    if args[0] == 'show':
+        limits, tenants, default_limit_name, restricted_limit_name = store.definitions()
+        meters = dict((name, {'time_period': limits[name].time_period, 'bandwidth_limit': limits[name].band_limit,
+                              'bandwith_per_sec': limits[name].band_per_sec}) for name in limits)
+        output = {'version': store.version(), 'default': default_limit_name, 'restricted': restricted_limit_name,
+                  'meters': meters, 'tenants': tenants}
+        sys.stdout.write(json.dumps(output, indent = 2, sort_keys = True) + '\n')
+        return
+    if args[0] == 'version':
+        sys.stdout.write(str(store.version()) + '\n')
+        return
+    count, method = commands[args[0]]
+    if len(args) != count + 1:
+        parser.error(args[0] + ' takes ' + str(count) + ' arguments')
+    values = args[1:]
+    if args[0] == 'set-meter':
+        values = [values[0], float(values[1]), float(values[2]), int(values[3])]
+    sys.stdout.write(str(getattr(store, method)(*values)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@
 #
 # USAGE:
 #
-#  Todo
+#  metering_check.py [-s STATUS_SOCKET] [-f FILE_NAME] [-a MAX_AGE]
 
 # DESCRIPTION:
 # Report potential abuse cases to sensu, and ensures that the metering daemon is running,
@@ -23,59 +23,119 @@
 import optparse
 import sys
 import os
-import time
-from collections import Counter
+import socket
+from status_client import query_status
+from journal import read_entries
 
 STATE_OK = 0
 STATE_WARNING = 1
 STATE_CRITICAL = 2
 
+default_socket = os.path.dirname(os.path.realpath(__file__)) + '/metering.sock'
+
 def read_errors_from_status_file(f_name):
-    if not os.path.exists(f_name):
-            print ('The file ' + f_name + ' could not be opened')
+    if f_name is None or not os.path.exists(f_name):
+            print ('The file ' + str(f_name) + ' could not be opened')
+            sys.exit(STATE_CRITICAL)
+    restricted = []
+    #the daemon only rewrites the file once in a while, the entries that changed since are in its journal
+    for vm_entry in read_entries(f_name).values():
+        vm_entry_split = [field.strip() for field in vm_entry.split(',')]
+        if len(vm_entry_split) != 4 and len(vm_entry_split) != 10:
+            print ('The line ' + vm_entry + ' does not have the correct number of fields')
+            sys.exit(STATE_CRITICAL)
+        vm_id = vm_entry_split[0]
+        if not vm_id.isdigit():
+            print ('The entry ' + vm_id + ' should be a vm_id, but it is not a number.')
             sys.exit(STATE_CRITICAL)
-    with open(f_name) as f:
-        for vm_entry in f.readlines()[1:]:
-            vm_entry_split = vm_entry.split(',')
-            if len(vm_entry_split) != 4:
-                print ('The line ' + vm_entry + ' does not have the correct number of fields')
-                sys.exit(STATE_CRITICAL)
-            vm_id = vm_entry_split[0]
-            if not vm_id.isdigit():
-                print ('The entry ' + vm_id + ' should be a vm_id, but it is not a number.')
-                sys.exit(STATE_CRITICAL)
-            try:
-                date = (float(vm_entry_split[1]))
-            except ValueError:
-                print ('The entry ' + vm_entry_split[1] + ' should be a date in float format.')
-                sys.exit(STATE_CRITICAL)
-            try:
-                bandwidth = (float(vm_entry_split[2]))
-            except ValueError:
-                print ('The entry ' + vm_entry_split[2] + ' should be a bandwidth, but it is not a number.')
-                sys.exit(STATE_CRITICAL)
-            is_restricted = vm_entry_split[3]
-            if is_restricted:
-                print ('vm with virsh_id ' + vm_id + ' has been restricted. The restriction will be lifted during the vm\'s next cycle')
+        try:
+            float(vm_entry_split[1])
+        except ValueError:
+            print ('The entry ' + vm_entry_split[1] + ' should be a date in float format.')
+            sys.exit(STATE_CRITICAL)
+        try:
+            float(vm_entry_split[2])
+        except ValueError:
+            print ('The entry ' + vm_entry_split[2] + ' should be a bandwidth, but it is not a number.')
+            sys.exit(STATE_CRITICAL)
+        #written as True/False, a non empty string is always true
+        if vm_entry_split[3].lower() in ('yes', 'true', 't', '1'):
+            restricted.append(vm_id)
+    report_restricted(sorted(restricted))
 
-                sys.exit(STATE_WARNING)
+def read_errors_from_daemon(socket_name, max_age):
+    """
+    Ask the running daemon, from what it holds in memory
+    Raises socket.error if the daemon is not listening
+    """
+    health = query_status(socket_name, 'health')
+    if health['last_cycle_age'] is None:
+        if health['uptime'] > max_age:
+            print ('The metering daemon has not completed a cycle in ' + str(int(health['uptime'])) + ' seconds')
+            sys.exit(STATE_CRITICAL)
+    elif health['last_cycle_age'] > max_age:
+        print ('The last cycle of the metering daemon completed ' + str(int(health['last_cycle_age'])) + ' seconds ago')
+        sys.exit(STATE_CRITICAL)
+    vm_ids = []
+    if health['restricted']:
+        vm_ids = sorted(query_status(socket_name, 'restricted')['restricted'])
+    report_restricted(vm_ids, health.get('restricted_tenants', []))
+
+def report_restricted(vm_ids, tenants = ()):
+    if not vm_ids and not tenants:
+        return
+    for vm_id in vm_ids:
+        print ('vm with virsh_id ' + vm_id + ' has been restricted. The restriction will be lifted during the vm\'s next cycle')
+    for tenant in tenants:
+        print ('tenant ' + tenant + ' is over its quota across the compute nodes')
+    sys.exit(STATE_WARNING)
 
 def main():
     parser = optparse.OptionParser()
 
     parser.add_option('-f', '--file-name',
-        help    = 'name of file to collect metering status from',
+        help    = 'name of file to collect metering status from when the daemon does not answer',
         dest    = 'file_name',
         metavar = 'FILE_NAME')
 
+    parser.add_option('-s', '--status-socket',
+        help    = 'status socket of the metering daemon. Default metering.sock next to this script',
+        dest    = 'status_socket',
+        metavar = 'STATUS_SOCKET')
+
+    parser.add_option('-a', '--max-age',
+        help    = 'seconds since the last cycle of the daemon before it is reported as stuck. Default 300',
+        dest    = 'max_age',
+        metavar = 'MAX_AGE')
+
 
     (options, args) = parser.parse_args()
     f_name = options.file_name
-    read_errors_from_status_file(f_name)
+    socket_name = options.status_socket
+    max_age = options.max_age
+    if socket_name is None:
+        socket_name = default_socket
+    if max_age is None:
+        max_age = 300
+    try:
+        max_age = int(max_age)
+    except ValueError:
+        print ('The max age ' + max_age + ' should be a number of seconds.')
+        sys.exit(STATE_CRITICAL)
+    try:
+        read_errors_from_daemon(socket_name, max_age)
+    except (socket.error, ValueError, LookupError) as exception:
+        if f_name is None:
+            print ('The metering daemon is not answering on ' + socket_name + ': ' + str(exception))
+            sys.exit(STATE_CRITICAL)
+        #the daemon is not running, or is too old to have a status socket. The file may be stale,
+        #so the check never passes on it alone
+        print ('The metering daemon is not answering on ' + socket_name + ' (' + str(exception) + '), '
+               'reporting from ' + f_name)
+        read_errors_from_status_file(f_name)
+        sys.exit(STATE_WARNING)
     sys.exit(STATE_OK)
 
-#Todo add check that daemon is running and output file has been updated within x time
-
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,231 @@
+import threading
+import logging
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) #seconds
+
+
+class CounterValue:
+    value = 0
+
+
+    def __init__(self, metric):
+        self.lock = metric.lock
+        self.value = 0
+
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+
+class GaugeValue(CounterValue):
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+
+class HistogramValue:
+    buckets = ()
+    counts = None
+    sum = 0
+    count = 0
+
+
+    def __init__(self, metric):
+        self.lock = metric.lock
+        self.buckets = metric.buckets
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        with self.lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+    def samples(self, name, labels):
+        samples = []
+        for index, bound in enumerate(self.buckets):
+            samples.append((name + '_bucket', labels + [('le', repr(float(bound)))], self.counts[index]))
+        samples.append((name + '_bucket', labels + [('le', '+Inf')], self.count))
+        samples.append((name + '_sum', labels, self.sum))
+        samples.append((name + '_count', labels, self.count))
+        return samples
+
+
+
+class Metric:
+    """
+    A counter, gauge or histogram, with one value per combination of label values
+    """
+    value_types = {'counter': CounterValue, 'gauge': GaugeValue, 'histogram': HistogramValue}
+    name = ''
+    help = ''
+    type = ''
+    label_names = ()
+    buckets = default_buckets
+    values = None
+    lock = None
+
+
+    def __init__(self, name, help, type, label_names = (), buckets = default_buckets):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def labels(self, *label_values):
+        """
+        :return: value of the metric for the label values, i.e. subprocesses.labels('virsh').inc()
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError('The metric ' + self.name + ' takes the labels ' + ', '.join(self.label_names))
+        label_values = tuple(str(value) for value in label_values)
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = self.value_types[self.type](self)
+            return self.values[label_values]
+
+
+    def inc(self, amount = 1):
+        self.labels().inc(amount)
+
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.type]
+        with self.lock:
+            for label_values in sorted(self.values):
+                labels = list(zip(self.label_names, label_values))
+                for name, sample_labels, value in self.values[label_values].samples(self.name, labels):
+                    lines.append(name + format_labels(sample_labels) + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+
+class MetricsRegistry:
+    """
+    Every metric of the daemon, rendered in the Prometheus text format
+    """
+    metrics = None
+
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def add(self, name, help, type, label_names = (), buckets = default_buckets):
+        metric = Metric(name, help, type, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the registry on http://<host>:<port>/metrics
+    """
+    daemon_threads = True
+    registry = None
+
+
+    def __init__(self, registry, port, host = '127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = registry
+
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, name = 'MetricsServer')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving metrics on http://' + self.server_address[0] + ':' + str(self.server_address[1]) + '/metrics')
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for name, value in labels) + '}'
+
+
+registry = MetricsRegistry()
+cycle_duration = registry.add('metering_cycle_duration_seconds', 'Time spent on a measurement cycle', 'histogram')
+stage_duration = registry.add('metering_stage_duration_seconds', 'Time spent on each stage of a cycle', 'histogram',
+                              ['stage'])
+subprocesses = registry.add('metering_subprocesses_total', 'Processes started, per backend', 'counter', ['backend'])
+retries = registry.add('metering_retries_total', 'Calls tried again after a failure, per backend', 'counter', ['backend'])
+api_requests = registry.add('metering_api_requests_total', 'REST calls sent, per backend', 'counter', ['backend'])
+virsh_session_commands = registry.add('metering_virsh_session_commands_total',
+                                      'Commands sent to the long lived virsh shell', 'counter')
+cycle_overruns = registry.add('metering_cycle_overruns_total', 'Cycles that ran past their deadline', 'counter')
+skipped_cycles = registry.add('metering_skipped_cycles_total', 'Cycles skipped after an overrun', 'counter')
+vms_tracked = registry.add('metering_vms_tracked', 'VMs tracked on the host', 'gauge')
+vms_restricted = registry.add('metering_vms_restricted', 'VMs over their quota this cycle', 'gauge')
+vms_quarantined = registry.add('metering_vms_quarantined', 'VMs left alone after their work failed', 'gauge')
+qos_queue_depth = registry.add('metering_qos_queue_depth', 'QOS port updates queued or in flight', 'gauge')
+local_enforcements = registry.add('metering_local_enforcements_total',
+                                  'Rate limits put on or taken off a tap by the local enforcer, per action', 'counter',
+                                  ['action'])
+vms_enforced_locally = registry.add('metering_vms_enforced_locally', 'VMs rate limited on their tap by the daemon',
+                                    'gauge')
@@ -0,0 +1,381 @@
+import os
+import ssl
+import json
+import time
+import socket
+import calendar
+import datetime
+import threading
+import logging
+try:
+    import httplib
+    from urlparse import urlparse
+    from urllib import urlencode, quote
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse, urlencode, quote
+from util import get_breaker
+import metrics
+
+
+service_backends = {'identity': 'keystone', 'network': 'neutron', 'compute': 'nova'}
+
+
+class OpenStackClient:
+    """
+    Talks to keystone, neutron and nova over their REST APIs from inside the daemon,
+    instead of starting a new neutron/nova CLI (and a new keystone login and TLS
+    handshake) for every call.
+    Connections are kept alive and reused per endpoint, and the keystone token is
+    cached until refresh_margin seconds before it expires.
+    Both keystone v2.0 and v3 auth urls are supported.
+    keystone, neutron and nova calls go through the circuit breaker of their backend, shared
+    with the CLI commands. Connection errors, timeouts and 5xx replies count as failures.
+    """
+    auth_url = ''
+    username = ''
+    password = ''
+    project_name = ''
+    user_domain_name = 'Default'
+    project_domain_name = 'Default'
+    region_name = None
+    cacert = None
+    timeout = 30 #seconds
+    refresh_margin = 300 #seconds
+    pool_size = 4 #idle connections kept per endpoint
+    token = None
+    token_expires = 0
+    catalog = {}
+    qos_policy_ids = {}
+    pools = {}
+    lock = None
+    token_lock = None
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, auth_url, username, password, project_name, user_domain_name = 'Default',
+                 project_domain_name = 'Default', region_name = None, cacert = None, timeout = 30, pool_size = 4):
+        """
+        :param auth_url: keystone url, i.e. http://controller:5000/v3
+        :param username:
+        :param password:
+        :param project_name:
+        :param user_domain_name: only used by keystone v3
+        :param project_domain_name: only used by keystone v3
+        :param region_name: region of the endpoints to use, None for the first one listed
+        :param cacert: CA bundle for https endpoints
+        :param timeout: socket timeout in seconds
+        :param pool_size: idle connections kept per endpoint
+        """
+        self.auth_url = auth_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.project_name = project_name
+        self.user_domain_name = user_domain_name
+        self.project_domain_name = project_domain_name
+        self.region_name = region_name
+        self.cacert = cacert
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.token = None
+        self.token_expires = 0
+        self.catalog = {}
+        self.qos_policy_ids = {}
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.token_lock = threading.Lock()
+
+
+    def get_token(self):
+        with self.token_lock:
+            if self.token is None or time.time() > self.token_expires - self.refresh_margin:
+                self.__authenticate()
+            return self.token
+
+
+    def invalidate_token(self):
+        with self.token_lock:
+            self.token = None
+
+
+    def __authenticate(self):
+        self.logger.debug('Requesting a keystone token from ' + self.auth_url)
+        if self.auth_url.endswith('/v2.0'):
+            body = {'auth': {'passwordCredentials': {'username': self.username, 'password': self.password},
+                             'tenantName': self.project_name}}
+            status, headers, data = self.__call('identity', 'POST', self.auth_url + '/tokens', body)
+            if status >= 400:
+                raise RuntimeError('Keystone refused the credentials of ' + self.username + ' (' + str(status) + ')')
+            access = data['access']
+            self.token = access['token']['id']
+            self.token_expires = parse_time(access['token']['expires'])
+            self.catalog = {}
+            for service in access.get('serviceCatalog', []):
+                endpoints = [endpoint for endpoint in service['endpoints']
+                             if self.region_name is None or endpoint.get('region') == self.region_name]
+                if endpoints:
+                    self.catalog[service['type']] = endpoints[0]['publicURL'].rstrip('/')
+        else:
+            auth_url = self.auth_url
+            if not auth_url.endswith('/v3'):
+                auth_url = auth_url + '/v3'
+            body = {'auth': {'identity': {'methods': ['password'],
+                                          'password': {'user': {'name': self.username,
+                                                                'domain': {'name': self.user_domain_name},
+                                                                'password': self.password}}},
+                             'scope': {'project': {'name': self.project_name,
+                                                   'domain': {'name': self.project_domain_name}}}}}
+            status, headers, data = self.__call('identity', 'POST', auth_url + '/auth/tokens', body)
+            if status >= 400:
+                raise RuntimeError('Keystone refused the credentials of ' + self.username + ' (' + str(status) + ')')
+            self.token = headers.get('x-subject-token')
+            self.token_expires = parse_time(data['token']['expires_at'])
+            self.catalog = {}
+            for service in data['token'].get('catalog', []):
+                endpoints = [endpoint for endpoint in service['endpoints'] if endpoint.get('interface') == 'public' and
+                             (self.region_name is None or endpoint.get('region') == self.region_name)]
+                if endpoints:
+                    self.catalog[service['type']] = endpoints[0]['url'].rstrip('/')
+
+
+    def endpoint(self, service_type):
+        self.get_token()
+        if service_type not in self.catalog:
+            raise LookupError('The keystone catalog does not have a ' + service_type + ' endpoint.')
+        return self.catalog[service_type]
+
+
+    def request(self, service_type, method, path, body = None, query = None):
+        """
+        Call a service from the keystone catalog. The token is renewed once if it was rejected
+        :param service_type: network, compute...
+        :param method: GET, POST, PUT...
+        :param path: path appended to the endpoint of the service
+        :param body: dict sent as json
+        :param query: dict or list of pairs for the query string
+        :return: decoded json body
+        """
+        url = self.endpoint(service_type) + path
+        if query:
+            url = url + '?' + urlencode(query, True)
+        status, headers, data = self.__call(service_type, method, url, body, self.get_token())
+        if status == 401:
+            self.invalidate_token()
+            metrics.retries.labels(service_backends.get(service_type, service_type)).inc()
+            status, headers, data = self.__call(service_type, method, url, body, self.get_token())
+        if status == 404:
+            raise LookupError('Hit error while calling ' + service_type + ' (' + method + ' ' + path + '): not found')
+        if status >= 400:
+            raise RuntimeError('Hit error while calling ' + service_type + ' (' + method + ' ' + path + ') \n' +
+                               str(status) + ' ' + str(data))
+        return data
+
+
+    def __call(self, service_type, method, url, body = None, token = None):
+        """
+        Send the request through the circuit breaker of the service
+        Raises CircuitOpenError without sending anything if the service keeps failing
+        """
+        backend = service_backends.get(service_type, service_type)
+        breaker = get_breaker(backend)
+        breaker.allow()
+        metrics.api_requests.labels(backend).inc()
+        try:
+            status, headers, data = self.__send(method, url, body, token)
+        except (httplib.HTTPException, socket.error):
+            breaker.record_failure()
+            raise
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return status, headers, data
+
+
+    def __send(self, method, url, body = None, token = None):
+        parsed_url = urlparse(url)
+        headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if token is not None:
+            headers['X-Auth-Token'] = token
+        path = parsed_url.path
+        if parsed_url.query:
+            path = path + '?' + parsed_url.query
+        connection, reused = self.__acquire(parsed_url.scheme, parsed_url.netloc)
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            #the server closed an idle keep-alive connection, try once on a new one
+            connection, reused = self.__acquire(parsed_url.scheme, parsed_url.netloc, False)
+            try:
+                connection.request(method, path, payload, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+        else:
+            self.__release(parsed_url.scheme, parsed_url.netloc, connection)
+        response_headers = dict((key.lower(), value) for key, value in response.getheaders())
+        if data:
+            try:
+                data = json.loads(data)
+            except ValueError:
+                pass
+        return response.status, response_headers, data
+
+
+    def __acquire(self, scheme, netloc, reuse = True):
+        with self.lock:
+            idle = self.pools.setdefault((scheme, netloc), [])
+            if reuse and idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            context = ssl.create_default_context(cafile = self.cacert)
+            return httplib.HTTPSConnection(netloc, timeout = self.timeout, context = context), False
+        return httplib.HTTPConnection(netloc, timeout = self.timeout), False
+
+
+    def __release(self, scheme, netloc, connection):
+        with self.lock:
+            idle = self.pools.setdefault((scheme, netloc), [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        with self.lock:
+            pools = self.pools
+            self.pools = {}
+        for idle in pools.values():
+            for connection in idle:
+                connection.close()
+
+
+    def list_servers(self):
+        return self.request('compute', 'GET', '/servers', query = {'limit': 1})['servers']
+
+
+    def list_ports(self, filters = None, fields = None):
+        """
+        :param filters: dict of port attribute -> value, i.e. {'binding:host_id': 'compute1'}
+        :param fields: attributes to return, None for all of them
+        :return: list of port dicts
+        """
+        query = []
+        if filters:
+            query.extend(filters.items())
+        if fields:
+            query.extend(('fields', field) for field in fields)
+        return self.request('network', 'GET', '/v2.0/ports', query = query)['ports']
+
+
+    def update_port_qos(self, port_id, policy_name):
+        policy_id = self.qos_policy_id(policy_name)
+        self.request('network', 'PUT', '/v2.0/ports/' + quote(port_id), {'port': {'qos_policy_id': policy_id}})
+
+
+    def list_qos_policies(self):
+        policies = self.request('network', 'GET', '/v2.0/qos/policies')['policies']
+        with self.lock:
+            self.qos_policy_ids = dict((policy['name'], policy['id']) for policy in policies)
+        return policies
+
+
+    def qos_policy_id(self, policy_name):
+        with self.lock:
+            policy_id = self.qos_policy_ids.get(policy_name)
+        if policy_id is None:
+            self.list_qos_policies()
+            with self.lock:
+                policy_id = self.qos_policy_ids.get(policy_name)
+        if policy_id is None:
+            raise LookupError('There is no QOS policy named ' + policy_name)
+        return policy_id
+
+
+    def create_qos_policy(self, policy_name):
+        policy = self.request('network', 'POST', '/v2.0/qos/policies', {'policy': {'name': policy_name}})['policy']
+        with self.lock:
+            self.qos_policy_ids[policy_name] = policy['id']
+        return policy
+
+
+    def list_bandwidth_limit_rules(self, policy_id):
+        return self.request('network', 'GET', '/v2.0/qos/policies/' + quote(policy_id) +
+                            '/bandwidth_limit_rules')['bandwidth_limit_rules']
+
+
+    def create_bandwidth_limit_rule(self, policy_id, max_kbps, max_burst_kbps):
+        rule = {'bandwidth_limit_rule': {'max_kbps': max_kbps, 'max_burst_kbps': max_burst_kbps}}
+        return self.request('network', 'POST', '/v2.0/qos/policies/' + quote(policy_id) + '/bandwidth_limit_rules',
+                            rule)['bandwidth_limit_rule']
+
+
+    def update_bandwidth_limit_rule(self, policy_id, rule_id, max_kbps, max_burst_kbps):
+        rule = {'bandwidth_limit_rule': {'max_kbps': max_kbps, 'max_burst_kbps': max_burst_kbps}}
+        return self.request('network', 'PUT', '/v2.0/qos/policies/' + quote(policy_id) + '/bandwidth_limit_rules/' +
+                            quote(rule_id), rule)['bandwidth_limit_rule']
+
+
+
+def parse_time(timestamp):
+    """
+    :param timestamp: keystone expiry time, i.e. 2016-05-10T18:23:58.000000Z
+    :return: unix time
+    """
+    timestamp = timestamp.rstrip('Z').split('.')[0]
+    return calendar.timegm(datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S').timetuple())
+
+
+def client_from_environment():
+    """
+    Build a client from the OS_* variables of a sourced stackrc/openrc
+    """
+    environment = os.environ
+    for variable in ('OS_AUTH_URL', 'OS_USERNAME', 'OS_PASSWORD'):
+        if not environment.get(variable):
+            raise Exception('The environment variable ' + variable + ' is not set. Please source a stackrc/openrc.')
+    project_name = environment.get('OS_PROJECT_NAME', environment.get('OS_TENANT_NAME'))
+    if not project_name:
+        raise Exception('Neither OS_PROJECT_NAME nor OS_TENANT_NAME is set. Please source a stackrc/openrc.')
+    return OpenStackClient(environment['OS_AUTH_URL'], environment['OS_USERNAME'], environment['OS_PASSWORD'],
+                           project_name, environment.get('OS_USER_DOMAIN_NAME', 'Default'),
+                           environment.get('OS_PROJECT_DOMAIN_NAME', 'Default'), environment.get('OS_REGION_NAME'),
+                           environment.get('OS_CACERT'))
+
+
+client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Client shared by the whole daemon, built from the environment on first use
+    """
+    global client
+    with client_lock:
+        if client is None:
+            client = client_from_environment()
+        return client
+
+
+def set_client(openstack_client):
+    global client
+    with client_lock:
+        client = openstack_client
@@ -0,0 +1,58 @@
+import socket
+import logging
+from openstack import get_client
+
+
+class PortIndex:
+    """
+    Maps the MAC address of the VMs on this host to their neutron port id.
+    One neutron API call lists every port bound to this host, so discovering many new VMs
+    in the same cycle costs a single API call. Call invalidate once per cycle so newly
+    booted VMs trigger at most one refresh.
+    """
+    host = ''
+    ports = {}
+    stale = True
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, host = None):
+        """
+        :param host: neutron binding host of this compute node. Default is the hostname
+        """
+        if host is None:
+            host = socket.gethostname()
+        self.host = host
+        self.ports = {}
+        self.stale = True
+
+
+    def invalidate(self):
+        """
+        Allow the next lookup of an unknown MAC address to relist the ports of the host
+        """
+        self.stale = True
+
+
+    def forget(self, mac_address):
+        self.ports.pop(mac_address.lower(), None)
+
+
+    def refresh(self):
+        self.logger.debug('Listing neutron ports bound to ' + self.host)
+        port_list = get_client().list_ports({'binding:host_id': self.host}, ['id', 'mac_address'])
+        self.ports = dict((port['mac_address'].lower(), port['id']) for port in port_list)
+        self.stale = False
+
+
+    def get_port_id(self, mac_address):
+        mac_address = mac_address.lower()
+        if mac_address not in self.ports and self.stale:
+            self.refresh()
+        if mac_address not in self.ports:
+            #the port binding host does not match our hostname, ask for this port only
+            port_list = get_client().list_ports({'mac_address': mac_address}, ['id'])
+            if len(port_list) != 1:
+                raise LookupError('Could not find a single neutron port with mac address ' + mac_address)
+            self.ports[mac_address] = port_list[0]['id']
+        return self.ports[mac_address]
@@ -0,0 +1,77 @@
+import time
+import logging
+
+
+class Quarantine:
+    """
+    VMs whose work failed, i.e. a domain that disappeared mid-migration or a definition
+    that could not be parsed. A quarantined VM is left alone until its retry time, which
+    doubles with every failure in a row up to max_delay, so it does not hold up the healthy VMs.
+    """
+    base_delay = 30 #seconds
+    max_delay = 3600 #seconds
+    entries = None #vm id -> [failures in a row, retry time (unix), last error]
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, base_delay = 30, max_delay = 3600):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.entries = {}
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, vm_id):
+        return vm_id in self.entries
+
+
+    def add(self, vm_id, exception):
+        """
+        :return: unix time the VM should be tried again
+        """
+        failures = 1
+        if vm_id in self.entries:
+            failures = self.entries[vm_id][0] + 1
+        retry_time = time.time() + min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        self.entries[vm_id] = [failures, retry_time, str(exception)]
+        self.logger.error('VM ' + vm_id + ' quarantined after ' + str(failures) + ' failure(s), retrying in ' +
+                          str(int(retry_time - time.time())) + ' seconds: ' + str(exception))
+        return retry_time
+
+
+    def ready(self, vm_id):
+        """
+        :return: True if the VM is not quarantined or its retry time has come
+        """
+        return vm_id not in self.entries or time.time() >= self.entries[vm_id][1]
+
+
+    def release(self, vm_id):
+        """
+        The work of the VM succeeded
+        """
+        if vm_id in self.entries:
+            self.logger.info('VM ' + vm_id + ' released from quarantine')
+            del self.entries[vm_id]
+
+
+    def retain(self, vm_ids):
+        """
+        Forget the VMs that are gone
+        :param vm_ids: ids of the VMs still running
+        """
+        for vm_id in list(self.entries.keys()):
+            if vm_id not in vm_ids:
+                del self.entries[vm_id]
+
+
+    def status(self):
+        """
+        :return: dict of vm id -> dict of failures, retry_in (seconds) and error
+        """
+        now = time.time()
+        return dict((vm_id, {'failures': entry[0], 'retry_in': max(0, int(entry[1] - now)), 'error': entry[2]})
+                    for vm_id, entry in self.entries.items())
@@ -0,0 +1,177 @@
+import time
+import threading
+import logging
+from openstack import get_client
+from util import monotonic
+import metrics
+
+
+class QosReconciler:
+    """
+    Queue of the QOS policy each port should have, drained by background workers
+    so the measurement loop never waits on neutron.
+    Submitting a port that is already queued replaces its desired policy, so a port
+    only gets the latest state no matter how often it changed. A port is never
+    updated by two workers at once. Failed updates are retried after retry_delay
+    unless a newer policy was submitted in the meantime.
+    """
+    workers = 4
+    retry_delay = 30 #seconds
+    pending = {} #port id -> [policy, time first queued, time it can run, callback]
+    in_flight = {} #port id -> time first queued
+    cancelled = set()
+    condition = None
+    threads = []
+    stopping = False
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, workers = 4, retry_delay = 30):
+        """
+        :param workers: Number of neutron calls that can run at the same time
+        :param retry_delay: Seconds to wait before retrying a failed update
+        """
+        try:
+            self.workers = int(workers)
+        except ValueError:
+            raise ValueError('The number of QOS workers ' + str(workers) + ' is not a valid integer.')
+        if self.workers < 1:
+            raise ValueError('There must be at least one QOS worker.')
+        self.retry_delay = retry_delay
+        self.pending = {}
+        self.in_flight = {}
+        self.cancelled = set()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopping = False
+
+
+    def start(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target = self.__work, name = 'qos-worker-' + str(i))
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+
+
+    def stop(self, timeout = None):
+        """
+        Stop the workers once the updates they are making are done. The updates still queued are dropped
+        :param timeout: seconds to wait for each worker
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for worker in self.threads:
+            worker.join(timeout)
+        self.threads = []
+
+
+    def submit(self, port_id, policy, callback = None):
+        """
+        Record the policy a port should have
+        :param port_id:
+        :param policy: QOS policy name
+        :param callback: Called with the policy once neutron accepted the update
+        """
+        with self.condition:
+            if port_id in self.pending:
+                queued = self.pending[port_id][1]
+            else:
+                queued = time.time()
+            self.pending[port_id] = [policy, queued, 0, callback]
+            self.condition.notify()
+
+
+    def cancel(self, port_id):
+        """
+        Forget about a port, i.e. its VM was deleted
+        """
+        with self.condition:
+            self.pending.pop(port_id, None)
+            if port_id in self.in_flight:
+                self.cancelled.add(port_id)
+
+
+    def depth(self):
+        """
+        :return: Number of ports waiting for an update, including the ones being updated
+        """
+        with self.condition:
+            return len(set(self.pending) | set(self.in_flight))
+
+
+    def oldest_age(self):
+        """
+        :return: Seconds the oldest waiting update has been queued, 0 if the queue is empty
+        """
+        with self.condition:
+            queued = [entry[1] for entry in self.pending.values()] + list(self.in_flight.values())
+            if not queued:
+                return 0
+            return time.time() - min(queued)
+
+
+    def join(self, timeout = None):
+        """
+        Wait until every queued update went through
+        :param timeout: seconds
+        :return: True if the queue is empty
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            while self.pending or self.in_flight:
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self.condition.wait(1)
+            return True
+
+
+    def __next_port(self):
+        """
+        Wait for a port that is due and not already being updated
+        Must be called while holding the condition
+        :return: port id, None once the reconciler is stopping
+        """
+        while True:
+            if self.stopping:
+                return None
+            now = time.time()
+            wait = None
+            for port_id in self.pending:
+                if port_id in self.in_flight:
+                    continue
+                not_before = self.pending[port_id][2]
+                if not_before <= now:
+                    return port_id
+                if wait is None or not_before - now < wait:
+                    wait = not_before - now
+            self.condition.wait(wait)
+
+
+    def __work(self):
+        while True:
+            with self.condition:
+                port_id = self.__next_port()
+                if port_id is None:
+                    return
+                policy, queued, not_before, callback = self.pending.pop(port_id)
+                self.in_flight[port_id] = queued
+            start = monotonic()
+            try:
+                get_client().update_port_qos(port_id, policy)
+                if callback is not None:
+                    callback(policy)
+            except Exception as exception:
+                self.logger.error('Could not set QOS policy ' + policy + ' on port ' + port_id + ': ' + str(exception))
+                with self.condition:
+                    if port_id not in self.pending and port_id not in self.cancelled:
+                        self.pending[port_id] = [policy, queued, time.time() + self.retry_delay, callback]
+            finally:
+                metrics.stage_duration.labels('qos_update').observe(monotonic() - start)
+                with self.condition:
+                    self.in_flight.pop(port_id, None)
+                    self.cancelled.discard(port_id)
+                    self.condition.notify_all()
@@ -0,0 +1,218 @@
+"""
+Replays the counters kept in a UsageArchive through candidate limit definition files, to see how many
+VMs a change of bandwidth_limit or time_period would restrict before it is deployed.
+
+    python replay.py -d /var/lib/metering/archive -s 2016-05-01 -e 2016-06-01 meter.yaml candidate.yaml
+
+The samples go through CycleTable.evaluate, as in the daemon, with one row per VM and file, so each
+recorded cycle is evaluated for every VM and every file in one pass. The cycle of a VM starts at its
+first sample in the window. Samples are replayed when they were taken, so a file with lower limits
+than the one deployed may restrict a VM later than a daemon running it would have.
+
+Prints for each file the VMs and tenants restricted, the delay between a VM going over its quota
+(interpolated between its two samples) and its restriction, and the QOS policy updates caused by the
+restrictions and their lifting.
+"""
+import sys
+import json
+import time
+import optparse
+import numpy
+from archive import UsageArchive
+from cycle_table import CycleTable, SECONDS_PER_DAY
+from limit import parse_meter_file, resolve_limit
+from usage_query import parse_time
+
+
+class PolicyReplay:
+    """
+    Cycle state of every VM under every limit definition file, in one CycleTable
+    """
+    names = [] #name of each file
+    vm_limits = [] #file -> list of LimitType of each VM, None for the VMs without a limit
+    vm_tenants = [] #VM index -> tenant
+    table = None
+    rows = None #(file, VM index) -> row of the table, -1 before the first sample of the VM, -2 without a limit
+    restrictions = None #file -> number of times a VM was restricted
+    lifted = None #file -> number of restrictions lifted by a new cycle
+    restricted_vms = None #(file, VM index) -> restricted at least once
+    detection_files = [] #file of each restriction, one array per cycle with restrictions
+    detection_delays = [] #seconds from crossing the quota to the restriction, matching detection_files
+    first_time = None
+    last_time = None
+
+
+    def __init__(self, policies, vm_tenants):
+        """
+        :param policies: list of (name, limits, tenants, default limit name)
+        :param vm_tenants: tenant of each VM index of the samples
+        """
+        self.names = [policy[0] for policy in policies]
+        self.vm_limits = [[resolve_limit(limits, tenants, default_limit_name, tenant) for tenant in vm_tenants]
+                          for name, limits, tenants, default_limit_name in policies]
+        self.vm_tenants = list(vm_tenants)
+        self.table = CycleTable(max(1, len(policies) * len(vm_tenants)))
+        self.rows = numpy.full((len(policies), len(vm_tenants)), -1, numpy.intp)
+        self.restrictions = numpy.zeros(len(policies), numpy.int64)
+        self.lifted = numpy.zeros(len(policies), numpy.int64)
+        self.restricted_vms = numpy.zeros((len(policies), len(vm_tenants)), numpy.bool_)
+        self.detection_files = []
+        self.detection_delays = []
+        self.first_time = None
+        self.last_time = None
+
+
+    def __add(self, policy_indexes, vm_indexes, now, rx_bytes):
+        for policy_index, vm_index, start_bytes in zip(policy_indexes, vm_indexes, rx_bytes):
+            limit = self.vm_limits[policy_index][vm_index]
+            if limit is None:
+                self.rows[policy_index, vm_index] = -2
+                continue
+            cycle = self.table.add(now, start_bytes)
+            self.table.set_limit(cycle.row, limit)
+            self.rows[policy_index, vm_index] = cycle.row
+
+
+    def replay(self, times, vm_indexes, rx_bytes):
+        """
+        :param times: unix time of each sample
+        :param vm_indexes: VM index of each sample
+        :param rx_bytes: rx counter of each sample
+        """
+        order = numpy.argsort(times, kind = 'mergesort')
+        times = numpy.asarray(times, numpy.float64)[order]
+        vm_indexes = numpy.asarray(vm_indexes, numpy.intp)[order]
+        rx_bytes = numpy.asarray(rx_bytes, numpy.int64)[order]
+        if not len(times):
+            return
+        if self.first_time is None:
+            self.first_time = float(times[0])
+        self.last_time = float(times[-1])
+        bounds = numpy.concatenate(([0], numpy.flatnonzero(times[1:] != times[:-1]) + 1, [len(times)]))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            self.__evaluate(float(times[first]), vm_indexes[first:last], rx_bytes[first:last])
+
+
+    def __evaluate(self, now, vm_indexes, rx_bytes):
+        table = self.table
+        rows = self.rows[:, vm_indexes]
+        new_policies, new_columns = numpy.nonzero(rows == -1)
+        if len(new_policies):
+            self.__add(new_policies, vm_indexes[new_columns], now, rx_bytes[new_columns])
+        policies, columns = numpy.nonzero(rows >= 0)
+        if not len(policies):
+            return
+        rows = rows[policies, columns]
+        counters = rx_bytes[columns]
+        #the sample before this one, or the start of the cycle for the first one
+        previous_dates = numpy.where(table.last_date[rows] > 0, table.last_date[rows], table.start_date[rows])
+        previous_bytes = numpy.where(table.last_date[rows] > 0, table.last_bytes[rows], table.start_bytes[rows])
+        previous_used = previous_bytes - table.start_bytes[rows]
+        lifted, abused = table.evaluate(rows, numpy.full(len(rows), now), counters)
+        numpy.add.at(self.lifted, policies[lifted], 1)
+        if not abused.any():
+            return
+        numpy.add.at(self.restrictions, policies[abused], 1)
+        self.restricted_vms[policies[abused], vm_indexes[columns[abused]]] = True
+        abused_rows = rows[abused]
+        quota = table.limit_bytes[table.limit_index[abused_rows]]
+        used = counters[abused] - table.start_bytes[abused_rows]
+        previous_used = previous_used[abused]
+        crossed = numpy.clip((quota - previous_used).astype(numpy.float64) / numpy.maximum(used - previous_used, 1),
+                             0, 1)
+        self.detection_files.append(policies[abused])
+        self.detection_delays.append((1 - crossed) * (now - previous_dates[abused]))
+
+
+    def results(self):
+        """
+        :return: list of dict of the outcome of each file
+        """
+        days = 0
+        if self.first_time is not None:
+            days = (self.last_time - self.first_time) / SECONDS_PER_DAY
+        files = numpy.concatenate(self.detection_files) if self.detection_files else numpy.zeros(0, numpy.intp)
+        delays = numpy.concatenate(self.detection_delays) if self.detection_delays else numpy.zeros(0)
+        results = []
+        for policy_index, name in enumerate(self.names):
+            tracked = self.rows[policy_index] >= 0
+            restricted_vm_indexes = numpy.flatnonzero(self.restricted_vms[policy_index])
+            qos_updates = int(self.restrictions[policy_index] + self.lifted[policy_index])
+            result = {'meter_file': name,
+                      'vms': int(tracked.sum()),
+                      'restrictions': int(self.restrictions[policy_index]),
+                      'restricted_vms': len(restricted_vm_indexes),
+                      'restricted_tenants': sorted(set(self.vm_tenants[index] for index in restricted_vm_indexes)),
+                      'restricted_at_end': int(self.table.restricted[self.rows[policy_index][tracked]].sum()),
+                      'lifted': int(self.lifted[policy_index]),
+                      'qos_updates': qos_updates,
+                      'qos_updates_per_day': qos_updates / days if days > 0 else None,
+                      'detection_seconds': None}
+            policy_delays = delays[files == policy_index]
+            if len(policy_delays):
+                result['detection_seconds'] = {'mean': float(policy_delays.mean()),
+                                               'p95': float(numpy.percentile(policy_delays, 95)),
+                                               'max': float(policy_delays.max())}
+            results.append(result)
+        return results
+
+
+
+def load_policy(fname):
+    """
+    :return: (fname, limits, tenants, default limit name) of a limit definition file
+    """
+    with open(fname, 'rb') as stream:
+        limits, tenants, default_limit_name, restricted_limit_name = parse_meter_file(stream.read(), fname)
+    return fname, limits, tenants, default_limit_name
+
+
+def replay_archive(archive, meter_fnames, start, end):
+    """
+    :param archive: UsageArchive
+    :param meter_fnames: limit definition files to compare
+    :return: list of dict of the outcome of each file
+    """
+    replay = PolicyReplay([load_policy(fname) for fname in meter_fnames], archive.vm_tenants)
+    samples = archive.window(start, end)
+    replay.replay(samples['time'], samples['vm'], samples['rx'])
+    return replay.results()
+
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog -d ARCHIVE_DIR [options] meter.yaml [candidate.yaml ...]')
+
+    parser.add_option('-d', '--archive-dir',
+        help    = 'Directory of the usage archive of the daemon',
+        dest    = 'archive_dir',
+        metavar = 'ARCHIVE_DIR')
+
+    parser.add_option('-s', '--start',
+        help    = 'Start of the replay, unix time or UTC date. Default 30 days ago',
+        dest    = 'start',
+        metavar = 'START')
+
+    parser.add_option('-e', '--end',
+        help    = 'End of the replay, unix time or UTC date. Default now',
+        dest    = 'end',
+        metavar = 'END')
+
+    (options, args) = parser.parse_args()
+    if options.archive_dir is None:
+        parser.error('The archive directory is required')
+    meter_fnames = args
+    if not meter_fnames:
+        meter_fnames = ['/etc/metering/meter.yaml']
+    end = time.time()
+    if options.end is not None:
+        end = parse_time(options.end)
+    start = end - 30 * SECONDS_PER_DAY
+    if options.start is not None:
+        start = parse_time(options.start)
+    archive = UsageArchive(options.archive_dir, retention_days = 0)
+    results = replay_archive(archive, meter_fnames, start, end)
+    sys.stdout.write(json.dumps({'start': start, 'end': end, 'results': results}, indent = 2, sort_keys = True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
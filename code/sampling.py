@@ -0,0 +1,63 @@
+import heapq
+import logging
+
+
+class SampleQueue:
+    """
+    VMs ordered by the time their counters next need to be read. A VM far from its quota
+    is not sampled again until it could have crossed it, so most VMs are skipped most cycles.
+    max_interval bounds the time between two samples of the same VM.
+    Entries are never removed from the heap, an entry whose time no longer matches due is stale and skipped.
+    """
+    max_interval = 3600 #seconds
+    heap = None
+    due = None #vm id -> time the next sample is due
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, max_interval = 3600):
+        """
+        :param max_interval: most seconds between two samples of a VM
+        """
+        self.max_interval = max_interval
+        self.heap = []
+        self.due = {}
+
+
+    def __len__(self):
+        return len(self.due)
+
+
+    def __contains__(self, vm_id):
+        return vm_id in self.due
+
+
+    def schedule(self, vm_id, due_time, now):
+        """
+        :param due_time: unix time the VM should be sampled again, at the latest now + max_interval
+        :param now: unix time of the sample that was just taken
+        """
+        due_time = min(due_time, now + self.max_interval)
+        self.due[vm_id] = due_time
+        heapq.heappush(self.heap, (due_time, vm_id))
+
+
+    def remove(self, vm_id):
+        self.due.pop(vm_id, None)
+
+
+    def pop_due(self, now):
+        """
+        :return: list of vm ids due at now, they are no longer scheduled
+        """
+        vm_ids = []
+        while self.heap and self.heap[0][0] <= now:
+            due_time, vm_id = heapq.heappop(self.heap)
+            if self.due.get(vm_id) == due_time:
+                del self.due[vm_id]
+                vm_ids.append(vm_id)
+        #stale entries pile up when VMs are rescheduled often, rebuild once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.due) + 64:
+            self.heap = [(self.due[vm_id], vm_id) for vm_id in self.due]
+            heapq.heapify(self.heap)
+        return vm_ids
@@ -0,0 +1,108 @@
+import logging
+from util import monotonic
+import metrics
+
+
+class CycleScheduler:
+    """
+    Keeps the measurement cycles on a fixed cadence. Cycle n is due at start + n * interval
+    on the monotonic clock, so the time spent working does not push the following cycles
+    later, and neither do changes to the wall clock.
+    A cycle that is still running when the next one is due is an overrun. The cycles it ran
+    into are skipped rather than run back to back, and the next cycle waits for the following slot.
+    An interval of 0 or less runs the cycles back to back, without a deadline.
+    """
+    interval = -1 #seconds
+    clock = None
+    next_deadline = 0
+    overruns = 0
+    skipped_cycles = 0
+    last_lateness = 0 #seconds
+    max_lateness = 0 #seconds
+    total_lateness = 0 #seconds
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, interval, clock = monotonic):
+        """
+        :param interval: seconds between the start of two cycles, 0 or less to run them back to back
+        :param clock: function returning the time in seconds, monotonic by default
+        """
+        self.interval = interval
+        self.clock = clock
+        self.next_deadline = self.clock() #the first cycle is due straight away
+
+
+    def begin_cycle(self):
+        """
+        Called when a cycle starts. Its work should be done by the returned deadline,
+        when the next cycle is due.
+        :return: deadline on the scheduler clock, None when the cycles run back to back
+        """
+        if self.interval <= 0:
+            self.next_deadline = self.clock()
+            return None
+        self.next_deadline += self.interval
+        return self.next_deadline
+
+
+    def remaining(self):
+        """
+        :return: seconds until the next cycle is due, 0 if it is already due
+        """
+        return max(0, self.next_deadline - self.clock())
+
+
+    def late(self):
+        """
+        :return: True if the cycle that is running has used up its slot
+        """
+        return self.clock() >= self.next_deadline
+
+
+    def complete_cycle(self):
+        """
+        Called when the work of a cycle is done. If the cycle ran past its deadline, the
+        overrun is recorded and the next cycle is moved to the first slot that has not started yet.
+        :return: number of cycles skipped
+        """
+        now = self.clock()
+        lateness = now - self.next_deadline
+        if lateness < 0 or self.interval <= 0:
+            self.last_lateness = 0
+            return 0
+        skipped = int(lateness // self.interval) + 1
+        self.overruns += 1
+        self.skipped_cycles += skipped
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+        metrics.cycle_overruns.inc()
+        metrics.skipped_cycles.inc(skipped)
+        self.next_deadline += skipped * self.interval
+        self.logger.warning('Cycle overran its deadline by ' + str(round(lateness, 3)) + ' seconds, skipping ' +
+                            str(skipped) + ' cycle(s). ' + str(self.overruns) + ' overruns so far')
+        return skipped
+
+
+    def stats(self):
+        """
+        :return: dict of the overrun counters, used to size the hosts
+        """
+        return {'interval': self.interval, 'overruns': self.overruns, 'skipped_cycles': self.skipped_cycles,
+                'last_lateness': self.last_lateness, 'max_lateness': self.max_lateness,
+                'total_lateness': self.total_lateness}
+
+
+
+def advance_deadline(deadline, interval, now):
+    """
+    Move a deadline that has passed along its cadence
+    :param interval: seconds between two deadlines, 0 or less for a deadline that is always due
+    :return: first deadline after now, or now when interval is 0 or less
+    """
+    if interval <= 0:
+        return now
+    while deadline <= now:
+        deadline += interval
+    return deadline
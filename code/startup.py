@@ -28,6 +28,111 @@ def read_command_line():
         dest    = 'limit_synch_time',
         metavar = 'LIMIT_SYNCH_TIME')
 
+    parser.add_option('-b', '--counter-backend',
+        help    = 'Optional. Where to read VM bandwidth counters from: virsh, sysfs or procfs. Default virsh',
+        dest    = 'counter_backend',
+        metavar = 'COUNTER_BACKEND')
+
+    parser.add_option('-f', '--fsync-policy',
+        help    = 'Optional. When to fsync the recovery journal: always, cycle or never. Default cycle',
+        dest    = 'fsync_policy',
+        metavar = 'FSYNC_POLICY')
+
+    parser.add_option('-j', '--compact-threshold',
+        help    = 'Optional. Number of recovery journal entries before the recovery file is rewritten. Default 1000',
+        dest    = 'compact_threshold',
+        metavar = 'COMPACT_THRESHOLD')
+
+    parser.add_option('-q', '--qos-workers',
+        help    = 'Optional. Number of neutron QOS port updates that can run at the same time. Default 4',
+        dest    = 'qos_workers',
+        metavar = 'QOS_WORKERS')
+
+    parser.add_option('-e', '--lifecycle',
+        help    = 'Optional. How VMs starting and stopping are noticed: events (virsh event), inotify (libvirt '
+                  'runtime directory) or poll (list every domain each cycle). events needs sudo rights to run '
+                  'virsh event, and falls back to inotify where libvirt is too old for it. Default poll',
+        dest    = 'lifecycle',
+        metavar = 'LIFECYCLE')
+
+    parser.add_option('-p', '--full-poll-cycles',
+        help    = 'Optional. With events or inotify, list every domain once per this many cycles. Default 20',
+        dest    = 'full_poll_cycles',
+        metavar = 'FULL_POLL_CYCLES')
+
+    parser.add_option('-v', '--virsh-session',
+        help    = 'Optional. Send the virsh commands to one long lived virsh shell, True/False. Default True',
+        dest    = 'virsh_session',
+        metavar = 'VIRSH_SESSION')
+
+    parser.add_option('-n', '--engine',
+        help    = 'Optional. Main loop to run: sync, or async (asyncio, python 3 only). Default sync',
+        dest    = 'engine',
+        metavar = 'ENGINE')
+
+    parser.add_option('-m', '--max-sample-interval',
+        help    = 'Optional. Most seconds between two bandwidth samples of a VM far from its quota. Default 3600',
+        dest    = 'max_sample_interval',
+        metavar = 'MAX_SAMPLE_INTERVAL')
+
+    parser.add_option('-w', '--line-rate',
+        help    = 'Optional. Speed in Gbps of the link of the host. A VM is sampled again once it could have reached '
+                  'its quota receiving at this speed. Default 10',
+        dest    = 'line_rate',
+        metavar = 'LINE_RATE')
+
+    parser.add_option('-t', '--metrics-port',
+        help    = 'Optional. Serve Prometheus metrics on http://127.0.0.1:<port>/metrics, 0 to turn them off. Default 0',
+        dest    = 'metrics_port',
+        metavar = 'METRICS_PORT')
+
+    parser.add_option('-u', '--status-socket',
+        help    = 'Optional. Unix socket answering status queries, none to turn it off. Default metering.sock next to the daemon',
+        dest    = 'status_socket',
+        metavar = 'STATUS_SOCKET')
+
+    parser.add_option('-g', '--fleet-url',
+        help    = 'Optional. url of the aggregator of the tenant usage across the compute nodes, i.e. http://controller:8778',
+        dest    = 'fleet_url',
+        metavar = 'FLEET_URL')
+
+    parser.add_option('-z', '--fleet-token-file',
+        help    = 'Optional. File holding the token shared with the aggregator. Default /etc/metering/fleet.token',
+        dest    = 'fleet_token_file',
+        metavar = 'FLEET_TOKEN_FILE')
+
+    parser.add_option('-a', '--archive-dir',
+        help    = 'Optional. Directory to keep the history of the VM counters in, for usage_query.py',
+        dest    = 'archive_dir',
+        metavar = 'ARCHIVE_DIR')
+
+    parser.add_option('-r', '--archive-retention',
+        help    = 'Optional. Days the history of the VM counters is kept, 0 to keep it all. Default 90',
+        dest    = 'archive_retention',
+        metavar = 'ARCHIVE_RETENTION')
+
+    parser.add_option('-k', '--limit-store',
+        help    = 'Optional. SQLite database of the limits, filled with limit_store.py, to use instead of the limit yaml file',
+        dest    = 'limit_store',
+        metavar = 'LIMIT_STORE')
+
+    parser.add_option('-o', '--limit-poll-time',
+        help    = 'Optional. Time in seconds between two checks of the limit store for changes. Default 5',
+        dest    = 'limit_poll_time',
+        metavar = 'LIMIT_POLL_TIME')
+
+    parser.add_option('-x', '--local-enforcer',
+        help    = 'Optional. Give a VM over its quota the restricted policy and rate limit its tap right away, with '
+                  'tc or ovs, until neutron has applied it. none to leave the VM on its limit. Default none',
+        dest    = 'local_enforcer',
+        metavar = 'LOCAL_ENFORCER')
+
+    parser.add_option('-y', '--handoff-delay',
+        help    = 'Optional. Time in seconds the local rate limit is kept once neutron confirmed the restricted policy. '
+                  'Default 30',
+        dest    = 'handoff_delay',
+        metavar = 'HANDOFF_DELAY')
+
 
 
     (options, args) = parser.parse_args()
@@ -35,6 +140,26 @@ def read_command_line():
     log_file = options.log_file
     cycle_time = options.cycle_time
     limit_synch_time = options.limit_synch_time
+    counter_backend = options.counter_backend
+    fsync_policy = options.fsync_policy
+    compact_threshold = options.compact_threshold
+    qos_workers = options.qos_workers
+    lifecycle = options.lifecycle
+    full_poll_cycles = options.full_poll_cycles
+    max_sample_interval = options.max_sample_interval
+    line_rate = options.line_rate
+    virsh_session = options.virsh_session
+    engine = options.engine
+    metrics_port = options.metrics_port
+    status_socket = options.status_socket
+    fleet_url = options.fleet_url
+    fleet_token_file = options.fleet_token_file
+    archive_dir = options.archive_dir
+    archive_retention = options.archive_retention
+    limit_store = options.limit_store
+    limit_poll_time = options.limit_poll_time
+    local_enforcer = options.local_enforcer
+    handoff_delay = options.handoff_delay
     if str2bool(log_level):
         log_level = "DEBUG"
     else:
@@ -54,15 +179,65 @@ def read_command_line():
             limit_synch_time = 24
     except ValueError:
         raise Exception("Cycle time or limit synch time should be an interger")
+    if counter_backend is None:
+        counter_backend = 'virsh'
+    if fsync_policy is None:
+        fsync_policy = 'cycle'
+    if compact_threshold is None:
+        compact_threshold = 1000
+    if qos_workers is None:
+        qos_workers = 4
+    if lifecycle is None:
+        lifecycle = 'poll'
+    if full_poll_cycles is None:
+        full_poll_cycles = 20
+    if max_sample_interval is None:
+        max_sample_interval = 3600
+    if line_rate is None:
+        line_rate = 10
+    if metrics_port is None:
+        metrics_port = 0
+    if status_socket is None:
+        status_socket = os.path.dirname(os.path.realpath(__file__)) + '/metering.sock'
+    elif status_socket.lower() == 'none':
+        status_socket = None
+    if fleet_token_file is None:
+        fleet_token_file = '/etc/metering/fleet.token'
+    if archive_retention is None:
+        archive_retention = 90
+    if limit_poll_time is None:
+        limit_poll_time = 5
+    if local_enforcer is None:
+        local_enforcer = 'none'
+    if handoff_delay is None:
+        handoff_delay = 30
+    if engine is None:
+        engine = 'sync'
+    if engine not in ('sync', 'async'):
+        raise Exception('Unknown engine ' + engine + '. Use sync or async')
+    if virsh_session is None:
+        virsh_session = True
+    else:
+        virsh_session = str2bool(virsh_session)
 
-    return Daemon(cycle_time, limit_synch_time)
+    daemon = Daemon(cycle_time, limit_synch_time, counter_backend, fsync_policy, compact_threshold,
+                    qos_workers, lifecycle, full_poll_cycles, max_sample_interval, virsh_session,
+                    metrics_port, status_socket, fleet_url = fleet_url, fleet_token_file = fleet_token_file,
+                    archive_dir = archive_dir, archive_retention = archive_retention, limit_store = limit_store,
+                    limit_poll_time = limit_poll_time, local_enforcer = local_enforcer,
+                    handoff_delay = handoff_delay, line_rate = float(line_rate))
+    return daemon, engine
 
 
 
 def main():
     try:
-        daemon = read_command_line()
-        daemon.start()
+        daemon, engine = read_command_line()
+        if engine == 'async':
+            from async_engine import AsyncEngine
+            AsyncEngine(daemon).start()
+        else:
+            daemon.start()
     except Exception as exception:
         logger.error(exception)
         raise exception
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import threading
+import logging
+import numpy
+from cycle_table import BYTES_PER_GB
+from status_client import query_status
+try:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+queries = ('health', 'restricted', 'usage', 'status')
+
+
+class StatusBoard:
+    """
+    What the daemon knew at the end of its last cycle, for the status socket.
+    A new snapshot is built at each checkpoint and swapped in whole, so the queries,
+    answered from other threads, never see a cycle half way through.
+    """
+    interval = -1 #seconds between cycles
+    snapshot = None #dict of time, vms (vm id -> usage) and status
+    started = 0
+
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.time()
+        self.snapshot = {'time': 0, 'vms': {}, 'status': {}}
+
+
+    def update(self, vms, table, status):
+        """
+        :param vms: dict of vm id -> Vm
+        :param table: CycleTable holding the cycles of the VMs
+        :param status: Daemon.status()
+        """
+        vm_ids = list(vms.keys())
+        rows = numpy.array([vms[vm_id].cycle.row for vm_id in vm_ids], numpy.intp)
+        sampled = table.last_date[rows] > 0
+        used = numpy.where(sampled, table.last_bytes[rows] - table.start_bytes[rows], 0) / float(BYTES_PER_GB)
+        limit = table.limit_bytes[table.limit_index[rows]] / float(BYTES_PER_GB)
+        entries = {}
+        for index, vm_id in enumerate(vm_ids):
+            vm = vms[vm_id]
+            entries[vm_id] = {'nova_id': vm.nova_id, 'tenant': vm.tenant, 'limit': vm.band_limit.name,
+                              'used_gb': float(used[index]), 'limit_gb': float(limit[index]),
+                              'restricted': bool(table.restricted[rows[index]]),
+                              'cycle_start': float(table.start_date[rows[index]]),
+                              'last_sample': float(table.last_date[rows[index]])}
+        self.snapshot = {'time': time.time(), 'vms': entries, 'status': status}
+
+
+    def answer(self, args):
+        """
+        :param args: query and its arguments, i.e. ['usage', '5', '7']
+        :return: dict sent back as json
+        """
+        if not args or args[0] not in queries:
+            raise ValueError('Unknown query ' + ' '.join(args) + '. Use one of ' + ', '.join(queries))
+        snapshot = self.snapshot
+        if args[0] == 'health':
+            last_cycle = snapshot['time']
+            age = None
+            if last_cycle:
+                age = time.time() - last_cycle
+            return {'alive': True, 'pid': os.getpid(), 'uptime': time.time() - self.started,
+                    'interval': self.interval, 'last_cycle': last_cycle, 'last_cycle_age': age,
+                    'vms': len(snapshot['vms']),
+                    'restricted': len([vm_id for vm_id in snapshot['vms'] if snapshot['vms'][vm_id]['restricted']]),
+                    'restricted_tenants': snapshot['status'].get('restricted_tenants', [])}
+        if args[0] == 'restricted':
+            return {'restricted': dict((vm_id, entry) for vm_id, entry in snapshot['vms'].items() if entry['restricted'])}
+        if args[0] == 'usage':
+            if len(args) == 1:
+                return {'vms': snapshot['vms']}
+            missing = [vm_id for vm_id in args[1:] if vm_id not in snapshot['vms']]
+            if missing:
+                raise LookupError('Not tracking VM ' + ', '.join(missing))
+            return {'vms': dict((vm_id, snapshot['vms'][vm_id]) for vm_id in args[1:])}
+        return snapshot['status']
+
+
+
+class StatusServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Answers queries on a Unix socket, one line in (i.e. 'usage 5') and one line of json out.
+    A query that fails is answered with {"error": <message>}
+    """
+    daemon_threads = True
+    board = None
+    path = ''
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, path, board):
+        """
+        :param path: path of the socket, replaced if it is left over from a previous run
+        :param board: StatusBoard answering the queries
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        UnixStreamServer.__init__(self, path, StatusHandler)
+        os.chmod(path, 0o660)
+        self.path = path
+        self.board = board
+
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever, name = 'StatusServer')
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Answering status queries on ' + self.path)
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+
+class StatusHandler(StreamRequestHandler):
+
+    def handle(self):
+        args = self.rfile.readline(4096).decode('utf-8', 'replace').split()
+        try:
+            reply = self.server.board.answer(args)
+        except Exception as exception:
+            reply = {'error': str(exception)}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
@@ -0,0 +1,33 @@
+"""
+Client side of the status socket, kept apart from status.py so metering_check.py
+can ask the daemon without importing numpy or the cycle table
+"""
+import json
+import socket
+
+
+def query_status(path, query, timeout = 5):
+    """
+    Ask the daemon listening on path
+    :param query: i.e. 'health' or 'usage 5'
+    :param timeout: seconds
+    :return: dict answered by the daemon. Raises socket.error if it is not listening,
+             LookupError if it could not answer the query
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall((query + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = client.recv(65536)
+            if not data:
+                break
+            reply += data
+    finally:
+        client.close()
+    reply = json.loads(reply.decode('utf-8'))
+    if 'error' in reply:
+        raise LookupError('The daemon could not answer ' + query + ': ' + reply['error'])
+    return reply
@@ -0,0 +1,136 @@
+"""
+Usage of the VMs and tenants of a host over any time window, read from its UsageArchive.
+
+    python usage_query.py -d /var/lib/metering/archive -s 2016-05-01 -e 2016-06-01 -b tenant
+
+The usage of a VM is the traffic between its first and its last sample inside the window. A counter
+that went back, i.e. after the VM rebooted, is counted from 0 again.
+"""
+import sys
+import json
+import time
+import calendar
+import datetime
+import optparse
+import numpy
+from archive import UsageArchive
+from cycle_table import SECONDS_PER_DAY
+
+
+def usage_by_vm(archive, start, end):
+    """
+    :param archive: UsageArchive
+    :param start: unix time
+    :param end: unix time
+    :return: dict of nova id -> dict of tenant, rx_bytes, tx_bytes and samples
+    """
+    samples = archive.window(start, end)
+    rx_bytes, tx_bytes, counts = vm_totals(samples, len(archive.vm_nova_ids))
+    usage = {}
+    for index in counts.nonzero()[0]:
+        usage[archive.vm_nova_ids[index]] = {'tenant': archive.vm_tenants[index], 'rx_bytes': int(rx_bytes[index]),
+                                             'tx_bytes': int(tx_bytes[index]), 'samples': int(counts[index])}
+    return usage
+
+
+def usage_by_tenant(archive, start, end):
+    """
+    :return: dict of tenant -> dict of rx_bytes, tx_bytes and vms
+    """
+    usage = {}
+    if not archive.vm_tenants:
+        return usage
+    samples = archive.window(start, end)
+    rx_bytes, tx_bytes, counts = vm_totals(samples, len(archive.vm_nova_ids))
+    tenants, tenant_indexes = numpy.unique(numpy.array(archive.vm_tenants), return_inverse = True)
+    tenant_rx = numpy.bincount(tenant_indexes, rx_bytes, len(tenants))
+    tenant_tx = numpy.bincount(tenant_indexes, tx_bytes, len(tenants))
+    tenant_vms = numpy.bincount(tenant_indexes, counts > 0, len(tenants))
+    for index in tenant_vms.nonzero()[0]:
+        usage[str(tenants[index])] = {'rx_bytes': int(tenant_rx[index]), 'tx_bytes': int(tenant_tx[index]),
+                                      'vms': int(tenant_vms[index])}
+    return usage
+
+
+def vm_totals(samples, vm_count):
+    """
+    :param samples: dict of time, vm, rx and tx arrays
+    :param vm_count: number of VMs in the archive
+    :return: (rx bytes, tx bytes, number of samples) arrays indexed by VM
+    """
+    order = numpy.lexsort((samples['time'], samples['vm']))
+    vms = samples['vm'][order]
+    counts = numpy.bincount(vms, minlength = vm_count)
+    totals = []
+    for column in ('rx', 'tx'):
+        counters = samples[column][order]
+        used = counters[1:] - counters[:-1]
+        used = numpy.where(used < 0, counters[1:], used) #counter reset
+        same_vm = vms[1:] == vms[:-1]
+        totals.append(numpy.bincount(vms[1:][same_vm], used[same_vm], vm_count).astype(numpy.int64))
+    return totals[0], totals[1], counts
+
+
+def parse_time(value):
+    """
+    :param value: unix time, or a UTC date as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, date_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('The time ' + value + ' should be a unix time or a date as YYYY-MM-DD[THH:MM:SS]')
+
+
+def main():
+    parser = optparse.OptionParser()
+
+    parser.add_option('-d', '--archive-dir',
+        help    = 'Directory of the usage archive of the daemon',
+        dest    = 'archive_dir',
+        metavar = 'ARCHIVE_DIR')
+
+    parser.add_option('-s', '--start',
+        help    = 'Start of the window, unix time or UTC date. Default 30 days ago',
+        dest    = 'start',
+        metavar = 'START')
+
+    parser.add_option('-e', '--end',
+        help    = 'End of the window, unix time or UTC date. Default now',
+        dest    = 'end',
+        metavar = 'END')
+
+    parser.add_option('-b', '--by',
+        help    = 'vm or tenant. Default vm',
+        dest    = 'by',
+        metavar = 'BY')
+
+    (options, args) = parser.parse_args()
+    if options.archive_dir is None:
+        parser.error('The archive directory is required')
+    end = time.time()
+    if options.end is not None:
+        end = parse_time(options.end)
+    start = end - 30 * SECONDS_PER_DAY
+    if options.start is not None:
+        start = parse_time(options.start)
+    by = options.by
+    if by is None:
+        by = 'vm'
+    if by not in ('vm', 'tenant'):
+        raise ValueError('Unknown grouping ' + by + '. Use vm or tenant')
+    archive = UsageArchive(options.archive_dir, retention_days = 0)
+    if by == 'vm':
+        usage = usage_by_vm(archive, start, end)
+    else:
+        usage = usage_by_tenant(archive, start, end)
+    sys.stdout.write(json.dumps({'start': start, 'end': end, 'usage': usage}, indent = 2, sort_keys = True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
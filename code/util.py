@@ -1,34 +1,268 @@
+import os
 import subprocess
 import sys
+import time
+import signal
+import random
+import threading
+import ctypes
+import ctypes.util
 from time import sleep
 import logging
+import metrics
 
 logger = logging.getLogger(__name__)
 
-def subprocess_cmd(command, attempt = 2):
+command_timeouts = {'virsh': 30, 'neutron': 60, 'nova': 60} #seconds per command class
+default_timeout = 60 #seconds
+backoff_base = 2 #seconds
+backoff_max = 30 #seconds
+breakers = {} #backend -> CircuitBreaker
+breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    The backend failed too many times in a row, the call was not attempted
+    """
+
+
+
+class CircuitBreaker:
+    """
+    Stops calling a backend that keeps failing. After failure_threshold failures in a row the
+    breaker opens and every call fails straight away with CircuitOpenError. Once reset_timeout
+    seconds have passed a single trial call is let through, and the breaker closes again if it works.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    name = ''
+    failure_threshold = 5
+    reset_timeout = 30 #seconds
+    state = CLOSED
+    failures = 0
+    opened_at = 0
+    trial_running = False
+    lock = None
+
+
+    def __init__(self, name, failure_threshold = 5, reset_timeout = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+
+    def allow(self):
+        """
+        Raises CircuitOpenError if the backend should not be called now
+        """
+        with self.lock:
+            if self.state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return
+            if self.state != self.CLOSED:
+                raise CircuitOpenError('The circuit breaker of ' + self.name + ' is open after ' + str(self.failures) +
+                                       ' failures, not calling it')
+
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info('The circuit breaker of ' + self.name + ' is closed again')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                logger.warning('Opening the circuit breaker of ' + self.name + ' after ' + str(self.failures) +
+                               ' failures. Calls fail straight away for ' + str(self.reset_timeout) + ' seconds')
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+
+def get_breaker(backend):
+    """
+    :param backend: virsh, neutron, nova, keystone...
+    :return: CircuitBreaker shared by every call to the backend
+    """
+    with breakers_lock:
+        if backend not in breakers:
+            breakers[backend] = CircuitBreaker(backend)
+        return breakers[backend]
+
+
+def command_backend(command):
+    """
+    :param command: argument list or command line
+    :return: the command class of the command (virsh, neutron or nova), None for any other command
+    """
+    if not isinstance(command, list):
+        command = command.replace('|', ' ').split()
+    for word in command:
+        if word in command_timeouts:
+            return word
+    return None
+
+
+def backoff_delay(retry):
+    """
+    Exponential backoff with full jitter
+    :param retry: number of retries so far
+    :return: seconds to wait before the next try
+    """
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** retry))
+
+
+def _kill_process_group(process, killed):
+    killed.set()
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+def command_line(command):
+    if isinstance(command, list):
+        return ' '.join(command)
+    return command
+
+
+def run_with_timeout(command, timeout):
+    """
+    Runs a command, killing it and its children if it takes longer than timeout seconds
+    :param command: argument list, run directly. A string is run by bash
+    :return: (return code, stdout, stderr) as text, return code None if the command timed out
     """
-    Runs a bash command. Detect failure from the output stream.
-    Retry the command a number of times before accepting failure
-    :param command:
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               shell=not isinstance(command, list), preexec_fn=os.setsid, universal_newlines=True)
+    killed = threading.Event()
+    timer = threading.Timer(timeout, _kill_process_group, [process, killed])
+    timer.start()
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        timer.cancel()
+    if killed.is_set():
+        return None, stdout, stderr
+    return process.returncode, stdout, stderr
+
+
+def subprocess_cmd(command, attempt = 2, timeout = None):
+    """
+    Runs a command. Detect failure from the output stream.
+    An argument list is executed directly, without a shell, so ids and macs need no quoting.
+    A string is still run by bash, for the pipelines of the test scripts.
+    Retry the command a number of times before accepting failure, backing off exponentially.
+    Every virsh, neutron and nova command goes through the circuit breaker of its backend,
+    so a backend that is down fails fast instead of stalling the cycle.
+    :param command: argument list, i.e. ['sudo', 'virsh', 'dumpxml', '5'], or bash command line
     :param attempt:
+    :param timeout: seconds before the command is killed. Default from command_timeouts
     :return:
     """
-    logger.debug('Executing command: ' + command)
-    process = subprocess.Popen(command,stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    stdout, stderr = process.communicate()
-    stderr = stderr.strip()
-    stdout = stdout.strip()
+    backend = command_backend(command)
+    breaker = None
+    if backend is not None:
+        breaker = get_breaker(backend)
+    if timeout is None:
+        timeout = command_timeouts.get(backend, default_timeout)
+    retry = 0
+    while True:
+        if breaker is not None:
+            breaker.allow()
+        logger.debug('Executing command: ' + command_line(command))
+        metrics.subprocesses.labels(backend or 'other').inc()
+        returncode, stdout, stderr = run_with_timeout(command, timeout)
+        stderr = stderr.strip()
+        stdout = stdout.strip()
+        if returncode == 0:
+            if breaker is not None:
+                breaker.record_success()
+            return stdout
+        if returncode is None:
+            stderr = 'Timed out after ' + str(timeout) + ' seconds'
+        if breaker is not None:
+            breaker.record_failure()
+        if retry >= attempt:
+            raise RuntimeError('Hit error while running command (' + command_line(command) + ') \n' + stderr)
+        delay = backoff_delay(retry)
+        logger.debug('Hit error ' + stderr + '. Trying again in ' + str(round(delay, 1)) + ' seconds.')
+        sleep(delay)
+        retry += 1
+        metrics.retries.labels(backend or 'other').inc()
+
+
+class Timer:
+    """
+    Records the seconds spent in a with block in a histogram, on the monotonic clock
+    """
+    histogram = None
+    start = 0
+
+
+    def __init__(self, histogram):
+        self.histogram = histogram
 
-    if process.returncode != 0:
-        if attempt != 0:
-            logger.debug('Hit error ' + stderr + '. Trying again.')
-            sleep(5)
-            return subprocess_cmd(command, attempt - 1)
-        elif attempt == 0:
-            raise RuntimeError('Hit error while running command (' + command + ') \n' + stderr)
-    return stdout
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.histogram.observe(monotonic() - self.start)
+        return False
+
+
+def stage_timer(stage):
+    """
+    :param stage: vm_listing, discovery, counter_collection...
+    :return: Timer recording the duration of the stage
+    """
+    return Timer(metrics.stage_duration.labels(stage))
 
 
 def str2bool(str):
     return str.lower() in ('yes', 'true', 't', '1')
 
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime_monotonic():
+    """
+    time.monotonic is only available from python 3.3, read CLOCK_MONOTONIC from libc before that
+    """
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    def monotonic():
+        timespec = _timespec()
+        if clock_gettime(1, ctypes.byref(timespec)) != 0: #CLOCK_MONOTONIC
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = _clock_gettime_monotonic()
@@ -0,0 +1,193 @@
+import re
+import subprocess
+import threading
+import logging
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from util import *
+import metrics
+
+
+session = None
+session_lock = threading.Lock()
+
+
+class VirshSessionError(RuntimeError):
+    """
+    The virsh shell died or stopped answering
+    """
+
+
+
+class VirshSession:
+    """
+    One long lived virsh shell, started once with sudo and fed commands on stdin, so every
+    list, dumpxml or domifstat does not pay for sudo, a new process and a new libvirt connection.
+    Each command is followed by 'echo <marker>', and its output is everything printed before the
+    marker comes back. Lines starting with 'error:' mean the command failed.
+    Commands are sent one at a time. The shell is started again if it dies or does not answer
+    within timeout seconds, and only those failures count against the virsh circuit breaker.
+    """
+    command = ['sudo', 'stdbuf', '-oL', 'virsh', '--quiet'] #line buffered so each answer is flushed
+    timeout = 30 #seconds
+    prompt = 'virsh # '
+    process = None
+    lines = None
+    lock = None
+    sequence = 0
+    spawns = 0
+    logger = logging.getLogger(__name__)
+
+
+    def __init__(self, command = None, timeout = None):
+        """
+        :param command: argument list starting the shell. Default sudo virsh
+        :param timeout: seconds to wait for the answer to a command. Default the virsh command timeout
+        """
+        if command is not None:
+            self.command = command
+        if timeout is None:
+            timeout = command_timeouts['virsh']
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.spawns = 0
+
+
+    def __spawn(self):
+        self.logger.debug('Starting virsh session: ' + ' '.join(self.command))
+        self.process = subprocess.Popen(self.command, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        stderr = subprocess.STDOUT, universal_newlines = True, bufsize = 1)
+        self.lines = queue.Queue()
+        reader = threading.Thread(target = self.__read_output, args = (self.process, self.lines),
+                                  name = 'VirshSessionReader')
+        reader.daemon = True
+        reader.start()
+        self.spawns += 1
+        metrics.subprocesses.labels('virsh').inc()
+
+
+    def __read_output(self, process, lines):
+        for line in iter(process.stdout.readline, ''):
+            lines.put(line.rstrip('\n'))
+        lines.put(None)
+
+
+    def close(self):
+        with self.lock:
+            self.__kill()
+
+
+    def __kill(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+        self.process = None
+
+
+    def run(self, args):
+        """
+        :param args: virsh command and its arguments, i.e. ['dumpxml', '5']
+        :return: output of the command
+        """
+        breaker = get_breaker('virsh')
+        with self.lock:
+            breaker.allow()
+            try:
+                output = self.__request(args)
+            except VirshSessionError as exception:
+                #one more try on a new shell
+                self.logger.warning('virsh session failed (' + str(exception) + '), starting a new one')
+                self.__kill()
+                metrics.retries.labels('virsh').inc()
+                try:
+                    output = self.__request(args)
+                except VirshSessionError:
+                    self.__kill()
+                    breaker.record_failure()
+                    raise
+            breaker.record_success()
+        return output
+
+
+    def __request(self, args):
+        if self.process is None or self.process.poll() is not None:
+            self.__spawn()
+        self.sequence += 1
+        metrics.virsh_session_commands.inc()
+        marker = '--virsh-session-' + str(self.sequence) + '--'
+        command_line = ' '.join(quote_arg(arg) for arg in args)
+        try:
+            self.process.stdin.write(command_line + '\n' + 'echo ' + marker + '\n')
+            self.process.stdin.flush()
+        except (IOError, OSError) as exception:
+            raise VirshSessionError('could not send ' + command_line + ': ' + str(exception))
+        deadline = monotonic() + self.timeout
+        output = []
+        errors = []
+        while True:
+            remaining = deadline - monotonic()
+            try:
+                if remaining <= 0:
+                    raise queue.Empty()
+                line = self.lines.get(timeout = remaining)
+            except queue.Empty:
+                self.__kill()
+                raise VirshSessionError('no answer to ' + command_line + ' after ' + str(self.timeout) + ' seconds')
+            if line is None:
+                self.process = None
+                raise VirshSessionError('virsh exited while running ' + command_line)
+            while line.startswith(self.prompt):
+                line = line[len(self.prompt):]
+            if line.strip() == marker:
+                break
+            if line == command_line or line == 'echo ' + marker:
+                continue #echoed input
+            if line.startswith('error:'):
+                errors.append(line)
+            else:
+                output.append(line)
+        if errors:
+            raise RuntimeError('Hit error while running command (virsh ' + command_line + ') \n' + '\n'.join(errors))
+        return '\n'.join(output).strip()
+
+
+
+def quote_arg(arg):
+    """
+    Escape the characters the virsh shell would split on or interpret
+    """
+    return re.sub(r'([^\w.:/@+=,-])', r'\\\1', arg)
+
+
+def get_session():
+    """
+    :return: VirshSession shared by the daemon, None to start virsh for every command
+    """
+    with session_lock:
+        return session
+
+
+def set_session(virsh_session):
+    global session
+    with session_lock:
+        session = virsh_session
+
+
+def virsh_cmd(args, attempt = 2):
+    """
+    Runs a virsh command through the shared session, or as its own process if there is none
+    :param args: virsh command and its arguments, i.e. ['domifstat', '5', 'tap1']
+    :param attempt: retries when virsh is run as its own process
+    :return: output of the command
+    """
+    virsh_session = get_session()
+    if virsh_session is None:
+        return subprocess_cmd(['sudo', 'virsh'] + args, attempt)
+    return virsh_session.run(args)
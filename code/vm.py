@@ -1,19 +1,23 @@
 import xml.etree.ElementTree as ElementTree
-import datetime
 import time
 import logging
 from util import *
+from virsh import virsh_cmd
+from collector import *
+from ports import *
+from cycle_table import *
+from openstack import get_client
 
 
 
 class Cycle:
     '''
-    Records date and bandwidth at start of cycle
+    Records date and bandwidth at start of cycle, as recovered from file.
+    The cycle of a tracked VM lives in its row of a CycleTable
     '''
     date = 0       #unix time format
     bandwidth = 0  #Bandwidth in GB
     is_restricted = False
-    logger = logging.getLogger(__name__)
 
 
     def __init__(self, date, bandwidth, is_restricted = False):
@@ -22,34 +26,6 @@ class Cycle:
         self.is_restricted = is_restricted
 
 
-    def __format_time(self):
-        '''
-        User readable format for a date
-        :return:
-        '''
-        return datetime.datetime.fromtimestamp(float(self.date)).strftime('%Y-%m-%d %H:%M:%S')
-
-
-    def reset_limit(self, current_bandwidth):
-        self.bandwidth = current_bandwidth
-        self.date = time.time()
-        self.is_restricted = False
-
-
-    def stringify(self):
-        '''
-        Converts the object to a format that can be written to a text file
-        :return: String
-        '''
-        return str(self.date) + ', ' + str(self.bandwidth) + ', ' + str(self.is_restricted)
-
-
-    def __str__(self):
-        output =  ('Cycle start date:      ' + self.__format_time() + ' \n'
-                   'Cycle inital bandwith  ' + str(self.bandwidth) + 'GB')
-        return output
-
-
 
 class Vm:
     '''
@@ -62,22 +38,65 @@ class Vm:
     tap_interface = ''
     tenant = ''
     port_id = ''
-    cycle = None
+    cycle = None #CycleView
+    table = None
+    collector = None
+    ports = None
+    qos = None
+    enforcer = None
     band_limit = None
+    applied_policy = '' #last QOS policy pushed to the port
+    fleet_restricted = False #True while the tenant is over its fleet wide quota
+    verified = True #False until a VM restored from file is checked against the live domain
     state_change_required = True
     logger = logging.getLogger(__name__)
 
 
-    def __init__(self, virsh_id, limits, cycle = None):
+    def __init__(self, virsh_id, limits, cycle = None, counters = None, collector = None, ports = None, metadata = None,
+                 qos = None, table = None, domain_xml = None, enforcer = None):
+        """
+        :param virsh_id:
+        :param limits: LimitCollection
+        :param cycle: Cycle recovered from file, None for a newly detected VM
+        :param counters: Optional host wide counters (tap -> (rx_bytes, tx_bytes)) collected this cycle
+        :param collector: CounterCollector used when counters has no sample for this VM. Default virsh
+        :param ports: PortIndex shared by the VMs of the host
+        :param metadata: dict of nova_id, tap_interface, mac_address, tenant, port_id and applied_policy
+                         recovered from file. The VM is rebuilt without calling virsh or neutron and
+                         is checked against the live domain on its first update_cycle
+        :param qos: QosReconciler that applies policy changes in the background.
+                    Without one the port is updated before update_cycle returns
+        :param table: CycleTable holding the cycles of the VMs of the host. Default one of its own
+        :param domain_xml: Output of virsh dumpxml if it was already read, None to read it
+        :param enforcer: LocalEnforcer that rate limits the tap as soon as the VM is restricted, None to only use neutron
+        """
         self.virsh_id = virsh_id
-        self.__set_values_from_virsh_xml(virsh_id)
+        self.qos = qos
+        self.enforcer = enforcer
+        if table is None:
+            table = CycleTable(1)
+        self.table = table
+        if collector is None:
+            collector = VirshCollector()
+        self.collector = collector
+        if ports is None:
+            ports = PortIndex()
+        self.ports = ports
+        if metadata is not None and cycle is not None:
+            self.__restore(metadata, cycle, limits)
+            return
+        self.__set_values_from_virsh_xml(virsh_id, domain_xml)
         self.port_id = self.__get_port_id()
 
         if (cycle == None):
-            self.cycle = self.__get_current_bandwidth()
+            self.cycle = self.table.add(time.time(), self.__capture_packets(counters))
         else:
-            self.cycle = cycle
-        self.set_limit(limits)
+            self.cycle = self.__add_cycle(cycle)
+        try:
+            self.set_limit(limits, counters)
+        except Exception:
+            self.table.remove(self.cycle.row)
+            raise
 
 
     def __str__(self):
@@ -87,26 +106,83 @@ class Vm:
                    'tap_interface:        ' + self.tap_interface + '\n'
                    'tenant:               ' + self.tenant + '\n'
                    'port_id:              ' + self.port_id + '\n'
-                   'cycle bandwidth used: ' + str(self.__get_current_bandwidth().bandwidth - self.cycle.bandwidth) + 'GB\n'
+                   'cycle bandwidth used: ' + str(float(self.__capture_packets() - self.cycle.start_bytes) / BYTES_PER_GB) + 'GB\n'
                    'cycle:                ' + str(self.cycle) + '\n'
                    'band_limit:           ' + str(self.band_limit))
         return output
 
 
-    def set_limit(self, limits):
+    def __restore(self, metadata, cycle, limits):
+        self.nova_id = metadata['nova_id']
+        self.tap_interface = metadata['tap_interface']
+        self.mac_address = metadata['mac_address']
+        self.tenant = metadata['tenant']
+        self.port_id = metadata['port_id']
+        self.applied_policy = metadata['applied_policy']
+        self.band_limit = limits.get_limit_for_tenant(self.tenant)
+        self.cycle = self.__add_cycle(cycle)
+        self.table.set_limit(self.cycle.row, self.band_limit)
+        self.state_change_required = self.policy(limits.restricted_limit_name) != self.applied_policy
+        self.verified = False
+        if self.enforcer is not None and self.cycle.is_restricted:
+            if self.applied_policy == limits.restricted_limit_name:
+                self.enforcer.adopt(self.tap_interface)
+            else:
+                self.enforcer.restrict(self.tap_interface)
+
+
+    def __add_cycle(self, cycle):
+        """
+        :param cycle: Cycle recovered from file
+        :return: CycleView of the row it was copied to
+        """
+        return self.table.add(cycle.date, int(round(float(cycle.bandwidth) * BYTES_PER_GB)), cycle.is_restricted)
+
+
+    def __verify(self, counters):
+        """
+        A VM restored from file is trusted until its first cycle. If the host wide counters
+        have no sample for its tap, or the uuid of the live domain is not the nova_id recovered,
+        the virsh id was reused by another VM and the domain is discovered again.
+        :param counters: dict of tap -> (rx_bytes, tx_bytes)
+        """
+        self.verified = True
+        if counters is not None and self.tap_interface in counters and self.__get_live_nova_id() == self.nova_id:
+            return
+        self.logger.info('Recovered data for VM ' + self.virsh_id + ' does not match the live domain, rediscovering it')
+        nova_id = self.nova_id
+        tap_interface = self.tap_interface
+        port_id = self.port_id
+        self.__set_values_from_virsh_xml(self.virsh_id)
+        self.port_id = self.__get_port_id()
+        if self.nova_id != nova_id or self.tap_interface != tap_interface or self.port_id != port_id:
+            self.state_change_required = True
+
+
+    def __get_live_nova_id(self):
+        return virsh_cmd(['domuuid', self.virsh_id]).strip()
+
+
+    def set_limit(self, limits, counters = None):
         new_limit = limits.get_limit_for_tenant(self.tenant)
         if self.band_limit != new_limit:
             self.state_change_required = True
             self.band_limit = new_limit
-            self.update_cycle(limits.restricted_limit_name)
+            self.table.set_limit(self.cycle.row, new_limit)
+            self.update_cycle(limits.restricted_limit_name, counters)
+        elif self.policy(limits.restricted_limit_name) != self.applied_policy:
+            #the restricted limit changed while the VM is restricted
+            self.state_change_required = True
+            self.finish_cycle(False, False, limits.restricted_limit_name)
 
 
     def __get_port_id(self):
-        return subprocess_cmd("neutron port-list | grep " + self.mac_address + " |  awk '{print $2}'")
+        return self.ports.get_port_id(self.mac_address)
 
 
-    def __set_values_from_virsh_xml(self, virsh_id):
-        xml_data = subprocess_cmd('sudo virsh dumpxml ' + virsh_id)
+    def __set_values_from_virsh_xml(self, virsh_id, xml_data = None):
+        if xml_data is None:
+            xml_data = virsh_cmd(['dumpxml', virsh_id])
         root = ElementTree.fromstring(xml_data)
         self.tap_interface = self.__get_tap(root)
         self.nova_id = self.__get_nova_id(root)
@@ -150,52 +226,143 @@ class Vm:
         raise LookupError('Could not find tenant from xml parsing for vm ' + self.virsh_id)
 
 
-    def __capture_packets(self):
-        bandwidth_data = subprocess_cmd('sudo virsh domifstat ' + self.virsh_id + ' ' + self.tap_interface)
-        for bandwith_data_line in bandwidth_data.splitlines():
-            if ('rx_bytes' in bandwith_data_line):
-                return round(float(bandwith_data_line.split()[-1])/float(1000000000), 4) #convert to GB
-        raise LookupError('Could not find rx_byte data for vm ' + self.virsh_id)
+    def __capture_packets(self, counters = None):
+        """
+        Use the sample from the host wide collection when there is one,
+        otherwise ask the collector for this VM only
+        :param counters: dict of tap -> (rx_bytes, tx_bytes)
+        :return: rx bytes
+        """
+        if counters is not None and self.tap_interface in counters:
+            return int(counters[self.tap_interface][0])
+        return int(self.collector.read(self.virsh_id, self.tap_interface)[0])
+
+
+    def sample(self, counters = None):
+        """
+        :param counters: Optional host wide counters collected this cycle
+        :return: rx bytes to evaluate the cycle with
+        """
+        if not self.verified:
+            self.__verify(counters)
+        return self.__capture_packets(counters)
 
 
-    def __get_current_bandwidth(self):
-        return Cycle(time.time(), self.__capture_packets())
+    def policy(self, restricted_limit_name):
+        """
+        A VM over its own quota only gets the restricted policy with a local enforcer, without one
+        it keeps its limit as it always did. A tenant over its fleet wide quota gets it either way
+        :return: name of the QOS policy the port should have
+        """
+        restricted = self.fleet_restricted or (self.cycle.is_restricted and self.enforcer is not None)
+        if restricted and restricted_limit_name:
+            return restricted_limit_name
+        return self.band_limit.name
 
 
-    def update_cycle(self, restricted_limit_name):
+    def finish_cycle(self, lifted, abused, restricted_limit_name = None):
         """
-        Get current bandwidth and test for abuse
+        Push the policy to the port once the cycle has been evaluated
+        :param lifted: True if the restriction ended with the cycle
+        :param abused: True if the VM was just restricted
+        :param restricted_limit_name: policy of the restricted VMs, None to leave them on their limit
         """
-        current_bandwidth = self.__get_current_bandwidth()
-        time_diff_in_days = (current_bandwidth.date - self.cycle.date)/86400
-        #start of new cycle
-        if (time_diff_in_days > self.band_limit.time_period):
-            if self.cycle.is_restricted == True:
-                self.state_change_required = True
-            self.cycle.reset_limit(current_bandwidth.bandwidth)
-        if self.cycle.is_restricted == False:
-            bandwidth_diff = (current_bandwidth.bandwidth - self.cycle.bandwidth)
-            #abuse detected
-            if (bandwidth_diff > self.band_limit.band_limit):
-                self.logger.warning('Abuse detected for VM: ' + self.virsh_id)
-                self.cycle.is_restricted = True
-                self.state_change_required = True
+        if lifted:
+            self.state_change_required = True
+            if self.enforcer is not None and not self.fleet_restricted:
+                self.enforcer.release(self.tap_interface)
+        if abused:
+            self.logger.warning('Abuse detected for VM: ' + self.virsh_id)
+            self.state_change_required = True
+            if self.enforcer is not None and restricted_limit_name:
+                self.enforcer.restrict(self.tap_interface)
         #Run synch
-        if self.state_change_required == True:
-            subprocess_cmd('neutron port-update ' + self.port_id + ' --qos-policy ' + self.band_limit.name)
-            #if self.cycle.is_restricted == True:
-                #subprocess_cmd('neutron port-update ' + self.port_id + ' --qos-policy ' + restricted_limit_name)
-            #else:
-                #subprocess_cmd('neutron port-update ' + self.port_id + ' --qos-policy ' + self.band_limit.name)
+        policy = self.policy(restricted_limit_name)
+        if self.state_change_required == True and self.qos is not None:
+            self.qos.submit(self.port_id, policy, self.__policy_applied)
+            self.state_change_required = False
+        elif self.state_change_required == True:
+            get_client().update_port_qos(self.port_id, policy)
+            self.__policy_applied(policy)
             self.state_change_required = False
 
 
-
-    def stringify(self):
-        return self.virsh_id + ', ' + self.cycle.stringify() + '\n'
+    def set_fleet_restricted(self, restricted, restricted_limit_name = None):
+        """
+        The tenant went over or back under its fleet wide quota. The VM keeps the restricted
+        policy while either its own cycle or its tenant is over quota
+        :param restricted: True if the tenant is over its fleet wide quota
+        :param restricted_limit_name: policy of the restricted VMs, None to leave them on their limit
+        """
+        if restricted == self.fleet_restricted:
+            return
+        self.fleet_restricted = restricted
+        self.state_change_required = True
+        if self.enforcer is not None and restricted_limit_name:
+            if restricted:
+                self.enforcer.restrict(self.tap_interface)
+            elif not self.cycle.is_restricted:
+                self.enforcer.release(self.tap_interface)
+        self.finish_cycle(False, False, restricted_limit_name)
+
+
+    def update_cycle(self, restricted_limit_name, counters = None):
+        """
+        Get current bandwidth and test for abuse
+        :param restricted_limit_name:
+        :param counters: Optional host wide counters collected this cycle
+        """
+        failures = update_cycles([self], restricted_limit_name, counters)
+        if failures:
+            raise failures[0][1]
 
 
+    def next_sample_time(self):
+        """
+        Earliest time the VM could cross its quota or start a new cycle. The metered counter
+        cannot grow faster than the line rate of the host, so until then there is nothing new to detect.
+        :return: unix time, 0 if the VM has not been sampled yet
+        """
+        return float(self.table.next_sample_time([self.cycle.row])[0])
 
 
+    def __policy_applied(self, policy):
+        self.applied_policy = policy
+        if self.enforcer is not None:
+            self.enforcer.confirm(self.tap_interface, policy)
 
 
+    def stringify(self):
+        return (self.virsh_id + ', ' + self.cycle.stringify() + ', ' + self.nova_id + ', ' + self.tap_interface + ', ' +
+                self.mac_address + ', ' + self.tenant + ', ' + self.port_id + ', ' + self.applied_policy + '\n')
+
+
+
+def update_cycles(vms, restricted_limit_name, counters = None):
+    """
+    Get current bandwidth of the VMs and test them all for abuse in one pass
+    A VM that fails is left out and does not hold up the others
+    :param vms: list of Vm sharing the same CycleTable
+    :param restricted_limit_name:
+    :param counters: Optional host wide counters collected this cycle
+    :return: list of (Vm, exception) for the VMs that failed
+    """
+    failures = []
+    sampled = []
+    rx_bytes = []
+    for vm in vms:
+        try:
+            rx_bytes.append(vm.sample(counters))
+            sampled.append(vm)
+        except Exception as exception:
+            failures.append((vm, exception))
+    if not sampled:
+        return failures
+    now = time.time()
+    lifted, abused = sampled[0].table.evaluate([vm.cycle.row for vm in sampled], [now] * len(sampled), rx_bytes)
+    for index, vm in enumerate(sampled):
+        try:
+            vm.finish_cycle(lifted[index], abused[index], restricted_limit_name)
+        except Exception as exception:
+            failures.append((vm, exception))
+    return failures
@@ -0,0 +1,225 @@
+"""
+Measures how the daemon scales with the number of VMs on a host, without libvirt or OpenStack.
+virsh is testing/fake_virsh.py simulating the domains, neutron and nova are testing/openstack_stub.py.
+Each size runs in a process of its own so the memory figures do not include the previous sizes.
+
+    python -m testing.benchmark --sizes 10,100,1000 --output benchmark.json
+
+Prints one json document: the settings, then for each size the seconds taken by the first cycle
+(every VM is new), a steady cycle, a cycle sampling every VM, Daemon.load_file after a restart
+and LimitCollection.synch_limits after a tenant changes limit, with the processes started,
+the API calls made and the peak memory.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import optparse
+import resource
+import tempfile
+import platform
+import subprocess
+import logging
+from code.daemon import *
+from code.openstack import OpenStackClient, get_client, set_client
+import code.metrics as metrics
+from testing.openstack_stub import StubOpenStack
+
+testing_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class Timer:
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.seconds = monotonic() - self.start
+        return False
+
+
+
+class Counts:
+    """
+    Processes started and API calls made since the last call to take
+    """
+
+    def __init__(self, starts_fname, stub):
+        self.starts_fname = starts_fname
+        self.stub = stub
+        self.last = self.read()
+
+    def read(self):
+        starts = 0
+        if os.path.exists(self.starts_fname):
+            with open(self.starts_fname) as f:
+                starts = sum(1 for line in f)
+        subprocesses = dict((label[0], value.value) for label, value in metrics.subprocesses.values.items())
+        retries = dict((label[0], value.value) for label, value in metrics.retries.values.items())
+        return {'virsh_processes': starts, 'virsh_session_commands': metrics.virsh_session_commands.labels().value,
+                'api_requests': len(self.stub.requests), 'subprocesses': subprocesses, 'retries': retries}
+
+    def take(self):
+        current = self.read()
+        delta = {}
+        for key in current:
+            if isinstance(current[key], dict):
+                delta[key] = dict((name, current[key][name] - self.last[key].get(name, 0)) for name in current[key]
+                                  if current[key][name] != self.last[key].get(name, 0))
+            else:
+                delta[key] = current[key] - self.last[key]
+        self.last = current
+        return delta
+
+
+
+def peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_daemon(options, directory):
+    daemon = Daemon(30, 24, lifecycle = 'poll', virsh_session = False, qos_workers = options.qos_workers,
+                    recovery_fname = os.path.join(directory, 'recovery.txt'),
+                    meter_fname = os.path.join(directory, 'meter.yaml'))
+    if options.virsh == 'session':
+        if get_session() is not None:
+            get_session().close()
+        fake_virsh = [sys.executable, os.path.join(testing_dir, 'fake_virsh.py'), os.path.join(directory, 'starts')]
+        set_session(VirshSession(fake_virsh))
+    return daemon
+
+
+def run_size(options, size):
+    """
+    :return: dict of the measurements for a host running size VMs
+    """
+    directory = tempfile.mkdtemp()
+    logging.basicConfig(filename = os.path.join(directory, 'metering.log'), level = options.log_level)
+    os.environ['FAKE_VIRSH_DOMAINS'] = str(size)
+    os.environ['FAKE_VIRSH_LATENCY'] = str(options.virsh_latency)
+    #without a session, 'sudo virsh' is run from PATH
+    bin_directory = os.path.join(directory, 'bin')
+    os.mkdir(bin_directory)
+    with open(os.path.join(bin_directory, 'sudo'), 'w') as f:
+        f.write('#!/bin/sh\nexec "$@"\n')
+    with open(os.path.join(bin_directory, 'virsh'), 'w') as f:
+        f.write('#!/bin/sh\nexec ' + sys.executable + ' ' + os.path.join(testing_dir, 'fake_virsh.py') + ' ' +
+                os.path.join(directory, 'starts') + ' "$@"\n')
+    for name in ('sudo', 'virsh'):
+        os.chmod(os.path.join(bin_directory, name), 0o755)
+    os.environ['PATH'] = bin_directory + os.pathsep + os.environ['PATH']
+    shutil.copy(os.path.join(testing_dir, 'meter.yaml'), os.path.join(directory, 'meter.yaml'))
+
+    stub = StubOpenStack(latency = options.api_latency).start()
+    for vm_id in range(1, size + 1):
+        stub.add_port('fa:16:3e:%02x:%02x:%02x' % ((vm_id >> 16) & 0xff, (vm_id >> 8) & 0xff, vm_id & 0xff),
+                      socket.gethostname())
+    set_client(OpenStackClient(stub.auth_url(), 'admin', 'secret', 'admin'))
+    counts = Counts(os.path.join(directory, 'starts'), stub)
+    result = {'vms': size, 'baseline_memory_kb': peak_memory_kb()}
+    daemons = []
+    try:
+        daemon = make_daemon(options, directory)
+        daemons.append(daemon)
+        counts.take()
+
+        vms = {}
+        with Timer() as timer:
+            daemon.get_live_results(vms)
+        result['first_cycle'] = dict(counts.take(), seconds = timer.seconds, vms_added = len(vms))
+        with Timer() as timer:
+            drained = daemon.qos.join(600)
+        result['qos_drain'] = dict(counts.take(), seconds = timer.seconds, drained = drained)
+
+        seconds = []
+        for cycle in range(options.cycles):
+            with Timer() as timer:
+                daemon.get_live_results(vms)
+            seconds.append(timer.seconds)
+        result['steady_cycle'] = dict(counts.take(), cycles = options.cycles, mean_seconds = sum(seconds) / len(seconds),
+                                      max_seconds = max(seconds))
+
+        for vm_id in vms:
+            daemon.samples.schedule(vm_id, 0, time.time())
+        with Timer() as timer:
+            daemon.get_live_results(vms)
+        result['full_sample_cycle'] = dict(counts.take(), seconds = timer.seconds)
+
+        with open(os.path.join(directory, 'meter.yaml')) as f:
+            meter_file = f.read()
+        with open(os.path.join(directory, 'meter.yaml'), 'w') as f:
+            f.write(meter_file.replace('test: metering_blacklist', 'test: metering_whitelist'))
+        with Timer() as timer:
+            daemon.limits.synch_limits(vms)
+        result['synch_limits'] = dict(counts.take(), seconds = timer.seconds)
+
+        restarted = make_daemon(options, directory)
+        daemons.append(restarted)
+        counts.take()
+        with Timer() as timer:
+            restored = restarted.load_file()
+        result['load_file'] = dict(counts.take(), seconds = timer.seconds, vms_restored = len(restored))
+    finally:
+        #no worker may be left calling the stub as the process exits
+        for daemon in daemons:
+            daemon.qos.stop()
+        session = get_session()
+        if session is not None:
+            session.close()
+        get_client().close()
+        stub.stop()
+        shutil.rmtree(directory)
+    result['peak_memory_kb'] = peak_memory_kb()
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', dest = 'sizes', default = '10,100,1000',
+                      help = 'Comma separated numbers of VMs. Default 10,100,1000')
+    parser.add_option('--size', dest = 'size', type = 'int',
+                      help = 'Measure a single size in this process')
+    parser.add_option('--cycles', dest = 'cycles', type = 'int', default = 5,
+                      help = 'Steady cycles to average. Default 5')
+    parser.add_option('--virsh', dest = 'virsh', default = 'session',
+                      help = 'session (one virsh shell) or process (virsh started for every command). Default session')
+    parser.add_option('--virsh-latency', dest = 'virsh_latency', type = 'float', default = 0,
+                      help = 'Seconds added to every virsh command. Default 0')
+    parser.add_option('--api-latency', dest = 'api_latency', type = 'float', default = 0,
+                      help = 'Seconds added to every neutron/nova call. Default 0')
+    parser.add_option('--qos-workers', dest = 'qos_workers', type = 'int', default = 4,
+                      help = 'QOS workers of the daemon. Default 4')
+    parser.add_option('--log-level', dest = 'log_level', default = 'WARNING',
+                      help = 'Level of the daemon log, written to a temporary directory. Default WARNING')
+    parser.add_option('--output', dest = 'output',
+                      help = 'File to write the results to. Default stdout')
+    (options, args) = parser.parse_args()
+    if options.virsh not in ('session', 'process'):
+        raise ValueError('Unknown virsh mode ' + options.virsh + '. Use session or process')
+
+    if options.size is not None:
+        sys.stdout.write(json.dumps(run_size(options, options.size)) + '\n')
+        return
+    settings = dict((key, getattr(options, key)) for key in ('cycles', 'virsh', 'virsh_latency', 'api_latency',
+                                                             'qos_workers'))
+    report = {'python': platform.python_version(), 'host': socket.gethostname(), 'time': time.time(),
+              'settings': settings, 'results': []}
+    root = os.path.dirname(testing_dir)
+    for size in [int(size) for size in options.sizes.split(',')]:
+        command = [sys.executable, '-m', 'testing.benchmark', '--size', str(size)]
+        for key in ('cycles', 'virsh', 'virsh_latency', 'api_latency', 'qos_workers', 'log_level'):
+            command.extend(['--' + key.replace('_', '-'), str(getattr(options, key))])
+        output = subprocess.check_output(command, cwd = root)
+        report['results'].append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output is None:
+        sys.stdout.write(text + '\n')
+    else:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
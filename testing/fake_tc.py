@@ -0,0 +1,51 @@
+"""
+tc stand in for the tests. The first argument is a json file holding the state of the host,
+the others are the tc command, i.e. fake_tc.py state.json qdisc add dev tap5 handle ffff: ingress
+Only the commands of the local enforcer are understood. Like tc, adding a qdisc that exists
+or deleting a filter that does not fails.
+    {"qdiscs": ["tap5"], "filters": {"tap5": {"1": "police rate 5kbit burst 64k"}}}
+Set FAKE_TC_FAIL=1 to fail every command.
+"""
+import os
+import sys
+import json
+
+
+def main():
+    fname = sys.argv[1]
+    words = sys.argv[2:]
+    if os.environ.get('FAKE_TC_FAIL'):
+        sys.stderr.write('RTNETLINK answers: Operation not permitted\n')
+        return 2
+    state = {'qdiscs': [], 'filters': {}}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            state = json.load(f)
+    device = words[words.index('dev') + 1]
+    if words[:2] == ['qdisc', 'add']:
+        if device in state['qdiscs']:
+            sys.stderr.write('Error: Exclusivity flag on, cannot modify.\n')
+            return 2
+        state['qdiscs'].append(device)
+    elif words[:2] == ['filter', 'replace']:
+        if device not in state['qdiscs']:
+            sys.stderr.write('Error: Parent Qdisc doesn\'t exists.\n')
+            return 2
+        police = words[words.index('police'):]
+        state['filters'].setdefault(device, {})[words[words.index('prio') + 1]] = ' '.join(police)
+    elif words[:2] == ['filter', 'del']:
+        priority = words[words.index('prio') + 1]
+        if priority not in state['filters'].get(device, {}):
+            sys.stderr.write('Error: Filter with specified priority/protocol not found.\n')
+            return 2
+        del state['filters'][device][priority]
+    else:
+        sys.stderr.write('Unknown command ' + ' '.join(words) + '\n')
+        return 1
+    with open(fname, 'w') as f:
+        json.dump(state, f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
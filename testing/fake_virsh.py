@@ -0,0 +1,134 @@
+"""
+virsh stand in for the tests. With only the first argument it reads commands on stdin like
+'virsh' with no arguments and answers with canned output. With more arguments it runs them
+as a single command, like 'virsh <command>'.
+    sleep <seconds>   answer after a while
+    exit              quit, as if virsh crashed
+Every start is appended to the file given as first argument.
+FAKE_VIRSH_DOMAINS=<n> simulates a host running domains 1 to n, with counters growing over time,
+and FAKE_VIRSH_LATENCY=<seconds> delays every answer.
+"""
+import os
+import sys
+import time
+
+DOMAINS = [('5', 'instance-00000005'), ('7', 'instance-00000007')]
+if os.environ.get('FAKE_VIRSH_DOMAINS'):
+    DOMAINS = [(str(i), 'instance-%08x' % i) for i in range(1, int(os.environ['FAKE_VIRSH_DOMAINS']) + 1)]
+LATENCY = float(os.environ.get('FAKE_VIRSH_LATENCY') or 0)
+START = 1500000000 #counters count from here
+
+
+def mac_address(vm_id):
+    return 'fa:16:3e:%02x:%02x:%02x' % ((int(vm_id) >> 16) & 0xff, (int(vm_id) >> 8) & 0xff, int(vm_id) & 0xff)
+
+
+def definition(vm_id):
+    return ("<domain type='kvm' id='" + vm_id + "'>\n"
+            "  <uuid>nova-" + vm_id + "</uuid>\n"
+            "  <metadata>\n"
+            "    <nova:instance xmlns:nova='http://openstack.org/xmlns/libvirt/nova/1.0'>\n"
+            "      <nova:owner>\n"
+            "        <nova:project uuid='tenant-" + vm_id + "'>" + ('admin', 'test')[int(vm_id) % 2] + "</nova:project>\n"
+            "      </nova:owner>\n"
+            "    </nova:instance>\n"
+            "  </metadata>\n"
+            "  <devices>\n"
+            "    <interface type='bridge'>\n"
+            "      <mac address='" + mac_address(vm_id) + "'/>\n"
+            "      <target dev='tap" + vm_id + "'/>\n"
+            "    </interface>\n"
+            "  </devices>\n"
+            "</domain>")
+
+
+def domstats():
+    elapsed = int(time.time()) - START
+    lines = []
+    for vm_id, name in DOMAINS:
+        lines.extend(["Domain: '" + name + "'", '  net.count=1', '  net.0.name=tap' + vm_id,
+                      '  net.0.rx.bytes=' + str(elapsed * 1000 * (int(vm_id) % 7 + 1)),
+                      '  net.0.tx.bytes=' + str(elapsed * 500), ''])
+    return '\n'.join(lines)
+
+
+def answer(words):
+    if words[0] == 'echo':
+        return ' '.join(words[1:])
+    if LATENCY:
+        time.sleep(LATENCY)
+    if words[0] == 'list':
+        lines = [' Id    Name                           State', '----------------------------------------------------']
+        lines.extend(' ' + vm_id + '     ' + name + '              running' for vm_id, name in DOMAINS)
+        return '\n'.join(lines) + '\n'
+    if words[0] == 'domid':
+        for vm_id, name in DOMAINS:
+            if name == words[1]:
+                return vm_id + '\n'
+    if words[0] == 'domuuid' and words[1] in [vm_id for vm_id, name in DOMAINS]:
+        return 'nova-' + words[1]
+    if words[0] == 'dumpxml' and words[1] in [vm_id for vm_id, name in DOMAINS]:
+        return definition(words[1])
+    if words[0] == 'domstats':
+        return domstats()
+    if words[0] == 'domifstat' and len(words) == 3:
+        return words[2] + ' rx_bytes 1000\n' + words[2] + ' tx_bytes 2000\n'
+    if words[0] == 'args':
+        return '|'.join(words[1:])
+    if words[0] == 'sleep':
+        time.sleep(float(words[1]))
+        return 'slept'
+    sys.stderr.write("error: failed to run '" + ' '.join(words) + "'\n")
+    sys.stderr.flush()
+    return None
+
+
+def split(line):
+    words = []
+    word = ''
+    escaped = False
+    for char in line:
+        if escaped:
+            word += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char.isspace():
+            if word:
+                words.append(word)
+            word = ''
+        else:
+            word += char
+    if word:
+        words.append(word)
+    return words
+
+
+def main():
+    with open(sys.argv[1], 'a') as f:
+        f.write('start\n')
+    if len(sys.argv) > 2:
+        output = answer(sys.argv[2:])
+        if output is None:
+            sys.exit(1)
+        sys.stdout.write(output + '\n')
+        return
+    while True:
+        sys.stdout.write('virsh # ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line:
+            return
+        words = split(line)
+        if not words:
+            continue
+        if words[0] == 'exit':
+            return
+        output = answer(words)
+        if output is not None:
+            sys.stdout.write(output + '\n')
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
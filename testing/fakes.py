@@ -0,0 +1,39 @@
+from code.limit import LimitType
+
+
+class FakeLimits:
+    """
+    LimitCollection stand in giving every tenant the same limit
+    """
+    restricted_limit_name = 'metering_restricted'
+
+    def __init__(self, limit = None, limits = None):
+        """
+        :param limit: LimitType of every tenant. Default metering_blacklist of limits
+        :param limits: dict of name -> LimitType. Default metering_blacklist and metering_restricted
+        """
+        if limits is None:
+            limits = {'metering_blacklist': LimitType('metering_blacklist', 10, 100, 200),
+                      'metering_restricted': LimitType('metering_restricted', 10, 100, 5)}
+        if limit is None:
+            limit = limits['metering_blacklist']
+        self.limits = limits
+        self.limit = limit
+
+    def get_limit_for_tenant(self, tenant):
+        return self.limit
+
+
+
+class FakeQos:
+    """
+    QosReconciler stand in recording the (port id, policy, callback) submitted
+    """
+
+    def __init__(self, submitted = None):
+        if submitted is None:
+            submitted = []
+        self.submitted = submitted
+
+    def submit(self, port_id, policy, callback = None):
+        self.submitted.append((port_id, policy, callback))
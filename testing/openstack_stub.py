@@ -0,0 +1,209 @@
+import json
+import time
+import uuid
+import datetime
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class StubOpenStack(ThreadingMixIn, HTTPServer):
+    """
+    In memory keystone v3, neutron and nova endpoints on localhost, used to test the
+    daemon without an OpenStack cloud. Counts logins, connections and requests.
+    """
+    daemon_threads = True
+    token_lifetime = 3600 #seconds
+    latency = 0 #seconds added to every neutron/nova call
+
+
+    def __init__(self, token_lifetime = 3600, latency = 0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.token_lifetime = token_lifetime
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.logins = 0
+        self.connections = 0
+        self.requests = []
+        self.ports = {} #id -> port
+        self.policies = {} #id -> policy
+        self.rules = {} #policy id -> list of rules
+        self.servers = []
+        self.thread = None
+
+
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+
+    def auth_url(self):
+        return self.url() + '/v3'
+
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+    def add_port(self, mac_address, host = 'compute1', port_id = None):
+        if port_id is None:
+            port_id = str(uuid.uuid4())
+        self.ports[port_id] = {'id': port_id, 'mac_address': mac_address, 'binding:host_id': host,
+                               'qos_policy_id': None}
+        return port_id
+
+
+    def add_policy(self, name, max_kbps = None):
+        policy_id = str(uuid.uuid4())
+        self.policies[policy_id] = {'id': policy_id, 'name': name}
+        self.rules[policy_id] = []
+        if max_kbps is not None:
+            self.rules[policy_id].append({'id': str(uuid.uuid4()), 'max_kbps': max_kbps, 'max_burst_kbps': max_kbps})
+        return policy_id
+
+
+    def policy_name(self, port_id):
+        policy_id = self.ports[port_id]['qos_policy_id']
+        if policy_id is None:
+            return None
+        return self.policies[policy_id]['name']
+
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+
+    def reply(self, status, body = None, headers = None):
+        payload = b''
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key in (headers or {}):
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length == 0:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+    def handle_request(self, method):
+        server = self.server
+        parsed_url = urlparse(self.path)
+        query = parse_qs(parsed_url.query)
+        path = parsed_url.path.rstrip('/').split('/')[1:]
+        body = self.read_body()
+        with server.lock:
+            server.requests.append((method, parsed_url.path))
+        if path == ['v3', 'auth', 'tokens'] and method == 'POST':
+            return self.login(body)
+        if self.headers.get('X-Auth-Token') not in server.tokens:
+            return self.reply(401, {'error': 'unauthorized'})
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            if path[0] == 'nova' and path[-1] == 'servers':
+                return self.reply(200, {'servers': server.servers})
+            if path[0] == 'neutron':
+                return self.neutron(method, path[2:], query, body)
+        self.reply(404, {'error': 'not found'})
+
+
+    def login(self, body):
+        server = self.server
+        user = body['auth']['identity']['password']['user']
+        if user['password'] != 'secret':
+            return self.reply(401, {'error': 'bad password'})
+        token = uuid.uuid4().hex
+        expires = datetime.datetime.utcfromtimestamp(time.time() + server.token_lifetime)
+        with server.lock:
+            server.logins += 1
+            server.tokens.add(token)
+        catalog = [{'type': 'network', 'endpoints': [{'interface': 'public', 'region': 'RegionOne',
+                                                      'url': server.url() + '/neutron'}]},
+                   {'type': 'compute', 'endpoints': [{'interface': 'public', 'region': 'RegionOne',
+                                                      'url': server.url() + '/nova/v2.1'}]}]
+        self.reply(201, {'token': {'expires_at': expires.strftime('%Y-%m-%dT%H:%M:%S.000000Z'), 'catalog': catalog}},
+                   {'X-Subject-Token': token})
+
+
+    def neutron(self, method, path, query, body):
+        server = self.server
+        if path == ['ports'] and method == 'GET':
+            ports = list(server.ports.values())
+            for key in query:
+                if key != 'fields':
+                    ports = [port for port in ports if port.get(key) in query[key]]
+            if 'fields' in query:
+                ports = [dict((field, port[field]) for field in query['fields']) for port in ports]
+            return self.reply(200, {'ports': ports})
+        if len(path) == 2 and path[0] == 'ports' and method == 'PUT':
+            if path[1] not in server.ports:
+                return self.reply(404, {'error': 'no such port'})
+            server.ports[path[1]].update(body['port'])
+            return self.reply(200, {'port': server.ports[path[1]]})
+        if path == ['qos', 'policies'] and method == 'GET':
+            return self.reply(200, {'policies': list(server.policies.values())})
+        if path == ['qos', 'policies'] and method == 'POST':
+            policy_id = server.add_policy(body['policy']['name'])
+            return self.reply(201, {'policy': server.policies[policy_id]})
+        if len(path) >= 4 and path[:2] == ['qos', 'policies'] and path[3] == 'bandwidth_limit_rules':
+            rules = server.rules.get(path[2])
+            if rules is None:
+                return self.reply(404, {'error': 'no such policy'})
+            if len(path) == 4 and method == 'GET':
+                return self.reply(200, {'bandwidth_limit_rules': rules})
+            if len(path) == 4 and method == 'POST':
+                rule = dict(body['bandwidth_limit_rule'], id = str(uuid.uuid4()))
+                rules.append(rule)
+                return self.reply(201, {'bandwidth_limit_rule': rule})
+            if len(path) == 5 and method == 'PUT':
+                for rule in rules:
+                    if rule['id'] == path[4]:
+                        rule.update(body['bandwidth_limit_rule'])
+                        return self.reply(200, {'bandwidth_limit_rule': rule})
+        self.reply(404, {'error': 'not found'})
@@ -214,10 +214,12 @@ class TestStringMethods(unittest.TestCase):
         daemon.get_live_results(vms)
         vm = vms[vms.keys()[0]]
         daemon.get_live_results(vms)
+        daemon.qos.join(60)
         self.assertEqual(self.get_port_rule(vm), "metering_whitelist")
 
         daemon.limits.meter_file_path = os.path.dirname(os.path.realpath(__file__)) + '/meter_default_tenant.yaml'
         daemon.limits.synch_limits(vms)
+        daemon.qos.join(60)
         self.assertEqual(self.get_port_rule(vm), "metering_blacklist")
 
 
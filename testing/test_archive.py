@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.archive import UsageArchive
+from code.usage_query import usage_by_vm, usage_by_tenant, parse_time
+from code.cycle_table import SECONDS_PER_DAY
+
+
+class TestUsageArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = UsageArchive(self.directory, partition_seconds = 100, retention_days = 0)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_window_across_partitions(self):
+        for now in (50, 90, 150, 250):
+            self.archive.append(now, [('nova-a', 'admin', now, 2 * now), ('nova-b', 'test', 10, 20)])
+        self.assertEqual(self.archive.partitions(), [0, 100, 200])
+        self.assertEqual(self.archive.partitions(120, 180), [100])
+        samples = self.archive.window(90, 150)
+        self.assertEqual(list(samples['time']), [90, 90, 150, 150])
+        self.assertEqual(list(samples['rx']), [90, 10, 150, 10])
+        self.assertEqual(len(self.archive.window(300, 400)['time']), 0)
+
+
+    def test_vms_are_kept_after_a_restart(self):
+        self.archive.append(50, [('nova-a', 'admin', 1, 1), ('nova-b', 'test', 2, 2)])
+        reopened = UsageArchive(self.directory, partition_seconds = 100, retention_days = 0)
+        self.assertEqual(reopened.vm_nova_ids, ['nova-a', 'nova-b'])
+        self.assertEqual(reopened.vm_tenants, ['admin', 'test'])
+        reopened.append(60, [('nova-c', 'test', 3, 3), ('nova-a', 'admin', 4, 4)])
+        self.assertEqual(list(reopened.window(0, 100)['vm']), [0, 1, 2, 0])
+
+
+    def test_partial_write_is_cut(self):
+        self.archive.append(50, [('nova-a', 'admin', 1, 1)])
+        with open(os.path.join(self.directory, '0', 'time.f8'), 'ab') as f:
+            f.write(b'\0' * 12)
+        reopened = UsageArchive(self.directory, partition_seconds = 100, retention_days = 0)
+        self.assertEqual(reopened.rows(0), 1)
+        reopened.append(60, [('nova-a', 'admin', 5, 5)])
+        self.assertEqual(list(reopened.window(0, 100)['time']), [50, 60])
+
+
+    def test_old_partitions_expire(self):
+        archive = UsageArchive(self.directory, partition_seconds = SECONDS_PER_DAY, retention_days = 2)
+        archive.append(0, [('nova-a', 'admin', 1, 1)])
+        archive.append(SECONDS_PER_DAY, [('nova-a', 'admin', 2, 2)])
+        archive.append(3 * SECONDS_PER_DAY, [('nova-a', 'admin', 3, 3)])
+        self.assertEqual(archive.partitions(), [SECONDS_PER_DAY, 3 * SECONDS_PER_DAY])
+
+
+
+class TestUsageQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = UsageArchive(self.directory, partition_seconds = 100, retention_days = 0)
+        self.archive.append(10, [('nova-a', 'admin', 100, 1000), ('nova-b', 'admin', 0, 0)])
+        self.archive.append(110, [('nova-a', 'admin', 300, 1500), ('nova-c', 'test', 50, 50)])
+        #nova-a rebooted, its counters start again from 0
+        self.archive.append(210, [('nova-a', 'admin', 40, 60), ('nova-b', 'admin', 70, 80), ('nova-c', 'test', 90, 50)])
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_usage_by_vm(self):
+        usage = usage_by_vm(self.archive, 0, 300)
+        self.assertEqual(usage['nova-a'], {'tenant': 'admin', 'rx_bytes': 240, 'tx_bytes': 560, 'samples': 3})
+        self.assertEqual(usage['nova-b'], {'tenant': 'admin', 'rx_bytes': 70, 'tx_bytes': 80, 'samples': 2})
+        self.assertEqual(usage['nova-c'], {'tenant': 'test', 'rx_bytes': 40, 'tx_bytes': 0, 'samples': 2})
+        self.assertEqual(usage_by_vm(self.archive, 100, 150)['nova-a']['rx_bytes'], 0) #a single sample
+
+
+    def test_usage_by_tenant(self):
+        usage = usage_by_tenant(self.archive, 0, 300)
+        self.assertEqual(usage['admin'], {'rx_bytes': 310, 'tx_bytes': 640, 'vms': 2})
+        self.assertEqual(usage['test'], {'rx_bytes': 40, 'tx_bytes': 0, 'vms': 1})
+        self.assertEqual(usage_by_tenant(self.archive, 100, 150)['test'], {'rx_bytes': 0, 'tx_bytes': 0, 'vms': 1})
+
+
+    def test_empty_archive(self):
+        empty = UsageArchive(os.path.join(self.directory, 'empty'))
+        self.assertEqual(usage_by_vm(empty, 0, 300), {})
+        self.assertEqual(usage_by_tenant(empty, 0, 300), {})
+
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('1000.5'), 1000.5)
+        self.assertEqual(parse_time('1970-01-02'), SECONDS_PER_DAY)
+        self.assertEqual(parse_time('1970-01-01T00:01:00'), 60)
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+if sys.version_info >= (3, 5):
+    #the engine is run from the code directory like startup.py, with its implicit relative imports
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'code'))
+    from async_engine import *
+    from util import breakers
+    from virsh import virsh_cmd, set_session, VirshSession
+    from scheduler import CycleScheduler
+
+
+class FakeDaemon:
+    """
+    Records the stages the engine runs
+    """
+    store = None
+
+    def __init__(self):
+        self.collector = object() #not a VirshCollector, collected by the daemon
+        self.quarantine = Quarantine()
+        self.ports = self
+        self.calls = []
+        self.domain_xml = None
+
+    def refresh_live_vms(self, vms):
+        self.calls.append('refresh_live_vms')
+        return set(['1', '5', '7'])
+
+    def pop_due_vm_ids(self, vms, now):
+        return ['1']
+
+    def collect_counters(self, vms, due_vm_ids, now):
+        self.calls.append('collect_counters')
+        return {'tap1': (10, 20)}
+
+    def refresh(self):
+        self.calls.append('ports')
+
+    def evaluate(self, vms, due_vm_ids, counters, now):
+        self.calls.append('evaluate')
+
+    def add_new_vms(self, vms, live_vm_ids, counters, deadline, domain_xml):
+        self.calls.append('add_new_vms')
+        self.domain_xml = domain_xml
+
+    def report_fleet_usage(self, vms):
+        self.calls.append('report_fleet_usage')
+
+    def checkpoint(self, vms):
+        self.calls.append('checkpoint')
+
+    def poll_limits(self, vms):
+        self.calls.append('poll_limits')
+
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs python 3.5')
+class TestAsyncEngine(unittest.TestCase):
+    """
+    Runs the engine against testing/fake_virsh.py
+    """
+
+    def setUp(self):
+        breakers.clear()
+        set_session(None)
+        self.directory = tempfile.mkdtemp()
+        fake_virsh = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_virsh.py')
+        self.fake_virsh = fake_virsh
+        self.daemon = FakeDaemon()
+        self.engine = AsyncEngine(self.daemon, virsh_concurrency = 4)
+        self.engine.virsh_command = [sys.executable, fake_virsh, os.path.join(self.directory, 'starts')]
+        self.engine.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.engine.loop)
+        self.engine.semaphores = {'virsh': asyncio.Semaphore(4), 'neutron': asyncio.Semaphore(4)}
+
+
+    def tearDown(self):
+        if get_session() is not None:
+            get_session().close()
+            set_session(None)
+        self.engine.loop.close()
+        self.engine.executor.shutdown()
+        shutil.rmtree(self.directory)
+        breakers.clear()
+
+
+    def run_async(self, coroutine):
+        return self.engine.loop.run_until_complete(coroutine)
+
+
+    def test_virsh_calls_overlap(self):
+        start = time.time()
+        calls = asyncio.gather(*[self.engine.virsh(['sleep', '0.5']) for i in range(4)])
+        self.assertEqual(self.run_async(calls), ['slept'] * 4)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertRaises(RuntimeError, self.run_async, self.engine.virsh(['dumpxml', '42']))
+
+
+    def test_virsh_session_is_used(self):
+        starts = os.path.join(self.directory, 'session_starts')
+        set_session(VirshSession([sys.executable, self.fake_virsh, starts], timeout = 2))
+        calls = asyncio.gather(*[self.engine.virsh(['domid', 'instance-0000000' + vm_id]) for vm_id in ('5', '7')])
+        self.assertEqual(self.run_async(calls), ['5', '7'])
+        self.assertRaises(RuntimeError, self.run_async, self.engine.virsh(['dumpxml', '42']))
+        with open(starts) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'starts')))
+
+
+    def test_cycle_reads_new_definitions_together(self):
+        self.run_async(self.engine.cycle({'1': None}, None))
+        self.assertEqual(sorted(self.daemon.domain_xml.keys()), ['5', '7'])
+        self.assertTrue('nova-5' in self.daemon.domain_xml['5'])
+        self.assertEqual(self.daemon.calls[0], 'refresh_live_vms')
+        self.assertEqual(sorted(self.daemon.calls[1:3]), ['collect_counters', 'ports'])
+        self.assertEqual(self.daemon.calls[3:], ['evaluate', 'add_new_vms', 'report_fleet_usage', 'checkpoint'])
+
+
+    def test_wait_polls_the_limits_read_from_file(self):
+        self.daemon.scheduler = CycleScheduler(0.2)
+        self.daemon.scheduler.begin_cycle()
+        self.daemon.limits = self.daemon #read from file, without a store
+        self.daemon.watcher = None
+        self.run_async(self.engine.wait({}))
+        self.assertEqual(self.daemon.calls, ['poll_limits'])
+
+
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio engine needs python 3.5')
+class TestVirshProcess(unittest.TestCase):
+    """
+    Without a virsh session, the blocking commands the engine hands to its executor run
+    'sudo virsh' as its own process, here fake_virsh.py found on PATH
+    """
+
+    def setUp(self):
+        breakers.clear()
+        set_session(None)
+        self.directory = tempfile.mkdtemp()
+        fake_virsh = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_virsh.py')
+        with open(os.path.join(self.directory, 'sudo'), 'w') as f:
+            f.write('#!/bin/sh\nexec "$@"\n')
+        with open(os.path.join(self.directory, 'virsh'), 'w') as f:
+            f.write('#!/bin/sh\nexec ' + sys.executable + ' ' + fake_virsh + ' ' +
+                    os.path.join(self.directory, 'starts') + ' "$@"\n')
+        for name in ('sudo', 'virsh'):
+            os.chmod(os.path.join(self.directory, name), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.directory + os.pathsep + self.path
+
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.directory)
+        breakers.clear()
+
+
+    def test_output_is_text(self):
+        self.assertEqual(virsh_cmd(['domid', 'instance-00000005']), '5')
+        self.assertTrue('nova-7' in virsh_cmd(['dumpxml', '7']))
+
+
+    def test_failure_reports_the_error(self):
+        with self.assertRaises(RuntimeError) as context:
+            virsh_cmd(['dumpxml', '42'], 0)
+        self.assertTrue("error: failed to run 'dumpxml 42'" in str(context.exception))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+
+class TestBenchmark(unittest.TestCase):
+    """
+    Runs the benchmark on a small host, so it keeps working as the daemon changes
+    """
+
+    def run_benchmark(self, *args):
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        output = subprocess.check_output([sys.executable, '-m', 'testing.benchmark', '--sizes', '5', '--cycles', '1'] +
+                                         list(args), cwd = root)
+        return json.loads(output.decode('utf-8'))['results'][0]
+
+
+    def test_session(self):
+        result = self.run_benchmark()
+        self.assertEqual(result['vms'], 5)
+        self.assertEqual(result['first_cycle']['vms_added'], 5)
+        self.assertEqual(result['first_cycle']['virsh_processes'], 1)
+        self.assertTrue(result['qos_drain']['drained'])
+        self.assertEqual(result['load_file']['vms_restored'], 5)
+        self.assertTrue(result['peak_memory_kb'] > 0)
+
+
+    def test_process_per_command(self):
+        result = self.run_benchmark('--virsh', 'process')
+        #virsh list, domstats and one dumpxml per VM
+        self.assertEqual(result['first_cycle']['virsh_processes'], 7)
+        self.assertEqual(result['first_cycle']['subprocesses'], {'virsh': 7})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
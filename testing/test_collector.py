@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.collector import *
+
+
+class TestCollector(unittest.TestCase):
+    """
+    Counter backends that can run without a live hypervisor
+    """
+
+    def setUp(self):
+        self.sysfs_root = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.sysfs_root)
+
+
+    def add_device(self, device, rx_bytes, tx_bytes):
+        statistics = os.path.join(self.sysfs_root, device, 'statistics')
+        os.makedirs(statistics)
+        with open(os.path.join(statistics, 'rx_bytes'), 'w') as f:
+            f.write(str(rx_bytes) + '\n')
+        with open(os.path.join(statistics, 'tx_bytes'), 'w') as f:
+            f.write(str(tx_bytes) + '\n')
+
+
+    def test_sysfs_counters_are_from_the_vm_point_of_view(self):
+        self.add_device('tap1a2b3c4d-5e', 100, 7000000000)
+        collector = SysfsCollector(self.sysfs_root)
+        self.assertEqual(collector.read('1', 'tap1a2b3c4d-5e'), (7000000000, 100))
+
+
+    def test_sysfs_collect_all_taps(self):
+        self.add_device('tap1', 1, 2)
+        self.add_device('tap2', 3, 4)
+        self.add_device('eth0', 5, 6)
+        samples = SysfsCollector(self.sysfs_root).collect()
+        self.assertEqual(samples, {'tap1': (2, 1), 'tap2': (4, 3)})
+
+
+    def test_sysfs_missing_tap(self):
+        collector = SysfsCollector(self.sysfs_root)
+        self.assertEqual(collector.collect(['tap9']), {})
+        self.assertRaises(LookupError, collector.read, '9', 'tap9')
+
+
+    def test_proc_net_dev(self):
+        proc_net_dev = os.path.join(self.sysfs_root, 'dev')
+        with open(proc_net_dev, 'w') as f:
+            f.write('Inter-|   Receive                                                |  Transmit\n'
+                    ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n'
+                    '    lo:    500       5    0    0    0     0          0         0      500       5    0    0    0     0       0          0\n'
+                    'tap1:    100       1    0    0    0     0          0         0      900       9    0    0    0     0       0          0\n')
+        collector = ProcNetDevCollector(proc_net_dev)
+        self.assertEqual(collector.collect(), {'tap1': (900, 100)})
+        self.assertEqual(collector.collect(['lo']), {'lo': (500, 500)})
+
+
+    def test_parse_domstats(self):
+        samples = VirshCollector().parse_domstats("Domain: 'instance-00000001'\n"
+                                                  "  net.count=2\n"
+                                                  "  net.0.name=tap1\n"
+                                                  "  net.0.rx.bytes=100\n"
+                                                  "  net.0.tx.bytes=5\n"
+                                                  "  net.1.name=tap2\n"
+                                                  "  net.1.rx.bytes=7\n"
+                                                  "  net.1.tx.bytes=8\n"
+                                                  "\n"
+                                                  "Domain: 'instance-00000002'\n"
+                                                  "  net.count=1\n"
+                                                  "  net.0.name=tap3\n"
+                                                  "  net.0.rx.bytes=9\n"
+                                                  "  net.0.tx.bytes=10\n")
+        self.assertEqual(samples, {'tap1': (100, 5), 'tap2': (7, 8), 'tap3': (9, 10)})
+
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, get_collector, 'snmp')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from code.cycle_table import *
+from code.limit import LimitType
+
+
+class TestCycleTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = CycleTable(2)
+        self.blacklist = LimitType('metering_blacklist', 10, 100, 200)
+        self.whitelist = LimitType('metering_whitelist', 20, 5000, 1000)
+
+
+    def add(self, date, start_bytes, limit, restricted = False):
+        cycle = self.table.add(date, start_bytes, restricted)
+        self.table.set_limit(cycle.row, limit)
+        return cycle
+
+
+    def test_abuse_and_new_cycle_in_one_pass(self):
+        quiet = self.add(1000, 0, self.blacklist)
+        abuser = self.add(1000, 5, self.blacklist)
+        #grows past the initial capacity
+        heavy = self.add(1000, 0, self.whitelist)
+        expired = self.add(1000, 0, self.blacklist, restricted = True)
+        now = 1000 + 10 * 86400 + 1
+        lifted, abused = self.table.evaluate([quiet.row, abuser.row, heavy.row, expired.row],
+                                             [1000 + 3600, 1000 + 3600, 1000 + 3600, now],
+                                             [10, 100 * BYTES_PER_GB + 6, 200 * BYTES_PER_GB, 7])
+        self.assertEqual(list(lifted), [False, False, False, True])
+        self.assertEqual(list(abused), [False, True, False, False])
+        self.assertTrue(abuser.is_restricted)
+        self.assertFalse(expired.is_restricted)
+        self.assertEqual(expired.date, now)
+        self.assertEqual(expired.start_bytes, 7)
+        self.assertEqual(len(self.table), 4)
+
+
+    def test_counters_are_exact_bytes(self):
+        #exactly at the limit is not abuse, one more byte is
+        cycle = self.add(1000, 123456789, self.blacklist)
+        lifted, abused = self.table.evaluate([cycle.row], [2000], [123456789 + 100 * BYTES_PER_GB])
+        self.assertFalse(abused[0])
+        lifted, abused = self.table.evaluate([cycle.row], [2001], [123456789 + 100 * BYTES_PER_GB + 1])
+        self.assertTrue(abused[0])
+        self.assertEqual(cycle.stringify(), '1000.0, 0.123456789, True')
+
+
+    def test_rows_are_reused(self):
+        first = self.add(1000, 0, self.blacklist)
+        self.add(1000, 0, self.blacklist)
+        self.table.remove(first.row)
+        self.assertEqual(self.add(2000, 0, self.whitelist).row, first.row)
+        self.assertEqual(len(self.table), 2)
+
+
+    def test_usage_since_the_previous_sample(self):
+        rows = [self.add(1000, 0, self.blacklist).row for i in range(4)]
+        self.table.evaluate(rows[:3], [1010] * 3, [100, 200, 300])
+        previous_dates = self.table.last_date[rows]
+        previous_bytes = self.table.last_bytes[rows]
+        #the third counter went back, the fourth row was never sampled before
+        self.table.evaluate(rows[:3] + rows[3:], [1020] * 4, [150, 200, 10, 400])
+        self.assertEqual(list(self.table.usage_since(rows, previous_dates, previous_bytes)), [50, 0, 0, 0])
+
+
+
+    def test_next_sample_time_at_line_rate(self):
+        table = CycleTable(2, line_rate = 1) #125 MB/s
+        cycle = table.add(1000, 0)
+        table.set_limit(cycle.row, self.blacklist)
+        self.assertEqual(list(table.next_sample_time([cycle.row])), [0])
+        table.evaluate([cycle.row], [1010], [50 * BYTES_PER_GB])
+        self.assertAlmostEqual(table.next_sample_time([cycle.row])[0], 1010 + 400, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from code.enforcer import *
+from code.limit import LimitType
+from code.vm import Vm, Cycle
+from testing.fakes import FakeLimits, FakeQos
+
+testing_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class EnforcerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_fname = os.path.join(self.directory, 'tc.json')
+        self.limits = FakeLimits(limits = {'metering_blacklist': LimitType('metering_blacklist', 10, 100, 200),
+                                           'metering_restricted': LimitType('metering_restricted', 10, 100, 5)})
+        backend = TcBackend([sys.executable, os.path.join(testing_dir, 'fake_tc.py'), self.state_fname])
+        self.enforcer = LocalEnforcer(backend, self.limits, handoff_delay = 30)
+
+
+    def tearDown(self):
+        os.environ.pop('FAKE_TC_FAIL', None)
+        shutil.rmtree(self.directory)
+
+
+    def filters(self, tap_interface):
+        if not os.path.exists(self.state_fname):
+            return {}
+        with open(self.state_fname) as f:
+            return json.load(f)['filters'].get(tap_interface, {})
+
+
+
+class TestLocalEnforcer(EnforcerTestCase):
+
+    def test_restrict_and_hand_off(self):
+        self.enforcer.restrict('tap5')
+        self.assertEqual(self.filters('tap5'), {'1': 'police rate 5kbit burst 64k conform-exceed drop'})
+        self.assertEqual(len(self.enforcer), 1)
+        #the ingress qdisc already exists the second time
+        self.enforcer.enforced.clear()
+        self.enforcer.restrict('tap5')
+        self.assertEqual(len(self.enforcer), 1)
+        now = time.time()
+        self.enforcer.confirm('tap5', 'metering_blacklist')
+        self.enforcer.reconcile(set(['tap5']), now + 60)
+        self.assertEqual(len(self.enforcer), 1)
+        self.enforcer.confirm('tap5', 'metering_restricted')
+        self.enforcer.reconcile(set(['tap5']), now + 10)
+        self.assertEqual(len(self.filters('tap5')), 1)
+        self.enforcer.reconcile(set(['tap5']), now + 60)
+        self.assertEqual(self.filters('tap5'), {})
+        self.assertEqual(len(self.enforcer), 0)
+
+
+    def test_release_removes_right_away(self):
+        self.enforcer.restrict('tap5')
+        self.enforcer.release('tap5')
+        self.assertEqual(self.filters('tap5'), {})
+        self.enforcer.release('tap7')
+        self.assertEqual(len(self.enforcer), 0)
+
+
+    def test_failures_do_not_raise(self):
+        os.environ['FAKE_TC_FAIL'] = '1'
+        self.enforcer.restrict('tap5')
+        self.assertEqual(len(self.enforcer), 0)
+        #a filter left by a previous run that is not there any more
+        del os.environ['FAKE_TC_FAIL']
+        self.enforcer.adopt('tap7')
+        self.enforcer.reconcile(set(['tap7']))
+        self.assertEqual(len(self.enforcer), 0)
+
+
+    def test_gone_taps_are_forgotten(self):
+        self.enforcer.restrict('tap5')
+        self.enforcer.restrict('tap7')
+        self.enforcer.reconcile(set(['tap7']))
+        self.assertEqual(sorted(self.enforcer.enforced.keys()), ['tap7'])
+
+
+    def test_get_enforcer(self):
+        self.assertEqual(get_enforcer('none', self.limits), None)
+        self.assertTrue(isinstance(get_enforcer('ovs', self.limits).backend, OvsBackend))
+        self.assertRaises(ValueError, get_enforcer, 'iptables', self.limits)
+
+
+
+class TestVmEnforcement(EnforcerTestCase):
+    """
+    A restored VM, so neither virsh nor neutron are needed
+    """
+
+    def make_vm(self, restricted = False, applied_policy = 'metering_blacklist'):
+        metadata = {'nova_id': 'nova-5', 'tap_interface': 'tap5', 'mac_address': 'fa:16:3e:00:00:05',
+                    'tenant': 'test', 'port_id': 'port5', 'applied_policy': applied_policy}
+        self.submitted = []
+        self.qos = FakeQos(self.submitted)
+        return Vm('5', self.limits, Cycle(time.time(), 1.0, restricted), metadata = metadata, qos = self.qos,
+                  enforcer = self.enforcer)
+
+
+    def test_abuse_is_enforced_until_neutron_confirms(self):
+        vm = self.make_vm()
+        vm.table.restricted[vm.cycle.row] = True
+        vm.finish_cycle(False, True, 'metering_restricted')
+        self.assertEqual(len(self.filters('tap5')), 1)
+        port_id, policy, callback = self.submitted[-1]
+        self.assertEqual((port_id, policy), ('port5', 'metering_restricted'))
+        callback(policy)
+        self.assertEqual(vm.applied_policy, 'metering_restricted')
+        self.enforcer.reconcile(set(['tap5']), time.time() + 60)
+        self.assertEqual(self.filters('tap5'), {})
+
+
+    def test_lifted_restriction_is_released(self):
+        vm = self.make_vm(restricted = True, applied_policy = 'metering_blacklist')
+        #restored restricted without the restricted policy, so enforced again right away
+        self.assertEqual(len(self.filters('tap5')), 1)
+        vm.table.restricted[vm.cycle.row] = False
+        vm.finish_cycle(True, False, 'metering_restricted')
+        self.assertEqual(self.filters('tap5'), {})
+        self.assertEqual(self.submitted[-1][1], 'metering_blacklist')
+
+
+    def test_restored_restriction_already_applied_is_adopted(self):
+        vm = self.make_vm(restricted = True, applied_policy = 'metering_restricted')
+        self.assertFalse(vm.state_change_required)
+        self.assertEqual(self.filters('tap5'), {})
+        self.assertEqual(len(self.enforcer), 1)
+
+
+    def test_own_restriction_outlives_the_fleet_one(self):
+        vm = self.make_vm()
+        vm.table.restricted[vm.cycle.row] = True
+        vm.set_fleet_restricted(True, 'metering_restricted')
+        vm.set_fleet_restricted(False, 'metering_restricted')
+        self.assertEqual(self.submitted[-1][:2], ('port5', 'metering_restricted'))
+        self.assertEqual(len(self.filters('tap5')), 1)
+
+
+    def test_abuse_keeps_the_limit_without_enforcer(self):
+        vm = self.make_vm()
+        vm.enforcer = None
+        vm.table.restricted[vm.cycle.row] = True
+        vm.finish_cycle(False, True, 'metering_restricted')
+        self.assertEqual(self.submitted[-1][:2], ('port5', 'metering_blacklist'))
+        self.assertEqual(self.filters('tap5'), {})
+
+
+    def test_new_restricted_limit_is_pushed(self):
+        vm = self.make_vm(restricted = True, applied_policy = 'metering_restricted')
+        self.limits.restricted_limit_name = 'metering_whitelist'
+        vm.set_limit(self.limits)
+        self.assertEqual(self.submitted[-1][:2], ('port5', 'metering_whitelist'))
+        #unchanged limits push nothing
+        self.submitted[-1][2]('metering_whitelist')
+        vm.set_limit(self.limits)
+        self.assertEqual(len(self.submitted), 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import time
+import socket
+import unittest
+from code.fleet import *
+from code.util import breakers
+from code.vm import Vm, Cycle
+from testing.fakes import FakeLimits, FakeQos
+
+
+class TestFleetAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = FleetAggregator({'admin': 10}, 1, period = 1, now = 0)
+
+
+    def test_tenant_totals_across_nodes(self):
+        self.assertEqual(self.aggregator.apply('compute1', 1, {'admin': 6 * BYTES_PER_GB, 'test': BYTES_PER_GB / 2}, 10), [])
+        self.assertEqual(self.aggregator.apply('compute2', 1, {'admin': 5 * BYTES_PER_GB}, 10), ['admin'])
+        self.assertEqual(self.aggregator.apply('compute3', 1, {'test': BYTES_PER_GB}, 10), ['admin', 'test'])
+        usage = self.aggregator.usage()
+        self.assertAlmostEqual(usage['admin']['used_gb'], 11)
+        self.assertAlmostEqual(usage['test']['quota_gb'], 1)
+
+
+    def test_batch_sent_again_is_counted_once(self):
+        self.aggregator.apply('compute1', 1, {'test': BYTES_PER_GB}, 10)
+        self.aggregator.apply('compute1', 1, {'test': BYTES_PER_GB}, 10)
+        self.assertAlmostEqual(self.aggregator.usage()['test']['used_gb'], 1)
+
+
+    def test_totals_start_again_with_the_period(self):
+        self.aggregator.apply('compute1', 1, {'test': 2 * BYTES_PER_GB}, 10)
+        self.assertEqual(self.aggregator.apply('compute1', 2, {'test': 1}, SECONDS_PER_DAY + 10), [])
+        self.assertEqual(self.aggregator.window_start, SECONDS_PER_DAY)
+
+
+    def test_quota_file(self):
+        aggregator = load_quota_file(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fleet.yaml'))
+        self.assertEqual(aggregator.quotas['test'], 50 * BYTES_PER_GB)
+        self.assertEqual(aggregator.default_quota, 1000 * BYTES_PER_GB)
+
+
+
+class TestFleetClient(unittest.TestCase):
+    """
+    Several daemons pushing to an aggregator on localhost
+    """
+
+    def setUp(self):
+        breakers.clear()
+        self.aggregator = FleetAggregator({}, 1)
+        self.server = AggregatorServer(self.aggregator, 0, 'secret').start()
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+
+    def tearDown(self):
+        self.server.stop()
+        breakers.clear()
+
+
+    def test_tenant_spread_over_nodes_is_restricted(self):
+        clients = [FleetClient(self.url, 'secret', 'compute' + str(i)) for i in range(3)]
+        for client in clients:
+            client.add('test', 0.4 * BYTES_PER_GB)
+            client.add('admin', 0.1 * BYTES_PER_GB)
+        self.assertEqual(clients[0].push(), set())
+        self.assertEqual(clients[1].push(), set())
+        self.assertEqual(clients[2].push(), set(['test']))
+        self.assertEqual(clients[0].push(), set()) #nothing to send
+        clients[0].add('test', 1)
+        self.assertEqual(clients[0].push(), set(['test']))
+        self.assertAlmostEqual(self.aggregator.usage()['test']['used_gb'], 1.2)
+
+
+    def test_usage_is_kept_while_the_aggregator_is_down(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        client = FleetClient('http://127.0.0.1:' + str(listener.getsockname()[1]), 'secret', 'compute1', timeout = 1)
+        listener.close()
+        client.add('test', 100)
+        self.assertRaises(socket.error, client.push)
+        client.add('test', 50)
+        client.url = self.url
+        client.push()
+        self.assertEqual(self.aggregator.totals, {'test': 150})
+        self.assertEqual(client.pending, None)
+        self.assertEqual(client.accumulated, {})
+
+
+    def test_wrong_token_is_refused(self):
+        self.assertEqual(self.server.server_address[0], '127.0.0.1')
+        client = FleetClient(self.url, 'guess', 'compute1')
+        client.add('test', 2 * BYTES_PER_GB)
+        self.assertRaises(RuntimeError, client.push)
+        self.assertEqual(self.aggregator.totals, {})
+        connection = httplib.HTTPConnection(self.server.server_address[0], self.server.server_address[1])
+        connection.request('GET', '/v1/tenants')
+        self.assertEqual(connection.getresponse().status, 401)
+        connection.close()
+        self.assertRaises(ValueError, AggregatorServer, self.aggregator, 0, '')
+
+
+
+class TestFleetRestriction(unittest.TestCase):
+    """
+    The VMs of a tenant over its fleet wide quota, restored so neither virsh nor neutron are needed
+    """
+
+    def setUp(self):
+        metadata = {'nova_id': 'nova-5', 'tap_interface': 'tap5', 'mac_address': 'fa:16:3e:00:00:05',
+                    'tenant': 'test', 'port_id': 'port5', 'applied_policy': 'metering_blacklist'}
+        self.qos = FakeQos()
+        self.vm = Vm('5', FakeLimits(), Cycle(time.time(), 1.0), metadata = metadata, qos = self.qos)
+
+
+    def test_restricted_until_the_tenant_is_back_under_quota(self):
+        self.vm.set_fleet_restricted(True, 'metering_restricted')
+        self.assertEqual([submitted[:2] for submitted in self.qos.submitted], [('port5', 'metering_restricted')])
+        self.vm.set_fleet_restricted(True, 'metering_restricted')
+        self.assertEqual(len(self.qos.submitted), 1)
+        self.vm.set_fleet_restricted(False, 'metering_restricted')
+        self.assertEqual(self.qos.submitted[-1][:2], ('port5', 'metering_blacklist'))
+
+
+    def test_own_restriction_needs_a_local_enforcer(self):
+        self.vm.table.restricted[self.vm.cycle.row] = True
+        self.vm.set_fleet_restricted(True, 'metering_restricted')
+        self.vm.set_fleet_restricted(False, 'metering_restricted')
+        self.assertEqual(self.qos.submitted[-1][:2], ('port5', 'metering_blacklist'))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.journal import *
+
+
+class TestJournal(unittest.TestCase):
+
+    header = 'vm id, date(unix time), date (GB), restricted(t/f)'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'recovery.txt')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def journal_lines(self):
+        if not os.path.exists(self.fname + '.journal'):
+            return []
+        with open(self.fname + '.journal') as f:
+            return f.readlines()
+
+
+    def test_only_changes_are_appended(self):
+        journal = StateJournal(self.fname, self.header)
+        journal.write({'1': '1, 10.0, 0.5, False', '2': '2, 10.0, 0.7, False'})
+        self.assertEqual(len(self.journal_lines()), 2)
+        journal.write({'1': '1, 10.0, 0.5, False', '2': '2, 10.0, 0.7, False'})
+        self.assertEqual(len(self.journal_lines()), 2)
+        journal.write({'1': '1, 10.0, 0.5, True'})
+        self.assertEqual(self.journal_lines()[2:], ['+ 1, 10.0, 0.5, True\n', '- 2\n'])
+        self.assertEqual(read_entries(self.fname), {'1': '1, 10.0, 0.5, True'})
+
+
+    def test_compaction(self):
+        journal = StateJournal(self.fname, self.header, 'never', 3)
+        journal.write({'1': '1, 10.0, 0.5, False'})
+        journal.write({'1': '1, 11.0, 0.5, False'})
+        journal.write({'1': '1, 12.0, 0.5, False', '2': '2, 12.0, 0.5, False'})
+        self.assertEqual(self.journal_lines(), [])
+        with open(self.fname) as f:
+            self.assertEqual(f.readline(), self.header + '\n')
+        self.assertEqual(StateJournal(self.fname, self.header).load(),
+                         {'1': '1, 12.0, 0.5, False', '2': '2, 12.0, 0.5, False'})
+
+
+    def test_recover_ignores_partial_write(self):
+        journal = StateJournal(self.fname, self.header, 'always')
+        journal.write({'1': '1, 10.0, 0.5, False'})
+        with open(self.fname + '.journal', 'a') as f:
+            f.write('+ 1, 20.0, 0.')
+        journal = StateJournal(self.fname, self.header)
+        self.assertEqual(journal.load(), {'1': '1, 10.0, 0.5, False'})
+        self.assertEqual(self.journal_lines(), [])
+
+
+    def test_bad_fsync_policy(self):
+        self.assertRaises(ValueError, StateJournal, self.fname, self.header, 'sometimes')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
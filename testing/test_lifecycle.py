@@ -0,0 +1,81 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from code.lifecycle import *
+
+
+class TestLifecycle(unittest.TestCase):
+    """
+    Lifecycle watchers against a fake libvirt runtime directory and a fake virsh event stream
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.touch('instance-00000001.xml')
+        self.touch('instance-00000001.pid')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def touch(self, name):
+        open(os.path.join(self.directory, name), 'w').close()
+
+
+    def wait_for_events(self, watcher, count):
+        events = []
+        deadline = time.time() + 10
+        while len(events) < count and time.time() < deadline:
+            watcher.wakeup.wait(0.5)
+            events.extend(watcher.poll())
+        return events
+
+
+    def check_runtime_dir(self, watcher):
+        watcher.start()
+        time.sleep(0.2)
+        self.touch('instance-00000002.xml')
+        #libvirt writes the status file to a temporary name first
+        self.touch('instance-00000003.xml.new')
+        os.rename(os.path.join(self.directory, 'instance-00000003.xml.new'),
+                  os.path.join(self.directory, 'instance-00000003.xml'))
+        os.remove(os.path.join(self.directory, 'instance-00000001.xml'))
+        events = self.wait_for_events(watcher, 3)
+        self.assertEqual(sorted(events), [(STARTED, 'instance-00000002'), (STARTED, 'instance-00000003'),
+                                          (STOPPED, 'instance-00000001')])
+
+
+    def test_runtime_dir_inotify(self):
+        self.check_runtime_dir(RuntimeDirWatcher(self.directory))
+
+
+    def test_runtime_dir_listing(self):
+        self.check_runtime_dir(RuntimeDirWatcher(self.directory, use_inotify = False, poll_interval = 0.1))
+
+
+    def test_virsh_event(self):
+        watcher = VirshEventWatcher(['sh', '-c', 'echo "event \'lifecycle\' for domain instance-0000000a: Started Booted"; '
+                                                 'echo "event \'agent-lifecycle\' for domain instance-0000000a: state"; '
+                                                 'echo "event \'lifecycle\' for domain instance-0000000b: Suspended Paused"; '
+                                                 'echo "event \'lifecycle\' for domain instance-0000000b: Stopped Destroyed"; '
+                                                 'sleep 2'])
+        watcher.start()
+        self.assertEqual(self.wait_for_events(watcher, 2), [(STARTED, 'instance-0000000a'),
+                                                             (STOPPED, 'instance-0000000b')])
+
+
+    def test_virsh_event_falls_back_to_runtime_dir(self):
+        watcher = VirshEventWatcher(['false'], fallback_path = self.directory)
+        watcher.restart_delay = 0
+        watcher.start()
+        time.sleep(0.5)
+        self.touch('instance-00000002.xml')
+        self.assertEqual(self.wait_for_events(watcher, 1), [(STARTED, 'instance-00000002')])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
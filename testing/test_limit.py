@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.limit import *
+from code.openstack import *
+from testing.openstack_stub import StubOpenStack
+
+
+class FakeVm:
+    tenant = ''
+
+    def __init__(self, tenant, failures = 0, restricted = False):
+        """
+        :param failures: number of calls to set_limit that fail before it works
+        :param restricted: True if the VM is over its quota
+        """
+        self.tenant = tenant
+        self.set_limit_calls = 0
+        self.failures = failures
+        self.restricted = restricted
+
+    def set_limit(self, limits):
+        self.set_limit_calls += 1
+        if self.set_limit_calls <= self.failures:
+            raise RuntimeError('neutron is down')
+
+
+    def policy(self, restricted_limit_name):
+        if self.restricted:
+            return restricted_limit_name
+        return 'metering_blacklist'
+
+
+
+class TestLimitCollection(unittest.TestCase):
+    """
+    Resynching the limit file against a local stub of neutron
+    """
+
+    def setUp(self):
+        self.stub = StubOpenStack().start()
+        set_client(OpenStackClient(self.stub.auth_url(), 'admin', 'secret', 'admin'))
+        self.directory = tempfile.mkdtemp()
+        self.testing_directory = os.path.dirname(os.path.realpath(__file__))
+
+
+    def tearDown(self):
+        get_client().close()
+        set_client(None)
+        self.stub.stop()
+        shutil.rmtree(self.directory)
+
+
+    def limit_collection(self, meter_file):
+        return LimitCollection(os.path.join(self.testing_directory, meter_file))
+
+
+    def neutron_writes(self):
+        return [request for request in self.stub.requests if request[0] in ('POST', 'PUT') and 'neutron' in request[1]]
+
+
+    def test_unchanged_file_is_skipped(self):
+        limits = self.limit_collection('meter.yaml')
+        self.assertEqual(len(self.stub.policies), 3)
+        requests = len(self.stub.requests)
+        vms = {'1': FakeVm('admin')}
+        limits.vms_by_tenant.update(vms)
+        limits.synch_limits(vms)
+        self.assertEqual(len(self.stub.requests), requests)
+        self.assertEqual(vms['1'].set_limit_calls, 0)
+
+
+    def test_only_changed_limits_and_tenants_are_updated(self):
+        limits = self.limit_collection('meter.yaml')
+        writes = len(self.neutron_writes())
+        vms = {'1': FakeVm('admin'), '2': FakeVm('test'), '3': FakeVm('other')}
+        limits.vms_by_tenant.update(vms)
+        #meter_double.yaml only changes metering_whitelist, used by the admin tenant
+        limits.meter_file_path = os.path.join(self.testing_directory, 'meter_double.yaml')
+        limits.synch_limits(vms)
+        self.assertEqual(len(self.neutron_writes()), writes + 1)
+        self.assertEqual(limits.get_limit_for_tenant('admin').band_limit, 10000)
+        self.assertEqual([vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [1, 0, 0])
+
+
+    def test_tenant_moved_to_default(self):
+        limits = self.limit_collection('meter_double.yaml')
+        vms = {'1': FakeVm('admin'), '2': FakeVm('test')}
+        limits.vms_by_tenant.update(vms)
+        limits.meter_file_path = os.path.join(self.testing_directory, 'meter_default_tenant.yaml')
+        limits.synch_limits(vms)
+        self.assertEqual(limits.get_limit_for_tenant('admin').name, 'metering_blacklist')
+        self.assertEqual([vms[vm_id].set_limit_calls for vm_id in ('1', '2')], [1, 0])
+
+
+    def test_failed_vm_is_retried(self):
+        limits = self.limit_collection('meter.yaml')
+        vms = {'1': FakeVm('admin', failures = 1), '2': FakeVm('admin'), '3': FakeVm('test')}
+        limits.vms_by_tenant.update(vms)
+        limits.meter_file_path = os.path.join(self.testing_directory, 'meter_double.yaml')
+        limits.synch_limits(vms)
+        self.assertEqual([vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [1, 1, 0])
+        self.assertEqual(limits.pending_vm_ids, set(['1']))
+        self.assertTrue(limits.changed())
+        #the file did not change since, only the failed VM is tried again
+        limits.synch_limits(vms)
+        self.assertEqual([vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [2, 1, 0])
+        self.assertFalse(limits.changed())
+
+
+    def test_new_restricted_limit_moves_restricted_vms(self):
+        limits = self.limit_collection('meter.yaml')
+        vms = {'1': FakeVm('test', restricted = True), '2': FakeVm('test'), '3': FakeVm('admin', restricted = True)}
+        limits.vms_by_tenant.update(vms)
+        meter_file = os.path.join(self.directory, 'meter.yaml')
+        with open(meter_file, 'w') as f:
+            with open(os.path.join(self.testing_directory, 'meter.yaml')) as original:
+                f.write(original.read().replace('restricted: metering_restricted', 'restricted: metering_whitelist'))
+        limits.meter_file_path = meter_file
+        limits.synch_limits(vms)
+        self.assertEqual(limits.restricted_limit_name, 'metering_whitelist')
+        self.assertEqual([vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [1, 0, 1])
+
+
+    def test_tenant_index(self):
+        index = TenantIndex()
+        index.update({'1': FakeVm('admin'), '2': FakeVm('admin'), '3': FakeVm('test')})
+        self.assertEqual(sorted(index.vm_ids('admin')), ['1', '2'])
+        #virsh id reused by a VM of another tenant
+        index.add('2', 'test')
+        self.assertEqual(index.vm_ids('admin'), ['1'])
+        self.assertEqual(sorted(index.vm_ids('test')), ['2', '3'])
+        index.remove('1')
+        index.remove('4')
+        self.assertEqual(sorted(index.tenants()), ['test'])
+        self.assertEqual(len(index), 2)
+
+
+    def test_invalid_file_keeps_previous_limits(self):
+        limits = self.limit_collection('meter.yaml')
+        meter_file = os.path.join(self.directory, 'meter.yaml')
+        with open(meter_file, 'w') as f:
+            f.write('default: metering_blacklist\nrestricted: metering_restricted\nmeters: {}\n'
+                    'tenants:\n   admin: metering_gold\n')
+        limits.meter_file_path = meter_file
+        self.assertRaises(ValueError, limits.synch_limits, {})
+        self.assertEqual(limits.get_limit_for_tenant('admin').name, 'metering_whitelist')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
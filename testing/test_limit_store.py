@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.limit_store import *
+from code.limit import LimitCollection
+from code.openstack import *
+from testing.openstack_stub import StubOpenStack
+from testing.test_limit import FakeVm
+
+testing_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestLimitStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = LimitStore(os.path.join(self.directory, 'limits.db'))
+
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+
+    def test_import_only_writes_what_changed(self):
+        self.assertEqual(self.store.version(), 0)
+        self.assertEqual(self.store.changes_since(0), None)
+        version = self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml'))
+        self.assertEqual(version, 1)
+        self.assertEqual(self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml')), 1)
+        #meter_double.yaml only changes metering_whitelist
+        self.assertEqual(self.store.import_meter_file(os.path.join(testing_dir, 'meter_double.yaml')), 2)
+        changes = self.store.changes_since(1)
+        self.assertEqual(list(changes['meters'].keys()), ['metering_whitelist'])
+        self.assertEqual(changes['meters']['metering_whitelist'].band_limit, 10000)
+        self.assertEqual(changes['tenants'], {})
+        limits, tenants, default_limit_name, restricted_limit_name = self.store.definitions()
+        self.assertEqual(sorted(limits.keys()), ['metering_blacklist', 'metering_restricted', 'metering_whitelist'])
+        self.assertEqual(tenants, {'admin': 'metering_whitelist', 'test': 'metering_blacklist'})
+        self.assertEqual((default_limit_name, restricted_limit_name), ('metering_blacklist', 'metering_restricted'))
+
+
+    def test_tenant_changes_and_deletions(self):
+        self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml'))
+        self.assertEqual(self.store.set_tenant('test', 'metering_whitelist'), 2)
+        self.assertEqual(self.store.set_tenant('test', 'metering_whitelist'), 2)
+        self.assertEqual(self.store.delete_tenant('admin'), 3)
+        changes = self.store.changes_since(1)
+        self.assertEqual(changes['version'], 3)
+        self.assertEqual(changes['tenants'], {'test': 'metering_whitelist', 'admin': None})
+        self.assertEqual(self.store.changes_since(2)['tenants'], {'admin': None})
+        self.assertTrue('admin' not in self.store.definitions()[1])
+
+
+    def test_invalid_changes_are_refused(self):
+        self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml'))
+        self.assertRaises(ValueError, self.store.set_tenant, 'test', 'metering_gold')
+        self.assertRaises(ValueError, self.store.delete_meter, 'metering_whitelist')
+        self.assertRaises(ValueError, self.store.set_default, 'metering_gold')
+        self.assertEqual(self.store.version(), 1)
+        self.store.set_meter('metering_gold', 30, 10000, 2000)
+        self.store.set_tenant('test', 'metering_gold')
+        self.assertEqual(self.store.definitions()[0]['metering_gold'].time_period, 30)
+
+
+    def test_changes_are_seen_by_other_connections(self):
+        other = LimitStore(self.store.fname)
+        self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml'))
+        self.assertEqual(other.version(), 1)
+        self.assertEqual(other.changes_since(0)['tenants']['admin'], 'metering_whitelist')
+        other.close()
+
+
+
+class TestLimitCollectionStore(unittest.TestCase):
+    """
+    Applying the changes of the store against a local stub of neutron
+    """
+
+    def setUp(self):
+        self.stub = StubOpenStack().start()
+        set_client(OpenStackClient(self.stub.auth_url(), 'admin', 'secret', 'admin'))
+        self.directory = tempfile.mkdtemp()
+        self.store = LimitStore(os.path.join(self.directory, 'limits.db'))
+        self.store.import_meter_file(os.path.join(testing_dir, 'meter.yaml'))
+        self.limits = LimitCollection(os.path.join(self.directory, 'missing.yaml'), self.store)
+        self.vms = {'1': FakeVm('admin'), '2': FakeVm('test'), '3': FakeVm('other')}
+        self.limits.vms_by_tenant.update(self.vms)
+
+
+    def tearDown(self):
+        get_client().close()
+        set_client(None)
+        self.stub.stop()
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+
+    def neutron_writes(self):
+        return [request for request in self.stub.requests if request[0] in ('POST', 'PUT') and 'neutron' in request[1]]
+
+
+    def test_loaded_from_the_store(self):
+        self.assertEqual(self.limits.get_limit_for_tenant('admin').name, 'metering_whitelist')
+        self.assertEqual(self.limits.get_limit_for_tenant('other').name, 'metering_blacklist')
+        self.assertEqual(self.limits.restricted_limit_name, 'metering_restricted')
+        self.assertEqual(len(self.stub.policies), 3)
+        self.assertFalse(self.limits.changed())
+
+
+    def test_tenant_move_only_updates_its_vms(self):
+        writes = len(self.neutron_writes())
+        self.store.set_tenant('other', 'metering_whitelist')
+        self.assertTrue(self.limits.changed())
+        self.limits.synch_limits(self.vms)
+        self.assertFalse(self.limits.changed())
+        self.assertEqual(self.limits.get_limit_for_tenant('other').name, 'metering_whitelist')
+        self.assertEqual([self.vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [0, 0, 1])
+        self.assertEqual(len(self.neutron_writes()), writes)
+
+
+    def test_changed_meter_is_pushed_to_neutron(self):
+        writes = len(self.neutron_writes())
+        self.store.set_meter('metering_whitelist', 20, 10000, 1000)
+        self.limits.synch_limits(self.vms)
+        self.assertEqual(len(self.neutron_writes()), writes + 1)
+        self.assertEqual(self.limits.get_limit_for_tenant('admin').band_limit, 10000)
+        self.assertEqual([self.vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [1, 0, 0])
+
+
+    def test_deleted_tenant_falls_back_to_default(self):
+        self.store.delete_tenant('admin')
+        self.limits.synch_limits(self.vms)
+        self.assertEqual(self.limits.get_limit_for_tenant('admin').name, 'metering_blacklist')
+        self.assertEqual([self.vms[vm_id].set_limit_calls for vm_id in ('1', '2', '3')], [1, 0, 0])
+
+
+    def test_empty_store_is_refused(self):
+        empty = LimitStore(os.path.join(self.directory, 'empty.db'))
+        self.assertRaises(ValueError, LimitCollection, os.path.join(self.directory, 'missing.yaml'), empty)
+        empty.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
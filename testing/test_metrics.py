@@ -0,0 +1,91 @@
+import unittest
+import code.util
+from code.metrics import *
+from code.util import *
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+
+    def test_counter_per_label(self):
+        counter = self.registry.add('test_calls_total', 'Calls', 'counter', ['backend'])
+        counter.labels('virsh').inc()
+        counter.labels('virsh').inc(2)
+        counter.labels('neutron').inc()
+        text = self.registry.render()
+        self.assertIn('# TYPE test_calls_total counter\n', text)
+        self.assertIn('test_calls_total{backend="virsh"} 3.0\n', text)
+        self.assertIn('test_calls_total{backend="neutron"} 1.0\n', text)
+        self.assertRaises(ValueError, counter.labels)
+
+
+    def test_gauge(self):
+        gauge = self.registry.add('test_vms', 'VMs', 'gauge')
+        gauge.set(7)
+        gauge.set(4)
+        self.assertIn('test_vms 4.0\n', self.registry.render())
+
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.add('test_seconds', 'Seconds', 'histogram', ['stage'], [0.1, 1])
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.labels('discovery').observe(value)
+        text = self.registry.render()
+        self.assertIn('test_seconds_bucket{stage="discovery",le="0.1"} 1.0\n', text)
+        self.assertIn('test_seconds_bucket{stage="discovery",le="1.0"} 3.0\n', text)
+        self.assertIn('test_seconds_bucket{stage="discovery",le="+Inf"} 4.0\n', text)
+        self.assertIn('test_seconds_sum{stage="discovery"} 4.25\n', text)
+        self.assertIn('test_seconds_count{stage="discovery"} 4.0\n', text)
+
+
+    def test_label_values_are_escaped(self):
+        counter = self.registry.add('test_total', 'Total', 'counter', ['name'])
+        counter.labels('a"b\\c').inc()
+        self.assertIn('test_total{name="a\\"b\\\\c"} 1.0\n', self.registry.render())
+
+
+    def test_stage_timer(self):
+        before = stage_duration.labels('test_stage').count
+        with stage_timer('test_stage'):
+            pass
+        self.assertEqual(stage_duration.labels('test_stage').count, before + 1)
+
+
+    def test_subprocesses_and_retries_are_counted(self):
+        backoff_base = code.util.backoff_base
+        code.util.backoff_base = 0.01
+        try:
+            launched = subprocesses.labels('other').value
+            retried = retries.labels('other').value
+            subprocess_cmd('echo hello')
+            self.assertRaises(RuntimeError, subprocess_cmd, 'false', 2)
+        finally:
+            code.util.backoff_base = backoff_base
+        self.assertEqual(subprocesses.labels('other').value, launched + 4)
+        self.assertEqual(retries.labels('other').value, retried + 2)
+
+
+    def test_server(self):
+        self.registry.add('test_vms', 'VMs', 'gauge').set(3)
+        server = MetricsServer(self.registry, 0).start()
+        try:
+            url = 'http://127.0.0.1:' + str(server.server_address[1])
+            response = urlopen(url + '/metrics')
+            self.assertTrue(response.info().get('Content-Type').startswith('text/plain'))
+            self.assertIn('test_vms 3.0', response.read().decode('utf-8'))
+            self.assertRaises(HTTPError, urlopen, url + '/other')
+        finally:
+            server.stop()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
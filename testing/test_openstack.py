@@ -0,0 +1,103 @@
+import time
+import unittest
+from code.openstack import *
+from code.ports import *
+from code.limit import LimitType
+from code.util import breakers, CircuitOpenError
+from testing.openstack_stub import StubOpenStack
+
+
+class TestOpenStackClient(unittest.TestCase):
+    """
+    Runs the client against a local stub of keystone, neutron and nova
+    """
+
+    def setUp(self):
+        breakers.clear()
+        self.stub = StubOpenStack().start()
+        self.client = OpenStackClient(self.stub.auth_url(), 'admin', 'secret', 'admin')
+        set_client(self.client)
+
+
+    def tearDown(self):
+        get_client().close()
+        set_client(None)
+        self.stub.stop()
+
+
+    def test_token_and_connections_are_reused(self):
+        for i in range(5):
+            self.client.list_servers()
+            self.client.list_qos_policies()
+        self.assertEqual(self.stub.logins, 1)
+        self.assertEqual(self.stub.connections, 1)
+
+
+    def test_token_is_refreshed_before_it_expires(self):
+        self.stub.token_lifetime = self.client.refresh_margin + 1
+        self.client.list_servers()
+        time.sleep(1.1)
+        self.client.list_servers()
+        self.assertEqual(self.stub.logins, 2)
+
+
+    def test_rejected_token_is_renewed(self):
+        self.client.list_servers()
+        self.stub.tokens.clear()
+        self.client.list_servers()
+        self.assertEqual(self.stub.logins, 2)
+
+
+    def test_bad_credentials(self):
+        client = OpenStackClient(self.stub.auth_url(), 'admin', 'wrong', 'admin')
+        self.assertRaises(RuntimeError, client.list_servers)
+
+
+    def test_port_index_uses_one_call_for_many_vms(self):
+        port1 = self.stub.add_port('fa:16:3e:00:00:01')
+        port2 = self.stub.add_port('FA:16:3E:00:00:02')
+        port3 = self.stub.add_port('fa:16:3e:00:00:03', host = 'compute2')
+        self.stub.add_port('fa:16:3e:00:00:04', host = 'compute2')
+        ports = PortIndex('compute1')
+        self.assertEqual(ports.get_port_id('fa:16:3e:00:00:01'), port1)
+        self.assertEqual(ports.get_port_id('fa:16:3e:00:00:02'), port2)
+        self.assertEqual(len([request for request in self.stub.requests if request[1].endswith('/ports')]), 1)
+        #bound to another host name, looked up by mac
+        self.assertEqual(ports.get_port_id('fa:16:3e:00:00:03'), port3)
+        self.assertRaises(LookupError, ports.get_port_id, 'fa:16:3e:00:00:05')
+
+
+    def test_update_port_qos(self):
+        port_id = self.stub.add_port('fa:16:3e:00:00:01')
+        self.stub.add_policy('metering_whitelist', 1000)
+        self.client.update_port_qos(port_id, 'metering_whitelist')
+        self.assertEqual(self.stub.policy_name(port_id), 'metering_whitelist')
+        self.assertRaises(LookupError, self.client.update_port_qos, port_id, 'metering_unknown')
+
+
+    def test_synch_metering_rule(self):
+        limit = LimitType('metering_whitelist', 20, 5000, 1000)
+        limit.synch_metering_rule()
+        limit.band_per_sec = 2000
+        limit.synch_metering_rule()
+        policy_id = self.client.qos_policy_id('metering_whitelist')
+        rules = self.client.list_bandwidth_limit_rules(policy_id)
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(rules[0]['max_kbps'], 2000)
+
+
+    def test_unreachable_service_fails_fast(self):
+        self.client.list_servers()
+        self.stub.stop()
+        self.client.close()
+        for i in range(5):
+            self.assertRaises(Exception, self.client.list_servers)
+        start = time.time()
+        self.assertRaises(CircuitOpenError, self.client.list_servers)
+        self.assertTrue(time.time() - start < 1)
+        self.stub = StubOpenStack().start()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
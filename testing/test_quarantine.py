@@ -0,0 +1,71 @@
+import time
+import unittest
+from code.quarantine import *
+from code.vm import Vm, Cycle, update_cycles
+from code.cycle_table import CycleTable, BYTES_PER_GB
+from code.collector import CounterCollector
+from code.limit import LimitType
+from testing.fakes import FakeLimits, FakeQos
+
+
+class MigratingCollector(CounterCollector):
+
+    def read(self, virsh_id, tap_interface):
+        raise LookupError('Domain ' + virsh_id + ' not found')
+
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def test_backoff_doubles(self):
+        quarantine = Quarantine(base_delay = 10, max_delay = 25)
+        now = time.time()
+        self.assertAlmostEqual(quarantine.add('5', LookupError('gone')) - now, 10, 0)
+        self.assertFalse(quarantine.ready('5'))
+        self.assertTrue(quarantine.ready('6'))
+        self.assertAlmostEqual(quarantine.add('5', LookupError('gone')) - now, 20, 0)
+        self.assertAlmostEqual(quarantine.add('5', LookupError('gone')) - now, 25, 0)
+        self.assertEqual(quarantine.status()['5']['failures'], 3)
+        self.assertEqual(quarantine.status()['5']['error'], 'gone')
+        quarantine.release('5')
+        self.assertEqual(len(quarantine), 0)
+
+
+    def test_retain_forgets_gone_vms(self):
+        quarantine = Quarantine()
+        quarantine.add('5', LookupError('gone'))
+        quarantine.add('6', LookupError('gone'))
+        quarantine.retain(set(['6']))
+        self.assertFalse('5' in quarantine)
+        self.assertTrue('6' in quarantine)
+
+
+
+class TestUpdateCycles(unittest.TestCase):
+
+    def vm(self, virsh_id, tap, table, collector = None):
+        limit = LimitType('metering_blacklist', 10, 100, 200)
+        metadata = {'nova_id': 'nova' + virsh_id, 'tap_interface': tap, 'mac_address': 'fa:16:3e:00:00:0' + virsh_id,
+                    'tenant': 'admin', 'port_id': 'port' + virsh_id, 'applied_policy': limit.name}
+        vm = Vm(virsh_id, FakeLimits(limit), Cycle(time.time(), 0), collector = collector, metadata = metadata,
+                qos = FakeQos(), table = table)
+        vm.verified = True
+        return vm
+
+
+    def test_failing_vm_does_not_stop_the_others(self):
+        table = CycleTable()
+        healthy = self.vm('1', 'tap1', table)
+        migrating = self.vm('2', 'tap2', table, MigratingCollector())
+        abuser = self.vm('3', 'tap3', table)
+        failures = update_cycles([healthy, migrating, abuser], 'metering_restricted',
+                                 {'tap1': (10, 0), 'tap3': (200 * BYTES_PER_GB, 0)})
+        self.assertEqual([(vm.virsh_id, type(exception)) for vm, exception in failures], [('2', LookupError)])
+        self.assertTrue(abuser.cycle.is_restricted)
+        self.assertFalse(healthy.cycle.is_restricted)
+        self.assertRaises(LookupError, migrating.update_cycle, 'metering_restricted', {})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import time
+import unittest
+from code.reconcile import *
+from code.openstack import *
+from testing.openstack_stub import StubOpenStack
+
+
+class TestQosReconciler(unittest.TestCase):
+    """
+    Runs the reconciler against a local stub of neutron
+    """
+
+    def setUp(self):
+        self.stub = StubOpenStack(latency = 0.2).start()
+        set_client(OpenStackClient(self.stub.auth_url(), 'admin', 'secret', 'admin'))
+        self.stub.add_policy('metering_whitelist', 1000)
+        self.stub.add_policy('metering_blacklist', 200)
+        self.stub.add_policy('metering_restricted', 5)
+
+
+    def tearDown(self):
+        get_client().close()
+        set_client(None)
+        self.stub.stop()
+
+
+    def port_updates(self):
+        return [request for request in self.stub.requests if request[0] == 'PUT']
+
+
+    def test_updates_are_coalesced_per_port(self):
+        applied = []
+        port1 = self.stub.add_port('fa:16:3e:00:00:01')
+        port2 = self.stub.add_port('fa:16:3e:00:00:02')
+        reconciler = QosReconciler(2)
+        reconciler.submit(port1, 'metering_whitelist', applied.append)
+        reconciler.submit(port1, 'metering_blacklist', applied.append)
+        reconciler.submit(port2, 'metering_whitelist')
+        self.assertEqual(reconciler.depth(), 2)
+        reconciler.start()
+        self.assertTrue(reconciler.join(10))
+        self.assertEqual(len(self.port_updates()), 2)
+        self.assertEqual(self.stub.policy_name(port1), 'metering_blacklist')
+        self.assertEqual(self.stub.policy_name(port2), 'metering_whitelist')
+        self.assertEqual(applied, ['metering_blacklist'])
+        self.assertEqual(reconciler.oldest_age(), 0)
+
+
+    def test_failed_update_is_retried(self):
+        reconciler = QosReconciler(1, retry_delay = 0.5)
+        reconciler.start()
+        reconciler.submit('port1', 'metering_restricted')
+        self.assertFalse(reconciler.join(1))
+        self.assertEqual(reconciler.depth(), 1)
+        self.stub.add_port('fa:16:3e:00:00:01', port_id = 'port1')
+        self.assertTrue(reconciler.join(10))
+        self.assertEqual(self.stub.policy_name('port1'), 'metering_restricted')
+
+
+    def test_cancelled_port_is_not_retried(self):
+        reconciler = QosReconciler(1, retry_delay = 0.5)
+        reconciler.submit('port1', 'metering_restricted')
+        reconciler.cancel('port1')
+        reconciler.start()
+        self.assertTrue(reconciler.join(10))
+        self.assertEqual(self.port_updates(), [])
+
+
+    def test_stop_lets_the_update_in_flight_finish(self):
+        port1 = self.stub.add_port('fa:16:3e:00:00:01')
+        reconciler = QosReconciler(2)
+        reconciler.start()
+        reconciler.submit(port1, 'metering_restricted')
+        while port1 not in reconciler.in_flight:
+            time.sleep(0.01)
+        reconciler.stop(10)
+        self.assertEqual(reconciler.threads, [])
+        self.assertEqual(self.stub.policy_name(port1), 'metering_restricted')
+        self.assertEqual(reconciler.depth(), 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from code.replay import *
+from code.archive import UsageArchive
+from code.cycle_table import BYTES_PER_GB, SECONDS_PER_DAY
+from code.limit import LimitType
+
+testing_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestPolicyReplay(unittest.TestCase):
+
+    def setUp(self):
+        blacklist = LimitType('metering_blacklist', 10, 100, 200)
+        whitelist = LimitType('metering_whitelist', 20, 5000, 1000)
+        limits = {'metering_blacklist': blacklist, 'metering_whitelist': whitelist}
+        self.replay = PolicyReplay([('strict', limits, {}, 'metering_blacklist'),
+                                    ('loose', limits, {'test': 'metering_whitelist'}, 'metering_blacklist'),
+                                    ('unmetered', limits, {'test': 'metering_whitelist'}, 'other')],
+                                   ['test', 'admin'])
+
+
+    def test_restriction_and_detection_delay(self):
+        #the test VM crosses 100 GB half way between its second and third samples
+        self.replay.replay([0, 100, 200], [0, 0, 0], [0, 50 * BYTES_PER_GB, 150 * BYTES_PER_GB])
+        strict, loose, unmetered = self.replay.results()
+        self.assertEqual(strict['restrictions'], 1)
+        self.assertEqual(strict['restricted_tenants'], ['test'])
+        self.assertEqual(strict['restricted_at_end'], 1)
+        self.assertEqual(strict['qos_updates'], 1)
+        self.assertAlmostEqual(strict['detection_seconds']['max'], 50)
+        self.assertEqual(loose['restrictions'], 0)
+        self.assertEqual(loose['detection_seconds'], None)
+        self.assertEqual(unmetered['vms'], 1)
+
+
+    def test_restriction_is_lifted_by_the_next_cycle(self):
+        day = SECONDS_PER_DAY
+        times = [0, 0, day, day, 11 * day, 11 * day]
+        self.replay.replay(times, [0, 1, 0, 1, 0, 1], [0, 0, 200 * BYTES_PER_GB, 1, 201 * BYTES_PER_GB, 2])
+        strict = self.replay.results()[0]
+        self.assertEqual(strict['vms'], 2)
+        self.assertEqual(strict['restrictions'], 1)
+        self.assertEqual(strict['lifted'], 1)
+        self.assertEqual(strict['restricted_at_end'], 0)
+        self.assertEqual(strict['qos_updates'], 2)
+        self.assertAlmostEqual(strict['qos_updates_per_day'], 2 / 11.0)
+
+
+    def test_samples_out_of_order(self):
+        self.replay.replay([200, 0, 100], [0, 0, 0], [150 * BYTES_PER_GB, 0, 50 * BYTES_PER_GB])
+        self.assertAlmostEqual(self.replay.results()[0]['detection_seconds']['mean'], 50)
+
+
+
+class TestReplayArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        archive = UsageArchive(self.directory, retention_days = 0)
+        for step in range(10):
+            archive.append(10 * step, [('nova-a', 'admin', step * BYTES_PER_GB, 0), ('nova-b', 'test', step, 0)])
+        self.archive = UsageArchive(self.directory, retention_days = 0)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_candidate_files(self):
+        current, small = replay_archive(self.archive, [os.path.join(testing_dir, 'meter.yaml'),
+                                                       os.path.join(testing_dir, 'meter_small_limit.yaml')],
+                                        0, 100)
+        self.assertEqual(current['restrictions'], 0)
+        self.assertEqual(current['vms'], 2)
+        #0.01 GB over 17 seconds, every other sample starts a new cycle
+        self.assertEqual(small['restricted_tenants'], ['admin'])
+        self.assertTrue(small['restrictions'] > 1)
+        self.assertTrue(small['lifted'] > 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import time
+import unittest
+from code.sampling import *
+from code.vm import Vm, Cycle
+from code.limit import LimitType
+from testing.fakes import FakeLimits, FakeQos
+
+
+class TestSampleQueue(unittest.TestCase):
+
+    def test_vms_are_returned_in_due_order(self):
+        samples = SampleQueue(100)
+        samples.schedule('1', 50, 0)
+        samples.schedule('2', 10, 0)
+        samples.schedule('3', 1000, 0) #bounded by max_interval
+        self.assertEqual(samples.pop_due(5), [])
+        self.assertEqual(samples.pop_due(60), ['2', '1'])
+        self.assertEqual(samples.pop_due(100), ['3'])
+        self.assertEqual(len(samples), 0)
+
+
+    def test_rescheduled_and_removed_vms(self):
+        samples = SampleQueue(100)
+        samples.schedule('1', 10, 0)
+        samples.schedule('2', 10, 0)
+        samples.schedule('1', 30, 0)
+        samples.remove('2')
+        self.assertEqual(samples.pop_due(20), [])
+        self.assertTrue('1' in samples)
+        self.assertEqual(samples.pop_due(30), ['1'])
+
+
+
+class TestNextSampleTime(unittest.TestCase):
+    """
+    The earliest time a VM restored from file could reach its quota
+    """
+
+    def restored_vm(self, limit, cycle):
+        metadata = {'nova_id': 'nova', 'tap_interface': 'tap1', 'mac_address': 'fa:16:3e:00:00:01',
+                    'tenant': 'admin', 'port_id': 'port1', 'applied_policy': limit.name}
+        vm = Vm('1', FakeLimits(limit), cycle, metadata = metadata, qos = FakeQos())
+        vm.verified = True
+        return vm
+
+
+    def test_far_from_quota(self):
+        #100 GB left at the default line rate of 10 Gbps (1.25 GB/s) takes 80 seconds,
+        #however slow the policy of the port is
+        limit = LimitType('metering_blacklist', 10, 200, 8000)
+        now = time.time()
+        vm = self.restored_vm(limit, Cycle(now, 0))
+        self.assertEqual(vm.next_sample_time(), 0)
+        vm.update_cycle('metering_restricted', {'tap1': (100 * 1000000000, 0)})
+        self.assertAlmostEqual(vm.next_sample_time() - vm.table.last_date[vm.cycle.row], 80, 3)
+
+
+    def test_bounded_by_cycle_end(self):
+        limit = LimitType('metering_whitelist', 1, 500000, 8000)
+        now = time.time()
+        vm = self.restored_vm(limit, Cycle(now - 3600, 0))
+        vm.update_cycle('metering_restricted', {'tap1': (0, 0)})
+        self.assertAlmostEqual(vm.next_sample_time(), now - 3600 + 86400, 3)
+
+
+    def test_over_quota(self):
+        limit = LimitType('metering_blacklist', 10, 100, 8000)
+        vm = self.restored_vm(limit, Cycle(time.time(), 0))
+        vm.update_cycle('metering_restricted', {'tap1': (150 * 1000000000, 0)})
+        self.assertTrue(vm.cycle.is_restricted)
+        self.assertEqual(vm.next_sample_time(), vm.cycle.date + 10 * 86400)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
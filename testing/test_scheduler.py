@@ -0,0 +1,76 @@
+import unittest
+from code.scheduler import *
+from code.util import monotonic
+
+
+class FakeClock:
+    now = 0
+
+    def __init__(self, now = 100):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestCycleScheduler(unittest.TestCase):
+
+    def test_cadence_does_not_drift(self):
+        clock = FakeClock()
+        scheduler = CycleScheduler(10, clock)
+        for cycle in range(5):
+            self.assertEqual(scheduler.begin_cycle(), 110 + cycle * 10)
+            clock.now += 3 #work
+            self.assertEqual(scheduler.complete_cycle(), 0)
+            self.assertEqual(scheduler.remaining(), 7)
+            clock.now += scheduler.remaining()
+        self.assertEqual(clock.now, 150)
+        self.assertEqual(scheduler.overruns, 0)
+
+
+    def test_no_interval_runs_back_to_back(self):
+        clock = FakeClock()
+        scheduler = CycleScheduler(-1, clock)
+        for cycle in range(3):
+            self.assertEqual(scheduler.begin_cycle(), None)
+            clock.now += 3 #work
+            self.assertEqual(scheduler.complete_cycle(), 0)
+            self.assertEqual(scheduler.remaining(), 0)
+        self.assertEqual(scheduler.overruns, 0)
+
+
+    def test_overrun_skips_missed_cycles(self):
+        clock = FakeClock()
+        scheduler = CycleScheduler(10, clock)
+        scheduler.begin_cycle()
+        clock.now += 25
+        self.assertTrue(scheduler.late())
+        self.assertEqual(scheduler.complete_cycle(), 2)
+        #next cycle starts on the slot after the overrun, not straight away
+        self.assertEqual(scheduler.remaining(), 5)
+        clock.now += 5
+        self.assertEqual(scheduler.begin_cycle(), 140)
+        clock.now += 1
+        self.assertEqual(scheduler.complete_cycle(), 0)
+        self.assertEqual(scheduler.stats(), {'interval': 10, 'overruns': 1, 'skipped_cycles': 2, 'last_lateness': 0,
+                                             'max_lateness': 15, 'total_lateness': 15})
+
+
+    def test_advance_deadline(self):
+        self.assertEqual(advance_deadline(100, 30, 95), 100)
+        self.assertEqual(advance_deadline(100, 30, 100), 130)
+        self.assertEqual(advance_deadline(100, 30, 175), 190)
+        #the limits are resynched every cycle instead of never getting past the deadline
+        self.assertEqual(advance_deadline(100, 0, 175), 175)
+        self.assertEqual(advance_deadline(100, -3600, 175), 175)
+
+
+    def test_monotonic(self):
+        first = monotonic()
+        self.assertTrue(monotonic() >= first)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
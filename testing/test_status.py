@@ -0,0 +1,170 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import unittest
+from code.status import *
+from code.cycle_table import CycleTable, BYTES_PER_GB
+from code.limit import LimitType
+import code.metering_check as metering_check
+
+
+def run_check(args):
+    argv = sys.argv
+    sys.argv = ['metering_check.py'] + args
+    try:
+        metering_check.main()
+    except SystemExit as exit:
+        return exit.code
+    finally:
+        sys.argv = argv
+
+
+
+class FakeVm:
+    nova_id = 'nova'
+    tenant = 'admin'
+    band_limit = None
+    cycle = None
+
+    def __init__(self, table, limit, start_bytes, restricted = False):
+        self.band_limit = limit
+        self.cycle = table.add(1000, start_bytes, restricted)
+        table.set_limit(self.cycle.row, limit)
+
+
+
+class TestStatusBoard(unittest.TestCase):
+
+    def setUp(self):
+        self.limit = LimitType('metering_blacklist', 10, 100, 200)
+        self.table = CycleTable()
+        self.vms = {'5': FakeVm(self.table, self.limit, 0), '7': FakeVm(self.table, self.limit, 0, True)}
+        self.table.evaluate([self.vms['5'].cycle.row], [1010], [3 * BYTES_PER_GB])
+        self.board = StatusBoard(30)
+
+
+    def test_health_before_and_after_a_cycle(self):
+        health = self.board.answer(['health'])
+        self.assertTrue(health['alive'])
+        self.assertEqual(health['last_cycle_age'], None)
+        self.board.update(self.vms, self.table, {'vms': 2})
+        health = self.board.answer(['health'])
+        self.assertTrue(health['last_cycle_age'] < 5)
+        self.assertEqual(health['vms'], 2)
+        self.assertEqual(health['restricted'], 1)
+        self.assertEqual(self.board.answer(['status']), {'vms': 2})
+
+
+    def test_usage_and_restricted(self):
+        self.board.update(self.vms, self.table, {})
+        usage = self.board.answer(['usage', '5'])['vms']
+        self.assertEqual(list(usage.keys()), ['5'])
+        self.assertAlmostEqual(usage['5']['used_gb'], 3)
+        self.assertAlmostEqual(usage['5']['limit_gb'], 100)
+        self.assertEqual(usage['5']['limit'], 'metering_blacklist')
+        self.assertEqual(self.board.answer(['usage'])['vms']['7']['used_gb'], 0) #never sampled
+        self.assertEqual(list(self.board.answer(['restricted'])['restricted'].keys()), ['7'])
+        self.assertRaises(LookupError, self.board.answer, ['usage', '9'])
+        self.assertRaises(ValueError, self.board.answer, ['reboot'])
+
+
+
+class TestStatusServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metering.sock')
+        self.board = StatusBoard(30)
+        self.server = StatusServer(self.path, self.board).start()
+
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+
+    def test_query(self):
+        self.assertTrue(query_status(self.path, 'health')['alive'])
+        self.assertEqual(query_status(self.path, 'restricted'), {'restricted': {}})
+        self.assertRaises(LookupError, query_status, self.path, 'usage 5')
+
+
+    def test_nobody_listening(self):
+        self.assertRaises(socket.error, query_status, os.path.join(self.directory, 'other.sock'), 'health')
+
+
+    def test_check_does_not_need_numpy(self):
+        code_dir = os.path.dirname(os.path.realpath(metering_check.__file__))
+        output = subprocess.check_output([sys.executable, '-c', 'import sys; import metering_check; '
+                                          'print(sorted(set(["numpy", "cycle_table"]) & set(sys.modules)))'],
+                                         cwd = code_dir)
+        self.assertEqual(output.decode('utf-8').strip(), '[]')
+
+
+    def test_check_reports_a_stuck_daemon(self):
+        self.board.started = time.time() - 600
+        self.assertEqual(run_check(['-s', self.path]), metering_check.STATE_CRITICAL)
+        self.board.snapshot = {'time': time.time(), 'vms': {}, 'status': {}}
+        self.assertEqual(run_check(['-s', self.path]), metering_check.STATE_OK)
+
+
+
+class TestStatusFile(unittest.TestCase):
+    """
+    metering_check.py reads the recovery file when the daemon does not answer
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'recovery.txt')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def check(self, entries, journal = None):
+        with open(self.fname, 'w') as f:
+            f.write('vm id, date(unix time), date (GB), restricted(t/f)\n')
+            f.writelines(entry + '\n' for entry in entries)
+        if journal is not None:
+            with open(self.fname + '.journal', 'w') as f:
+                f.writelines(entry + '\n' for entry in journal)
+        try:
+            metering_check.read_errors_from_status_file(self.fname)
+        except SystemExit as exit:
+            return exit.code
+        return metering_check.STATE_OK
+
+
+    def test_unrestricted_vms_are_ok(self):
+        self.assertEqual(self.check(['5, 1000.0, 1.5, False', '7, 1000.0, 2.5, False']), metering_check.STATE_OK)
+
+
+    def test_restricted_vm_is_reported(self):
+        self.assertEqual(self.check(['5, 1000.0, 1.5, False', '7, 1000.0, 2.5, True']), metering_check.STATE_WARNING)
+
+
+    def test_journal_is_replayed(self):
+        self.assertEqual(self.check(['5, 1000.0, 1.5, True'], ['- 5']), metering_check.STATE_OK)
+        self.assertEqual(self.check(['5, 1000.0, 1.5, False'], ['+ 5, 1000.0, 1.5, True']), metering_check.STATE_WARNING)
+
+
+    def test_bad_entry_is_critical(self):
+        self.assertEqual(self.check(['x, 1000.0, 1.5, False']), metering_check.STATE_CRITICAL)
+
+
+    def test_silent_daemon_is_never_ok(self):
+        self.check(['5, 1000.0, 1.5, False'])
+        self.assertEqual(run_check(['-s', os.path.join(self.directory, 'metering.sock'), '-f', self.fname]),
+                         metering_check.STATE_WARNING)
+        self.assertEqual(run_check(['-s', os.path.join(self.directory, 'metering.sock')]), metering_check.STATE_CRITICAL)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import unittest
+import code.util
+from code.util import *
+
+
+class TestSubprocessCmd(unittest.TestCase):
+
+    def setUp(self):
+        breakers.clear()
+        self.backoff_base = code.util.backoff_base
+        code.util.backoff_base = 0.01
+
+
+    def tearDown(self):
+        code.util.backoff_base = self.backoff_base
+        breakers.clear()
+
+
+    def test_output_and_retries(self):
+        self.assertEqual(subprocess_cmd('echo hello'), 'hello')
+        self.assertRaises(RuntimeError, subprocess_cmd, 'false', 2)
+
+
+    def test_argument_list_is_not_run_by_a_shell(self):
+        self.assertEqual(subprocess_cmd(['echo', 'instance-0000000a; ls', '$HOME']), 'instance-0000000a; ls $HOME')
+
+
+    def test_hung_command_is_killed(self):
+        start = monotonic()
+        self.assertRaises(RuntimeError, subprocess_cmd, 'sleep 10', 0, 0.5)
+        self.assertTrue(monotonic() - start < 5)
+
+
+    def test_breaker_opens_per_backend(self):
+        for i in range(5):
+            self.assertRaises(RuntimeError, subprocess_cmd, 'false virsh', 0)
+        self.assertEqual(get_breaker('virsh').state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, subprocess_cmd, 'echo virsh')
+        #other backends are not affected
+        self.assertEqual(subprocess_cmd('echo neutron'), 'neutron')
+
+
+    def test_command_backend(self):
+        self.assertEqual(command_backend('sudo virsh list | tail -n +3'), 'virsh')
+        self.assertEqual(command_backend('neutron port-list'), 'neutron')
+        self.assertEqual(command_backend(['sudo', 'virsh', 'dumpxml', '5']), 'virsh')
+        self.assertEqual(command_backend('ls /tmp'), None)
+
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_trial_call_after_reset_timeout(self):
+        breaker = CircuitBreaker('neutron', failure_threshold = 2, reset_timeout = 0.2)
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        time.sleep(0.3)
+        breaker.allow()
+        #only one trial call at a time
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.allow)
+        time.sleep(0.3)
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.allow()
+
+
+    def test_backoff_delay(self):
+        for retry in range(10):
+            self.assertTrue(0 <= backoff_delay(retry) <= code.util.backoff_max)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from code.virsh import *
+from code.util import breakers
+from code.vm import Vm, Cycle
+from testing.fakes import FakeLimits
+
+
+class TestVirshSession(unittest.TestCase):
+    """
+    Runs the session against testing/fake_virsh.py
+    """
+
+    def setUp(self):
+        breakers.clear()
+        self.directory = tempfile.mkdtemp()
+        self.starts = os.path.join(self.directory, 'starts')
+        fake_virsh = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_virsh.py')
+        self.session = VirshSession([sys.executable, fake_virsh, self.starts], timeout = 2)
+
+
+    def tearDown(self):
+        self.session.close()
+        set_session(None)
+        shutil.rmtree(self.directory)
+        breakers.clear()
+
+
+    def start_count(self):
+        with open(self.starts) as f:
+            return len(f.readlines())
+
+
+    def test_commands_share_one_process(self):
+        set_session(self.session)
+        self.assertTrue(virsh_cmd(['list']).splitlines()[-1].split()[:2] == ['7', 'instance-00000007'])
+        self.assertEqual(virsh_cmd(['domid', 'instance-00000005']), '5')
+        self.assertEqual(virsh_cmd(['domifstat', '5', 'tap1']), 'tap1 rx_bytes 1000\ntap1 tx_bytes 2000')
+        self.assertEqual(self.start_count(), 1)
+
+
+    def test_arguments_are_escaped(self):
+        self.assertEqual(self.session.run(['args', 'a b', "it's", 'x;y']), "a b|it's|x;y")
+
+
+    def test_error_keeps_the_session(self):
+        self.assertRaises(RuntimeError, self.session.run, ['dumpxml', '42'])
+        self.assertEqual(self.session.run(['domid', 'instance-00000007']), '7')
+        self.assertEqual(self.start_count(), 1)
+
+
+    def test_respawn_after_exit(self):
+        self.session.run(['list'])
+        self.session.process.stdin.write('exit\n')
+        self.session.process.stdin.flush()
+        self.session.process.wait()
+        self.assertEqual(self.session.run(['domid', 'instance-00000005']), '5')
+        self.assertEqual(self.start_count(), 2)
+
+
+    def test_hung_session_is_replaced(self):
+        self.assertRaises(VirshSessionError, self.session.run, ['sleep', '10'])
+        self.assertEqual(self.session.run(['domid', 'instance-00000005']), '5')
+
+
+    def test_concurrent_callers_get_their_own_answer(self):
+        results = {}
+        def run(tap):
+            results[tap] = self.session.run(['domifstat', '5', tap])
+        threads = [threading.Thread(target = run, args = ('tap' + str(i),)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertTrue(results['tap' + str(i)].startswith('tap' + str(i) + ' rx_bytes'))
+
+
+
+
+class FakePorts:
+
+    def get_port_id(self, mac_address):
+        return 'port-' + mac_address
+
+
+
+class TestRestoredVm(unittest.TestCase):
+    """
+    A VM restored from file is checked against the live domain on its first sample
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fake_virsh = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_virsh.py')
+        set_session(VirshSession([sys.executable, fake_virsh, os.path.join(self.directory, 'starts')], timeout = 2))
+
+
+    def tearDown(self):
+        get_session().close()
+        set_session(None)
+        shutil.rmtree(self.directory)
+
+
+    def restored_vm(self, nova_id, tenant):
+        metadata = {'nova_id': nova_id, 'tap_interface': 'tap5', 'mac_address': 'fa:16:3e:00:00:05',
+                    'tenant': tenant, 'port_id': 'port-fa:16:3e:00:00:05', 'applied_policy': 'metering_blacklist'}
+        vm = Vm('5', FakeLimits(), Cycle(time.time(), 0), metadata = metadata, ports = FakePorts())
+        vm.state_change_required = False
+        return vm
+
+
+    def test_matching_domain_is_kept(self):
+        vm = self.restored_vm('nova-5', 'test')
+        self.assertEqual(vm.sample({'tap5': (1000, 0)}), 1000)
+        self.assertTrue(vm.verified)
+        self.assertFalse(vm.state_change_required)
+
+
+    def test_reused_virsh_id_is_rediscovered(self):
+        vm = self.restored_vm('nova-of-a-deleted-vm', 'admin')
+        vm.sample({'tap5': (1000, 0)})
+        self.assertEqual(vm.nova_id, 'nova-5')
+        self.assertEqual(vm.tenant, 'test')
+        self.assertTrue(vm.state_change_required)
+
+
+
+if __name__ == '__main__':
+    unittest.main()